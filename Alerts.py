@@ -0,0 +1,194 @@
+#
+# Copyright (c) 2018, Edgewise Networks Inc. All rights reserved.
+#
+
+import sys
+import json
+import queue
+import threading
+from datetime import datetime
+
+class Alert(object):
+    """ One detector event about a key: 'start' and 'end' of an outlier
+        period, or a warning named by event. value is the detector's measure
+        (sigmas, N_rem, ...) or a dict of them, if it has one; timestamp is
+        the netflow time in seconds. description says what the key became, as
+        in "an outlier for IP port scanning".
+    """
+    __slots__ = ('detector', 'key', 'event', 'value', 'timestamp', 'description')
+
+    def __init__(self, detector, key, event, value, timestamp, description):
+        self.detector = detector
+        self.key = key
+        self.event = event
+        self.value = value
+        self.timestamp = timestamp
+        self.description = description
+
+    def getText(self):
+        """ The line detectors print when they have no AlertSink.
+        """
+        dt = datetime.fromtimestamp(self.timestamp)
+        if self.event == 'start':
+            return "%s ::: IP address %s became %s." % (dt, self.key, self.description)
+        if self.event == 'end':
+            return "%s ::: IP address %s is no longer %s." % (dt, self.key, self.description)
+        if isinstance(self.value, dict):
+            value = ' '.join("%s=%f" % item for item in sorted(self.value.items()))
+        else:
+            value = self.value
+        return "%s ::: IP address %s: %s %s" % (dt, self.key, self.event, value)
+
+    def toDict(self):
+        return {'detector': self.detector, 'key': self.key, 'event': self.event, 'value': self.value,
+                'timestamp': self.timestamp, 'time': datetime.fromtimestamp(self.timestamp).isoformat()}
+
+
+class TextWriter(object):
+    """ Writes each alert's getText() line to f, stdout by default.
+    """
+    __slots__ = ('f',)
+
+    def __init__(self, f=None):
+        self.f = f
+
+    def __call__(self, alerts):
+        f = self.f if self.f is not None else sys.stdout
+        f.write(''.join(alert.getText() + '\n' for alert in alerts))
+        f.flush()
+
+    def close(self):
+        pass
+
+
+class JsonlWriter(object):
+    """ Appends each alert to fname as a line of JSON.
+    """
+    __slots__ = ('f',)
+
+    def __init__(self, fname):
+        self.f = open(fname, 'a')
+
+    def __call__(self, alerts):
+        self.f.write(''.join(json.dumps(alert.toDict()) + '\n' for alert in alerts))
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+class AlertSink(object):
+    """ Takes alerts from detectors without blocking them on output.
+
+        add() puts an alert on a queue of up to maxQueue alerts, and a
+        background thread takes them off in batches of up to batchSize and
+        hands each batch to every writer: a TextWriter, a JsonlWriter, or any
+        callable taking a list of Alerts. When the queue is full, alerts are
+        dropped and counted in overflowed, rather than slowing the detectors
+        down to the speed of the output.
+
+        With maxPerKey, each (detector, key, event) gets at most that many
+        alerts per ratePeriod seconds of netflow time; the rest are counted
+        in limited.
+    """
+    __slots__ = ('writers', 'queue', 'batchSize', 'maxPerKey', 'ratePeriod', 'window', 'counts',
+                 'limited', 'overflowed', 'written', 'thread')
+
+    def __init__(self, writers=None, maxQueue=65536, batchSize=512, maxPerKey=None, ratePeriod=3600):
+        self.writers = writers if writers is not None else [TextWriter()]
+        self.queue = queue.Queue(maxQueue)
+        self.batchSize = batchSize
+        self.maxPerKey = maxPerKey
+        self.ratePeriod = ratePeriod
+        # the ratePeriod the alerts are in, and (detector, key, event) -> alerts so far in it
+        self.window = None
+        self.counts = {}
+        self.limited = 0
+        self.overflowed = 0
+        self.written = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def add(self, alert):
+        """ Returns False if the alert was dropped.
+        """
+        if self.maxPerKey is not None:
+            window = int(alert.timestamp // self.ratePeriod)
+            if window != self.window:
+                self.window = window
+                self.counts = {}
+            key = (alert.detector, alert.key, alert.event)
+            count = self.counts.get(key, 0)
+            if count >= self.maxPerKey:
+                self.limited += 1
+                return False
+            self.counts[key] = count + 1
+        try:
+            self.queue.put_nowait(alert)
+        except queue.Full:
+            self.overflowed += 1
+            return False
+        return True
+
+    def run(self):
+        """ Writer thread loop, until close().
+        """
+        while True:
+            alert = self.queue.get()
+            batch = []
+            while alert is not None:
+                batch.append(alert)
+                if len(batch) >= self.batchSize:
+                    break
+                try:
+                    alert = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            if batch:
+                for writer in self.writers:
+                    try:
+                        writer(batch)
+                    except Exception as e:
+                        print("alert writer failed: %r" % e)
+                self.written += len(batch)
+            for _ in range(len(batch)):
+                self.queue.task_done()
+            if alert is None:
+                self.queue.task_done()
+                return
+
+    def flush(self):
+        """ Wait until every alert added so far is written.
+        """
+        self.queue.join()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        for writer in self.writers:
+            if hasattr(writer, 'close'):
+                writer.close()
+
+
+def test():
+    import os
+    import tempfile
+    written = []
+    sink = AlertSink([written.extend], batchSize=3, maxPerKey=2, ratePeriod=60)
+    for i in range(10):
+        sink.add(Alert('Test', '10.0.0.%i' % (i % 2), 'start', 6.0, 1500000000 + i, "an outlier"))
+    sink.add(Alert('Test', '10.0.0.0', 'start', 6.0, 1500000060, "an outlier"))
+    sink.flush()
+    assert len(written) == 5 and sink.limited == 6 and sink.written == 5
+    assert [alert.timestamp for alert in written] == [1500000000, 1500000001, 1500000002, 1500000003, 1500000060]
+    sink.close()
+    fname = os.path.join(tempfile.mkdtemp(), 'alerts.jsonl')
+    sink = AlertSink([JsonlWriter(fname)])
+    sink.add(Alert('Test', '10.0.0.1', 'end', None, 1500000000, "an outlier"))
+    sink.add(Alert('Test', '10.0.0.2', 'negative N_rem', {'N_rem': -2.0, 'slope': 1.0}, 1500000000, "frozen"))
+    sink.close()
+    with open(fname) as f:
+        lines = [json.loads(line) for line in f]
+    assert [line['event'] for line in lines] == ['end', 'negative N_rem']
+    assert lines[1]['value'] == {'N_rem': -2.0, 'slope': 1.0}
+    assert "is no longer an outlier." in Alert('Test', '10.0.0.1', 'end', None, 1500000000, "an outlier").getText()
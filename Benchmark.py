@@ -0,0 +1,238 @@
+#
+# Copyright (c) 2018, Edgewise Networks Inc. All rights reserved.
+#
+
+""" Reproducible benchmarks of the readers and detectors on synthetic netflows.
+
+    generateSite() writes a seeded synthetic site in the .txt.gz layout the
+    DataIterator readers expect. benchmark() runs every case in a fresh
+    process, so peak RSS is per case, and writes flows/sec, check latency
+    and peak RSS as JSON. compare() prints two such files side by side.
+"""
+
+import os
+import gzip
+import json
+import resource
+import multiprocessing
+from time import perf_counter
+import numpy as np
+
+def generateSite(dirname, seed=0, numHosts=1000, numFiles=4, rowsPerFile=100000, fanoutShape=1.2,
+                 maxFanout=5000, scanRate=0.001, numScanners=1, loopbackRate=0.005,
+                 startTime=1500000000000, meanGapMs=20.0):
+    """ Write numFiles files of rowsPerFile synthetic netflows to dirname.
+
+        Hosts send traffic in proportion to a Pareto weight, and each talks
+        to its own set of destinations whose size (the fan-out) is Pareto
+        distributed with shape fanoutShape, capped at maxFanout. As in
+        iterateNetworkDataWithPortScanning, a scanRate fraction of the rows
+        are replaced with netflows from numScanners scanners to random
+        ip:port pairs, and a loopbackRate fraction come from 127.0.0.1, for
+        the in-network filters to drop. Gaps between netflows are
+        exponential with mean meanGapMs.
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(dirname, exist_ok=True)
+    numDestinations = 1 << 16
+    hosts = ["10.%i.%i.%i" % (1 + (i >> 16 & 255), i >> 8 & 255, i & 255) for i in range(numHosts)]
+    weights = rng.pareto(fanoutShape, numHosts) + 1
+    weights /= weights.sum()
+    fanouts = np.minimum((rng.pareto(fanoutShape, numHosts) + 1) * 5, maxFanout).astype(np.int64)
+    destinations = ["10.200.%i.%i" % (d >> 8, d & 255) for d in range(numDestinations)]
+    scanners = ["10.250.0.%i" % (i + 1) for i in range(numScanners)]
+    commonPorts = np.array([22, 53, 80, 443, 3306, 8080])
+    ts = float(startTime)
+    fnames = []
+    for f in range(numFiles):
+        n = rowsPerFile
+        times = ts + np.cumsum(rng.exponential(meanGapMs, n))
+        ts = float(times[-1])
+        src = rng.choice(numHosts, n, p=weights)
+        dst = (src * 7919 + rng.integers(0, fanouts[src] + 1)) % numDestinations
+        dstport = np.where(rng.random(n) < 0.7, commonPorts[dst % len(commonPorts)], 1024 + dst % 1000)
+        srcport = rng.integers(1024, 65536, n)
+        flows = rng.integers(1, 100, n)
+        scan = rng.random(n) < scanRate
+        scanner = rng.integers(0, numScanners, n)
+        scanDst = rng.integers(0, numDestinations, n)
+        scanPort = rng.integers(1, 65536, n)
+        loopback = rng.random(n) < loopbackRate
+        fname = os.path.join(dirname, "flows-%03i.txt.gz" % f)
+        with gzip.open(fname, 'wt') as out:
+            for i, t in enumerate(times.astype(np.int64).tolist()):
+                if scan[i]:
+                    s, d, port = scanners[scanner[i]], destinations[scanDst[i]], scanPort[i]
+                else:
+                    s, d, port = hosts[src[i]], destinations[dst[i]], dstport[i]
+                if loopback[i]:
+                    s = "127.0.0.1"
+                out.write("%i\t%s\t%i\t%s\t%i\t%i\n" % (t, s, srcport[i], d, port, flows[i]))
+        fnames.append(fname)
+    return fnames
+
+def peakRssKb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def timeChecks(detectorClasses, checkTimes):
+    """ Patch each class's check() to record its duration in checkTimes. Only
+        ever done in a benchmark's own process.
+    """
+    for cls in set(detectorClasses):
+        check = cls.check
+        def timedCheck(self, check=check):
+            start = perf_counter()
+            check(self)
+            checkTimes.append(perf_counter() - start)
+        cls.check = timedCheck
+
+def makeDetectors(names):
+    from IpPortScanDetector import IpPortScanDetector
+    from ExplosionDetector import ExplosionDetector
+    from GrowthDetector import GrowthDetector
+    from HostStabilizationDetector import HostStabilizationDetector
+    specs = {
+        'IpPortScanDetector': lambda: IpPortScanDetector(period=600),
+        'ExplosionDetector': lambda: ExplosionDetector(period=900),
+        'GrowthDetector': lambda: GrowthDetector(period=300),
+        'GrowthDetector/vectorized': lambda: GrowthDetector(period=300, vectorized=True),
+        'HostStabilizationDetector': lambda: HostStabilizationDetector(period=600),
+        'HostStabilizationDetector/vectorized': lambda: HostStabilizationDetector(period=600, vectorized=True),
+    }
+    return [specs[name]() for name in names]
+
+detectorNames = ['IpPortScanDetector', 'ExplosionDetector', 'GrowthDetector', 'GrowthDetector/vectorized',
+                 'HostStabilizationDetector', 'HostStabilizationDetector/vectorized']
+
+def runReader(case, pathname, storename):
+    """ (flows, seconds) to iterate one reader over the whole site.
+    """
+    import DataIterator as D
+    import NetflowStore
+    from Netflows import NetflowBatch
+    readers = {
+        'iterateData': lambda: D.iterateData(pathname, 0),
+        'iterateNetworkDataImpl': lambda: D.iterateNetworkDataImpl(pathname, 0),
+        'iterateNetworkDataParallel': lambda: D.iterateNetworkDataParallel(pathname, 0),
+        'iterateDataBatches': lambda: D.iterateDataBatches(pathname, 0),
+        'iterateNetworkDataBatches': lambda: D.iterateNetworkDataBatches(pathname, 0),
+        'iterateNetworkDataBatchesParallel': lambda: D.iterateNetworkDataBatchesParallel(pathname, 0),
+        'iterateNetworkStoreBatches': lambda: NetflowStore.iterateNetworkStoreBatches(storename),
+    }
+    start = perf_counter()
+    flows = 0
+    for item in readers[case]():
+        flows += len(item) if isinstance(item, NetflowBatch) else 1
+    return flows, perf_counter() - start
+
+def runDetectors(names, path, pathname):
+    """ (flows, seconds, check durations) to feed the in-network netflows of
+        the site, read beforehand, to the named detectors; more than one runs
+        them under a CompositeNetflowDetector.
+    """
+    import DataIterator as D
+    from CompositeNetflowDetector import CompositeNetflowDetector
+    detectors = makeDetectors(names)
+    checkTimes = []
+    timeChecks([type(d) for d in detectors], checkTimes)
+    if len(detectors) == 1:
+        detector = detectors[0]
+    else:
+        detector = CompositeNetflowDetector()
+        for d in detectors:
+            detector.addDetector(d)
+    if path == 'rows':
+        data = list(D.iterateNetworkDataImpl(pathname, 0))
+        flows = len(data)
+        start = perf_counter()
+        detector.addNetflowIterator(iter(data))
+    else:
+        data = list(D.iterateNetworkDataBatches(pathname, 0))
+        flows = sum(len(batch) for batch in data)
+        start = perf_counter()
+        detector.addNetflowBatchIterator(iter(data))
+    return flows, perf_counter() - start, checkTimes
+
+def runCase(kind, case, config, conn):
+    """ Benchmark process body: runs one case and sends back its result.
+    """
+    import io
+    import contextlib
+    try:
+        rssBefore = peakRssKb()
+        with contextlib.redirect_stdout(io.StringIO()):
+            if kind == 'reader':
+                flows, seconds = runReader(case, config['pathname'], config['storename'])
+                checkTimes = []
+            else:
+                names, path = case
+                flows, seconds, checkTimes = runDetectors(names, path, config['pathname'])
+        result = {'flows': flows, 'seconds': seconds, 'flows/sec': flows / seconds if seconds else None,
+                  'checks': len(checkTimes),
+                  'check mean sec': float(np.mean(checkTimes)) if checkTimes else None,
+                  'check max sec': max(checkTimes) if checkTimes else None,
+                  'peak rss kb': peakRssKb(), 'rss before kb': rssBefore}
+    except Exception as e:
+        result = {'error': repr(e)}
+    conn.send(result)
+    conn.close()
+
+def benchmark(outfile, dirname='/tmp/five-sigma-benchmark', seed=0, regenerate=False, readers=True,
+              detectors=True, **siteConfig):
+    """ Run every reader and detector benchmark on a synthetic site (generated
+        into dirname unless already there), print a line per case, and save
+        the results to outfile as JSON.
+    """
+    import NetflowStore
+    sitedir = os.path.join(dirname, 'site0')
+    if regenerate or not os.path.isdir(sitedir):
+        generateSite(sitedir, seed=seed, **siteConfig)
+    pathname = os.path.join(dirname, 'site%s')
+    storename = NetflowStore.convertData(pathname, 0)
+    config = {'pathname': pathname, 'storename': storename}
+    cases = []
+    if readers:
+        cases += [('reader', name) for name in ['iterateData', 'iterateNetworkDataImpl', 'iterateNetworkDataParallel',
+                                                'iterateDataBatches', 'iterateNetworkDataBatches',
+                                                'iterateNetworkDataBatchesParallel', 'iterateNetworkStoreBatches']]
+    if detectors:
+        for path in ('rows', 'batches'):
+            cases += [('detector', ([name], path)) for name in detectorNames]
+            cases.append(('detector', (['IpPortScanDetector', 'ExplosionDetector', 'GrowthDetector',
+                                        'HostStabilizationDetector'], path)))
+    results = []
+    for kind, case in cases:
+        name = case if kind == 'reader' else "%s[%s]" % ('+'.join(case[0]) if len(case[0]) == 1
+                                                         else 'CompositeNetflowDetector', case[1])
+        parentConn, childConn = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=runCase, args=(kind, case, config, childConn))
+        process.start()
+        result = parentConn.recv()
+        process.join()
+        result['name'] = name
+        results.append(result)
+        if 'error' in result:
+            print("%-52s failed: %s" % (name, result['error']))
+        else:
+            print("%-52s %10.0f flows/s  %4i checks  %.4fs mean check  %8i KB peak" %
+                  (name, result['flows/sec'] or 0, result['checks'], result['check mean sec'] or 0,
+                   result['peak rss kb']))
+    report = {'seed': seed, 'site': siteConfig, 'results': results}
+    with open(outfile, 'w') as f:
+        json.dump(report, f, indent=1)
+    return report
+
+def compare(oldfile, newfile):
+    """ Print flows/sec and peak RSS of two benchmark() reports, case by case.
+    """
+    with open(oldfile) as f:
+        old = dict((r['name'], r) for r in json.load(f)['results'])
+    with open(newfile) as f:
+        new = json.load(f)['results']
+    for result in new:
+        before = old.get(result['name'])
+        if before is None or 'error' in before or 'error' in result:
+            continue
+        print("%-52s flows/s %10.0f -> %10.0f (%5.2fx)  peak %8i -> %8i KB" %
+              (result['name'], before['flows/sec'], result['flows/sec'],
+               result['flows/sec'] / before['flows/sec'], before['peak rss kb'], result['peak rss kb']))
@@ -0,0 +1,309 @@
+#
+# Copyright (c) 2018, Edgewise Networks Inc. All rights reserved.
+#
+
+import os
+import time
+import threading
+import numpy as np
+from HLL import HyperLogLog
+from OnlineDeviation import Stdev
+from IncrementalLeastSquares import ILS
+
+# Detector snapshots are flat dicts of NumPy arrays, saved as .npz. Each
+# detector's getState() builds one with the pack* helpers below, under
+# dotted name prefixes, and setState() reads it back with the unpack*
+# helpers. HLLs are stored as their raw sparse entries or registers, and
+# accumulators as one packed column per field.
+
+version = 1
+
+def packKeys(state, prefix, keys):
+    state[prefix + '.keys'] = np.array(list(keys), dtype=np.str_)
+
+def unpackKeys(state, prefix):
+    return state[prefix + '.keys'].tolist()
+
+def packScalars(state, prefix, **values):
+    for name, value in values.items():
+        state[prefix + '.' + name] = np.array(np.nan if value is None else value)
+
+def unpackScalar(state, prefix, name, kind=float):
+    value = state[prefix + '.' + name].item()
+    if kind is float and np.isnan(value):
+        return None
+    return kind(value)
+
+def packSketches(state, prefix, sketches):
+    """ A mapping of key -> HyperLogLog, all of one precision.
+    """
+    packKeys(state, prefix, sketches.keys())
+    lengths = []
+    sparse = []
+    dense = []
+    p = 16
+    for sketch in sketches.values():
+        p = sketch.p
+        raw = sketch.getRaw()
+        if sketch.isSparse():
+            lengths.append(len(raw))
+            sparse.append(raw)
+        else:
+            lengths.append(-1)
+            dense.append(raw)
+    state[prefix + '.p'] = np.array(p)
+    # number of sparse entries of each sketch, or -1 for dense registers
+    state[prefix + '.lengths'] = np.array(lengths, dtype=np.int64)
+    state[prefix + '.sparse'] = np.concatenate(sparse) if sparse else np.zeros(0, dtype=np.uint32)
+    state[prefix + '.dense'] = np.concatenate(dense) if dense else np.zeros(0, dtype=np.uint8)
+
+def unpackSketches(state, prefix, sketches):
+    """ Add the saved sketches to the mapping sketches, and return it.
+    """
+    p = int(state[prefix + '.p'])
+    m = 1 << p
+    sparse = state[prefix + '.sparse']
+    dense = state[prefix + '.dense']
+    s = d = 0
+    for key, length in zip(unpackKeys(state, prefix), state[prefix + '.lengths'].tolist()):
+        sketch = HyperLogLog(p)
+        if length < 0:
+            sketch.setRaw(dense[d:d + m])
+            d += m
+        else:
+            sketch.setRaw(sparse[s:s + length])
+            s += length
+        sketches[key] = sketch
+    return sketches
+
+def packSketch(state, prefix, sketch):
+    packSketches(state, prefix, {'': sketch})
+
+def unpackSketch(state, prefix):
+    return unpackSketches(state, prefix, {})['']
+
+def packFields(state, prefix, objects, fields):
+    """ A mapping of key -> accumulator, as one column per field.
+    """
+    packKeys(state, prefix, objects.keys())
+    for field in fields:
+        state[prefix + '.' + field] = np.array([getattr(obj, field) for obj in objects.values()],
+                                               dtype=np.float64)
+
+def unpackFields(state, prefix, objects, factory, fields, counts=('n', 'cnt')):
+    columns = [state[prefix + '.' + field].tolist() for field in fields]
+    for key, values in zip(unpackKeys(state, prefix), zip(*columns)):
+        obj = factory()
+        for field, value in zip(fields, values):
+            setattr(obj, field, int(value) if field in counts else value)
+        objects[key] = obj
+    return objects
+
+def packStdevs(state, prefix, stdevs):
+    packFields(state, prefix, stdevs, Stdev.__slots__)
+
+def unpackStdevs(state, prefix, stdevs):
+    return unpackFields(state, prefix, stdevs, Stdev, Stdev.__slots__)
+
+def packILSs(state, prefix, regressions):
+    packFields(state, prefix, regressions, ILS.__slots__)
+
+def unpackILSs(state, prefix, regressions):
+    return unpackFields(state, prefix, regressions, ILS, ILS.__slots__)
+
+def packWindows(state, prefix, windows):
+    """ A mapping of key -> SlopeWindow or AverageWindow, all of one maxlen:
+        each window's count, and its values oldest first.
+    """
+    packKeys(state, prefix, windows.keys())
+    maxlen = 1
+    values = []
+    for window in windows.values():
+        maxlen = window.maxlen
+        values.append(window.values() + [0] * (maxlen - len(window)))
+    state[prefix + '.cnt'] = np.array([window.cnt for window in windows.values()], dtype=np.int64)
+    state[prefix + '.values'] = np.array(values, dtype=np.float64).reshape(len(values), maxlen)
+
+def unpackWindows(state, prefix, windows, factory):
+    values = state[prefix + '.values'].tolist()
+    for key, cnt, row in zip(unpackKeys(state, prefix), state[prefix + '.cnt'].tolist(), values):
+        window = factory()
+        n = min(cnt, window.maxlen)
+        window.cnt = cnt - n
+        for value in row[:n]:
+            window.add(value)
+        windows[key] = window
+    return windows
+
+def packColumns(state, prefix, columnArray, names):
+    """ A StdevArray, ILSArray or WindowArray: the used part of each column.
+    """
+    for name in names:
+        state[prefix + '.' + name] = getattr(columnArray, name)[:len(columnArray)].copy()
+
+def unpackColumns(state, prefix, columnArray, names):
+    size = len(state[prefix + '.' + names[0]])
+    columnArray.resize(size)
+    for name in names:
+        getattr(columnArray, name)[:size] = state[prefix + '.' + name]
+    return columnArray
+
+def packValues(state, prefix, values):
+    """ A mapping of key -> number.
+    """
+    packKeys(state, prefix, values.keys())
+    state[prefix + '.values'] = np.array(list(values.values()), dtype=np.float64)
+
+def unpackValues(state, prefix, values):
+    values.update(zip(unpackKeys(state, prefix), state[prefix + '.values'].tolist()))
+    return values
+
+
+def save(detector, fname, compress=False):
+    """ Write detector.getState() to fname, atomically.
+    """
+    writeState(getSnapshot(detector), fname, compress)
+
+def getSnapshot(detector):
+    state = detector.getState()
+    state['checkpoint.class'] = np.array(type(detector).__name__)
+    state['checkpoint.version'] = np.array(version)
+    return state
+
+def writeState(state, fname, compress=False):
+    tmp = fname + '.tmp.npz'
+    if compress:
+        np.savez_compressed(tmp, **state)
+    else:
+        np.savez(tmp, **state)
+    os.replace(tmp, fname)
+
+def load(detector, fname):
+    """ Restore a detector, constructed with the same settings as the saved
+        one, from a checkpoint written by save(). Returns the detector.
+    """
+    with np.load(fname) as data:
+        state = dict(data.items())
+    saved = str(state.pop('checkpoint.class'))
+    if saved != type(detector).__name__:
+        raise Exception("checkpoint %s is of a %s, not a %s" % (fname, saved, type(detector).__name__))
+    if int(state.pop('checkpoint.version')) != version:
+        raise Exception("checkpoint %s has an unsupported version" % fname)
+    detector.setState(state)
+    return detector
+
+
+class Checkpointer(object):
+    """ Periodic background checkpoints of a detector.
+
+        watch() wraps the netflow (or batch) iterator a detector is fed from,
+        and every interval seconds of wall-clock time, between two items,
+        takes a snapshot of the detector's state. Snapshots are consistent,
+        since nothing is being added at that point. Writing the snapshot
+        happens in a background thread, and a checkpoint replaces the last
+        one only once it is completely written.
+    """
+    __slots__ = ('detector', 'fname', 'interval', 'compress', 'lastCheckpoint', 'writer')
+
+    def __init__(self, detector, fname, interval=300, compress=False):
+        self.detector = detector
+        self.fname = fname
+        self.interval = interval
+        self.compress = compress
+        self.lastCheckpoint = time.time()
+        self.writer = None
+
+    def watch(self, it):
+        for item in it:
+            yield item
+            if time.time() - self.lastCheckpoint >= self.interval:
+                self.checkpoint()
+
+    def checkpoint(self):
+        state = getSnapshot(self.detector)
+        self.wait()
+        self.writer = threading.Thread(target=writeState, args=(state, self.fname, self.compress), daemon=True)
+        self.writer.start()
+        self.lastCheckpoint = time.time()
+
+    def wait(self):
+        """ Wait for the checkpoint being written, if any.
+        """
+        if self.writer is not None:
+            self.writer.join()
+            self.writer = None
+
+
+def test():
+    import io
+    import tempfile
+    import contextlib
+    from Interning import ipTable
+    from DataIterator import parseNetflowBatch
+    from IpPortScanDetector import IpPortScanDetector
+    from ExplosionDetector import ExplosionDetector
+    from GrowthDetector import GrowthDetector
+    from HostStabilizationDetector import HostStabilizationDetector
+    from CompositeNetflowDetector import CompositeNetflowDetector
+    # 200 hosts with Pareto traffic and fan-outs, and a scanner sending 1% of the netflows
+    rng = np.random.default_rng(0)
+    n, numHosts = 10000, 200
+    weights = rng.pareto(1.2, numHosts) + 1
+    fanouts = np.minimum((rng.pareto(1.2, numHosts) + 1) * 5, 5000).astype(np.int64)
+    times = 1500000000000 + np.cumsum(rng.exponential(20.0, n)).astype(np.int64)
+    src = rng.choice(numHosts, n, p=weights / weights.sum())
+    dst = (src * 7919 + rng.integers(0, fanouts[src] + 1)) % 65536
+    ports = np.where(rng.random(n) < 0.7, 80, 1024 + dst % 1000)
+    scan = rng.random(n) < 0.01
+    src = np.where(scan, 250, src)
+    dst = np.where(scan, rng.integers(0, 65536, n), dst)
+    ports = np.where(scan, rng.integers(1, 65536, n), ports)
+    lines = ["%i\t10.1.0.%i\t5000\t10.200.%i.%i\t%i\t1" % row
+             for row in zip(times.tolist(), src.tolist(), (dst >> 8).tolist(), (dst & 255).tolist(), ports.tolist())]
+    batches = [parseNetflowBatch(lines[i:i + 500], ipTable) for i in range(0, n, 500)]
+    fname = os.path.join(tempfile.mkdtemp(), 'checkpoint.npz')
+    makers = [lambda: IpPortScanDetector(period=10, sigmaCount=2),
+              lambda: ExplosionDetector(period=10, sigmaCount=2, maxIdlePeriods=3),
+              lambda: ExplosionDetector(period=10, sigmaCount=2, windowPeriods=3),
+              lambda: GrowthDetector(period=10, sigmaCount=2, maxIdlePeriods=3),
+              lambda: GrowthDetector(period=10, sigmaCount=2, vectorized=True),
+              lambda: HostStabilizationDetector(period=5, tolerance=1),
+              lambda: HostStabilizationDetector(period=5, tolerance=1, vectorized=True),
+              lambda: HostStabilizationDetector(period=5, tolerance=1, vectorized=True, slopeWindow=4)]
+    def run(detector, batches):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            detector.addNetflowBatchIterator(iter(batches))
+        return out.getvalue().splitlines()
+    def sameState(a, b):
+        a, b = getSnapshot(a), getSnapshot(b)
+        # IpPortScanDetector.setState marks every host changed, to re-estimate them all
+        return sorted(a) == sorted(b) and all(np.array_equal(a[name], b[name], equal_nan=a[name].dtype.kind == 'f')
+                                              for name in a if not name.endswith('cardinalityDict.dirty'))
+    for make in makers:
+        # resuming from a checkpoint gives the output and state of an uninterrupted run
+        full = make()
+        expected = run(full, batches)
+        first = make()
+        lines = run(first, batches[:9])
+        save(first, fname)
+        resumed = load(make(), fname)
+        assert sameState(resumed, first)
+        lines += run(resumed, batches[9:])
+        assert lines == expected and len(expected) > 0, type(full).__name__
+        assert sameState(resumed, full)
+    composite = CompositeNetflowDetector()
+    for make in makers:
+        composite.addDetector(make())
+    checkpointer = Checkpointer(composite, fname, interval=0)
+    run(composite, checkpointer.watch(iter(batches[:5])))
+    checkpointer.wait()
+    restored = CompositeNetflowDetector()
+    for make in makers:
+        restored.addDetector(make())
+    assert sameState(load(restored, fname), composite)
+    try:
+        load(IpPortScanDetector(), fname)
+        assert False
+    except Exception as e:
+        assert 'CompositeNetflowDetector' in str(e)
@@ -2,6 +2,15 @@
 # Copyright (c) 2018, Edgewise Networks Inc. All rights reserved.
 #
 
+from time import perf_counter
+from heapq import heapify, heappush, heappop
+from NetflowDetector import firstDue
+
+# deadlines are scheduled this many seconds early, so float rounding in
+# lastTimestamp + period can never make the heap skip a check that
+# NetflowDetector.checkNetflow would have made.
+deadlineSlack = 1e-3
+
 class CompositeNetflowDetector(object):
     """ We want to find an IP address pair that's scanning a large number of
         ip address + port combinations. 
@@ -14,20 +23,55 @@ class CompositeNetflowDetector(object):
         IP address, and issue a warning when it's > 5 sigmas above 
         the expected number for all the HLLs.
     """
-    __slots__ = ('detectors')
+    __slots__ = ('detectors', 'featureSinks', 'deadlines', 'metrics')
 
     def __init__(self):
         self.detectors = []
+        self.featureSinks = []
+        # min-heap of (next check deadline, detector index)
+        self.deadlines = None
+        self.metrics = None
         
     def addDetector(self, detector):
         self.detectors.append(detector)
+        self.featureSinks.append(detector.addFlowFeatures)
+        self.deadlines = None
+        if self.metrics is not None:
+            self.setMetrics(self.metrics)
+    
+    def setMetrics(self, metrics):
+        """ setMetrics on every detector, labelled with its class name, and
+            its index too if there are several of the class. Each detector's
+            share of a sampled addNetflow is timed separately, to show which
+            one holds the pipeline up.
+        """
+        self.metrics = metrics
+        classNames = [type(detector).__name__ for detector in self.detectors]
+        for i, (detector, className) in enumerate(zip(self.detectors, classNames)):
+            if detector.metrics is None:
+                detector.setMetrics(metrics, className if classNames.count(className) == 1
+                                    else '%s.%i' % (className, i))
+    
+    def setAlertSink(self, alertSink):
+        for detector in self.detectors:
+            detector.setAlertSink(alertSink)
+    
+    def scheduleChecks(self):
+        self.deadlines = [(detector.lastTimestamp + detector.period - deadlineSlack, i)
+                          for i, detector in enumerate(self.detectors)
+                          if detector.lastTimestamp is not None]
+        heapify(self.deadlines)
         
     def addNetflowIterator(self, it):
+        if self.metrics is not None:
+            self.addNetflowIteratorMeasured(it)
+            return
         # first time
         netflow = next(it)
         self.addNetflow(netflow)
         for detector in self.detectors:
             detector.lastTimestamp = netflow.timestamp
+        self.scheduleChecks()
         # the remaining times
         while True:
             try: netflow = next(it)
@@ -36,11 +80,114 @@ class CompositeNetflowDetector(object):
             self.addNetflow(netflow)
             self.checkNetflow(netflow.timestamp)
         
-    def addNetflow(self, netflow):
+    def addNetflowIteratorMeasured(self, it):
+        """ addNetflowIterator, counting the netflows and timing every
+            detector's addFlowFeatures for one netflow in every
+            metrics.sampleEvery.
+        """
+        metrics = self.metrics
+        names = [detector.metricsName for detector in self.detectors]
+        histograms = [metrics.getHistogram('add_netflow_seconds', name) for name in names]
+        sampleEvery = metrics.sampleEvery
+        netflow = next(it)
+        self.addNetflow(netflow)
         for detector in self.detectors:
-            detector.addNetflow(netflow)
+            detector.lastTimestamp = netflow.timestamp
+        self.scheduleChecks()
+        count = 1
+        for netflow in it:
+            count += 1
+            if count < sampleEvery:
+                self.addNetflow(netflow)
+            else:
+                srcip = netflow.getSourceIpString()
+                dstHash = netflow.getDestinationHash()
+                for addFlowFeatures, histogram in zip(self.featureSinks, histograms):
+                    start = perf_counter()
+                    addFlowFeatures(srcip, dstHash)
+                    histogram.observe(perf_counter() - start)
+                for name in names:
+                    metrics.increment('netflows_total', name, count)
+                count = 0
+            self.checkNetflow(netflow.timestamp)
+        for name in names:
+            metrics.increment('netflows_total', name, count)
+        
+    def addNetflowBatchIterator(self, it):
+        """ Batches are split at the earliest check boundary of any detector,
+            so every detector checks exactly where it would one netflow at a time.
+        """
+        for batch in it:
+            if len(batch) == 0:
+                continue
+            timestamps = batch.timestamp
+            for detector in self.detectors:
+                if detector.lastTimestamp is None:
+                    detector.lastTimestamp = float(timestamps[0])
+                    self.deadlines = None
+            start = 0
+            while start < len(batch):
+                dues = [firstDue(timestamps[start:], detector.lastTimestamp, detector.period)
+                        for detector in self.detectors]
+                dues = [i for i in dues if i is not None]
+                if not dues:
+                    self.addNetflowBatch(batch.select(slice(start, None)))
+                    break
+                stop = start + min(dues) + 1
+                self.addNetflowBatch(batch.select(slice(start, stop)))
+                self.checkNetflow(float(timestamps[stop - 1]))
+                start = stop
+        
+    def addNetflow(self, netflow):
+        """ The source IP and destination hash are derived once and handed to every detector.
+        """
+        srcip = netflow.getSourceIpString()
+        dstHash = netflow.getDestinationHash()
+        for addFlowFeatures in self.featureSinks:
+            addFlowFeatures(srcip, dstHash)
+    
+    def addNetflowBatch(self, batch):
+        if self.metrics is None:
+            for detector in self.detectors:
+                detector.addNetflowBatch(batch)
+        else:
+            for detector in self.detectors:
+                detector.addNetflowBatchMeasured(batch)
     
     def checkNetflow(self, netflowTimestamp):
-        for detector in self.detectors:
+        """ O(1) per netflow unless a detector's deadline has passed.
+        """
+        deadlines = self.deadlines
+        if deadlines is None:
+            self.scheduleChecks()
+            deadlines = self.deadlines
+        if not deadlines or netflowTimestamp < deadlines[0][0]:
+            return
+        notYet = []
+        while deadlines and deadlines[0][0] <= netflowTimestamp:
+            deadline, i = heappop(deadlines)
+            detector = self.detectors[i]
+            lastTimestamp = detector.lastTimestamp
             detector.checkNetflow(netflowTimestamp)
-
+            if detector.lastTimestamp == lastTimestamp:
+                notYet.append((deadline, i))
+            else:
+                heappush(deadlines, (detector.lastTimestamp + detector.period - deadlineSlack, i))
+        for item in notYet:
+            heappush(deadlines, item)
+    
+    def getState(self):
+        """ Every detector's getState, with names prefixed by its index.
+        """
+        state = {}
+        for i, detector in enumerate(self.detectors):
+            for name, value in detector.getState().items():
+                state['%i.%s' % (i, name)] = value
+        return state
+    
+    def setState(self, state):
+        for i, detector in enumerate(self.detectors):
+            prefix = '%i.' % i
+            detector.setState(dict((name[len(prefix):], value) for name, value in state.items()
+                                   if name.startswith(prefix)))
+        self.deadlines = None
@@ -4,10 +4,16 @@
 
 import os, sys
 import gzip
-from itertools import repeat
-from Netflows import Netflow
+import heapq
+from operator import attrgetter
+from itertools import repeat, islice, chain
+import numpy as np
+from Netflows import Netflow, NetflowBatch, concatenateBatches
+from Interning import IpTable, ipTable as sharedIpTable
+from TimeIndex import TimeIndex, scanTextFile, inTimeRange, timeRangeMask
 from random import random, randint, sample
 import multiprocessing
+from queue import Empty
 from datetime import datetime
 
 def iterdir( dirname ):                                                                              
@@ -21,36 +27,212 @@ def iterdir( dirname ):
     except: 
         pass
 
-def iterNetflows(fname):                                                                                     
+def iterLines(f, rowRanges):
+    """ The lines of f in rowRanges, [(first row, end row)], or all of them.
+        Lines in between are skipped without being decoded.
+    """
+    if rowRanges is None:
+        return f
+    return chain.from_iterable(islice(f, first - last, end - last)
+                               for last, (first, end) in zip([0] + [end for first, end in rowRanges],
+                                                             rowRanges))
+
+def iterNetflows(fname, rowRanges=None):                                                                                     
     with gzip.open(fname, 'r') as f:                              
-        for x in f:
+        for x in iterLines(f, rowRanges):
             yield Netflow( *x.decode('utf8').strip().split('\t') )
 
 
-def iterateData(pathname, siteId):
+def iterNetflowBatches(fname, chunkSize=65536, ipTable=None, rowRanges=None):
+    """ Like iterNetflows, but yields NetflowBatch column chunks of up to chunkSize rows.
+    """
+    if ipTable is None:
+        ipTable = sharedIpTable
+    with gzip.open(fname, 'rt', encoding='utf8') as f:
+        lines = iterLines(f, rowRanges)
+        while True:
+            chunk = list(islice(lines, chunkSize))
+            if not chunk:
+                break
+            yield parseNetflowBatch(chunk, ipTable)
+
+def parsePorts(col):
+    """ A column of port strings as int32. Raises ValueError for ports outside
+        0..65535, which the int32 cast would otherwise wrap or overflow on.
+    """
+    try:
+        ports = np.array(col, dtype=np.int64)
+    except OverflowError:
+        raise ValueError("ports must be in 0..65535")
+    if len(ports) and (ports.min() < 0 or ports.max() > 0xffff):
+        raise ValueError("ports must be in 0..65535")
+    return ports.astype(np.int32)
+
+def parseNetflowBatch(lines, ipTable):
+    """ A NetflowBatch of tab-separated netflow lines. Raises ValueError if
+        any line has a bad number or port.
+    """
+    cols = list(zip(*(x.strip().split('\t') for x in lines)))
+    try:
+        flows = np.array(cols[5], dtype=np.int64)
+    except OverflowError:
+        raise ValueError("flow count out of range")
+    return NetflowBatch(np.array(cols[0], dtype=np.float64) / 1000.0,
+                        ipTable.internMany(cols[1]),
+                        parsePorts(cols[2]),
+                        ipTable.internMany(cols[3]),
+                        parsePorts(cols[4]),
+                        flows,
+                        ipTable)
+
+def defaultIndexName(dirname):
+    return dirname.rstrip(os.sep) + '.index.json'
+
+def iterSiteFiles(pathname, siteId, start=None, end=None):
+    """ Yields (file name, row ranges) for the site's .txt.gz files, in order.
+        Without time bounds, every file is read whole (row ranges None). With
+        them, the site's TimeIndex is brought up to date and only the blocks
+        that may hold timestamps in [start, end) are read.
+    """
     dirname = pathname % siteId
-    for fname in iterdir(dirname):
-        if fname.endswith(".txt.gz"):
-            for nf in iterNetflows(fname):
+    fnames = [fname for fname in iterdir(dirname) if fname.endswith(".txt.gz")]
+    if start is None and end is None:
+        for fname in fnames:
+            yield fname, None
+        return
+    index = TimeIndex(defaultIndexName(dirname))
+    for fname in fnames:
+        index.update(os.path.relpath(fname, dirname), fname, scanTextFile)
+    index.save()
+    for fname in fnames:
+        rowRanges = index.getRowRanges(os.path.relpath(fname, dirname), start, end)
+        if rowRanges:
+            yield fname, rowRanges
+
+def iterateData(pathname, siteId, start=None, end=None):
+    for fname, rowRanges in iterSiteFiles(pathname, siteId, start, end):
+        for nf in iterNetflows(fname, rowRanges):
+            if rowRanges is None or inTimeRange(nf.timestamp, start, end):
                 yield nf
 
-def iterateNetworkDataImpl(pathname, siteId, maxCount=None):
+def iterateNetworkDataImpl(pathname, siteId, maxCount=None, start=None, end=None):
+    netflows = iterateData(pathname, siteId, start, end)
+    return limitNetflows((nf for nf in netflows if nf.inNetwork()), maxCount)
+
+def iterateDataBatches(pathname, siteId, chunkSize=65536, start=None, end=None):
+    for fname, rowRanges in iterSiteFiles(pathname, siteId, start, end):
+        for batch in iterNetflowBatches(fname, chunkSize, rowRanges=rowRanges):
+            if rowRanges is not None:
+                batch = batch.select(timeRangeMask(batch.timestamp, start, end))
+            yield batch
+
+def iterateNetworkDataBatches(pathname, siteId, maxCount=None, chunkSize=65536, start=None, end=None):
+    """ Batch counterpart of iterateNetworkDataImpl: only in-network rows, at most maxCount of them.
+    """
+    return networkBatches(iterateDataBatches(pathname, siteId, chunkSize, start, end), maxCount)
+
+def networkBatches(batches, maxCount=None):
+    """ The in-network rows of batches, at most maxCount of them.
+    """
+    return limitNetflows((batch.select(batch.inNetwork()) for batch in batches), maxCount, batched=True)
+
+def limitNetflows(items, maxCount=None, batched=False):
+    """ The netflows in items (NetflowBatches, with batched), up to maxCount
+        of them. Then prints how many there were, saying "terminated" only if
+        netflows were left over, and not when there were exactly maxCount.
+    """
     cnt = 0
-    dirname = pathname % siteId
-    for fname in iterdir(dirname):
-        if fname.endswith(".txt.gz"):
-            for nf in iterNetflows(fname):
-                if maxCount is not None and cnt >= maxCount:
-                    print("iterated %i netflows - terminated" % cnt)
-                    raise StopIteration
-                if nf.inNetwork():
-                    cnt += 1
-                    yield nf
+    for item in items:
+        n = len(item) if batched else 1
+        if maxCount is not None and cnt + n > maxCount:
+            if cnt < maxCount:
+                item = item.select(slice(0, maxCount - cnt))
+                cnt = maxCount
+                yield item
+            print("iterated %i netflows - terminated" % cnt)
+            return
+        cnt += n
+        yield item
     print("iterated %i netflows - completed" % cnt)
 
-def iterateNetworkData(pathname, siteId, maxCount=None):
+def reorderNetflows(netflows, reorderWindow):
+    """ netflows sorted by timestamp, provided none arrives more than
+        reorderWindow seconds after a later one. Holds at most reorderWindow
+        seconds of netflows.
+    """
+    heap = []
+    seq = 0
+    for nf in netflows:
+        heapq.heappush(heap, (nf.timestamp, seq, nf))
+        seq += 1
+        while heap[0][0] <= nf.timestamp - reorderWindow:
+            yield heapq.heappop(heap)[2]
+    while heap:
+        yield heapq.heappop(heap)[2]
+
+def mergeNetflows(sources, reorderWindow=0):
+    """ k-way merge of Netflow iterators, each in timestamp order to within
+        reorderWindow seconds, into one timestamp-ordered stream.
+    """
+    if reorderWindow:
+        sources = [reorderNetflows(source, reorderWindow) for source in sources]
+    return heapq.merge(*sources, key=attrgetter('timestamp'))
+
+def mergeNetflowBatches(sources, reorderWindow=0):
+    """ k-way merge of NetflowBatch iterators into timestamp-ordered batches.
+
+        Each source is assumed to be in timestamp order to within
+        reorderWindow seconds, so once every source has produced a timestamp
+        of at least T, no later row can be earlier than T - reorderWindow:
+        the horizon. Every round reads one batch from the sources that bound
+        the horizon, and emits the rows up to it, sorted, as one batch. Rows
+        past the horizon wait in memory, which is bounded by the sources'
+        skew plus reorderWindow.
+    """
+    iterators = [iter(source) for source in sources]
+    # per source, the rows past the horizon, as runs sorted by timestamp: each
+    # batch is sorted once when read, and only ever split after that
+    pending = [[] for _ in iterators]
+    maxSeen = [float('-inf')] * len(iterators)
+    live = list(range(len(iterators)))
+    while live:
+        low = min(maxSeen[i] for i in live)
+        for i in [i for i in live if maxSeen[i] == low]:
+            batch = next(iterators[i], None)
+            if batch is None:
+                live.remove(i)
+            elif len(batch):
+                pending[i].append(batch.select(np.argsort(batch.timestamp, kind='stable')))
+                maxSeen[i] = max(maxSeen[i], float(batch.timestamp.max()))
+        horizon = min(maxSeen[i] for i in live) - reorderWindow if live else float('inf')
+        ready = []
+        for runs in pending:
+            for j, run in enumerate(runs):
+                split = np.searchsorted(run.timestamp, horizon, side='right')
+                if split:
+                    ready.append(run.select(slice(0, split)))
+                    runs[j] = run.select(slice(split, None))
+            runs[:] = [run for run in runs if len(run)]
+        if ready:
+            batch = concatenateBatches(ready)
+            yield batch.select(np.argsort(batch.timestamp, kind='stable'))
+
+def iterateNetworkDataMerged(pathname, siteIds, maxCount=None, reorderWindow=0, start=None, end=None):
+    """ In-network netflows of several sites (or collectors), merged into timestamp order.
+    """
+    sources = [iterateData(pathname, siteId, start, end) for siteId in siteIds]
+    return limitNetflows((nf for nf in mergeNetflows(sources, reorderWindow) if nf.inNetwork()), maxCount)
+
+def iterateNetworkDataBatchesMerged(pathname, siteIds, maxCount=None, chunkSize=65536, reorderWindow=0,
+                                    start=None, end=None):
+    """ Batch counterpart of iterateNetworkDataMerged.
+    """
+    sources = [iterateDataBatches(pathname, siteId, chunkSize, start, end) for siteId in siteIds]
+    return networkBatches(mergeNetflowBatches(sources, reorderWindow), maxCount)
+
+def iterateNetworkData(pathname, siteId, maxCount=None, start=None, end=None):
     startTime = datetime.now().timestamp()
-    it = iterateNetworkDataImpl(pathname, siteId, maxCount)
+    it = iterateNetworkDataImpl(pathname, siteId, maxCount, start, end)
     nf = next(it)
     offset = startTime - nf.timestamp
     nf.timestamp = startTime
@@ -60,25 +242,107 @@ def iterateNetworkData(pathname, siteId, maxCount=None):
         yield nf
         
 
-def processFile(fname):
-    print("start processFile:", fname)
-    return [nf for nf in iterNetflows(fname) if nf.inNetwork()]
+def decodeFiles(files, chunkSize, start, end, queue):
+    """ Worker process loop for iterParallelBatches: decodes each (file name,
+        row ranges) in turn into in-network column chunks, and puts them on
+        queue followed by an end-of-file marker. IPs are interned in a table
+        local to the worker, and each chunk carries the IPs first seen in it.
+    """
+    fname = None
+    try:
+        table = IpTable()
+        known = 0
+        for fname, rowRanges in files:
+            for batch in iterNetflowBatches(fname, chunkSize, table, rowRanges):
+                if rowRanges is not None:
+                    batch = batch.select(timeRangeMask(batch.timestamp, start, end))
+                batch = batch.select(batch.inNetwork())
+                if len(batch) == 0:
+                    continue
+                queue.put(('batch', table.keys[known:], batch.timestamp, batch.srcip, batch.srcport,
+                           batch.dstip, batch.dstport, batch.flows))
+                known = len(table.keys)
+            queue.put(('end',))
+    except Exception as e:
+        queue.put(('error', "%s: %r" % (fname, e)))
 
-def iterateNetworkDataParallel(pathname, siteId, maxCount=None):
-    cnt = 0
-    dirname = pathname % siteId
-    it = [fname for fname in iterdir(dirname) if fname.endswith(".txt.gz")]
-    numthreads = 8
-    # create the process pool
-    pool = multiprocessing.Pool(processes=numthreads)
-    for netflowList in pool.imap(processFile, it, 1):
-        if maxCount is not None and cnt >= maxCount:
-            pool.terminate()
-            break
-        cnt += len(netflowList)
-        for nf in netflowList:
-            yield nf
-    print("iterated %i netflows - completed" % cnt)
+def getFromWorker(queue, process, pollInterval=1.0):
+    """ The next message a decodeFiles worker puts on queue, waiting for as
+        long as the worker is alive.
+    """
+    while True:
+        try:
+            return queue.get(timeout=pollInterval)
+        except Empty:
+            if not process.is_alive():
+                break
+    # it may have put a last message just before it exited
+    try:
+        return queue.get(timeout=pollInterval)
+    except Empty:
+        raise Exception("decoding worker died with exit code %s" % process.exitcode)
+
+def iterParallelBatches(pathname, siteId, numWorkers=8, chunkSize=65536, queueSize=4,
+                        start=None, end=None):
+    """ In-network NetflowBatches of the site's files, in file order, decoded
+        by numWorkers processes. Files are dealt out round-robin, and each
+        worker has its own queue of at most queueSize chunks, so memory stays
+        bounded and the files can be read back in order. Chunks travel as
+        NumPy columns, which pickle as raw buffers. Workers are stopped as
+        soon as the caller stops iterating, and a worker that dies raises an
+        Exception here rather than leaving the caller waiting.
+    """
+    files = list(iterSiteFiles(pathname, siteId, start, end))
+    numWorkers = max(1, min(numWorkers, len(files)))
+    queues = []
+    processes = []
+    for i in range(numWorkers):
+        queue = multiprocessing.Queue(queueSize)
+        process = multiprocessing.Process(target=decodeFiles, daemon=True,
+                                          args=(files[i::numWorkers], chunkSize, start, end, queue))
+        process.start()
+        queues.append(queue)
+        processes.append(process)
+    # worker ip id -> ipTable id
+    translations = [np.zeros(0, dtype=np.int64) for _ in range(numWorkers)]
+    try:
+        for i in range(len(files)):
+            worker = i % numWorkers
+            queue = queues[worker]
+            while True:
+                msg = getFromWorker(queue, processes[worker])
+                if msg[0] == 'end':
+                    break
+                if msg[0] == 'error':
+                    raise Exception("decoding failed in %s" % msg[1])
+                newIps, ts, srcip, srcport, dstip, dstport, flows = msg[1:]
+                if newIps:
+                    translations[worker] = np.concatenate((translations[worker],
+                                                           sharedIpTable.internMany(newIps)))
+                translation = translations[worker]
+                yield NetflowBatch(ts, translation[srcip], srcport, translation[dstip], dstport,
+                                   flows, sharedIpTable)
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+
+def iterateNetworkDataParallel(pathname, siteId, maxCount=None, numWorkers=8, chunkSize=65536,
+                               queueSize=4, start=None, end=None):
+    batches = iterParallelBatches(pathname, siteId, numWorkers, chunkSize, queueSize, start, end)
+    try:
+        yield from limitNetflows((nf for batch in batches for nf in batch.iterNetflows()), maxCount)
+    finally:
+        # stops the workers as soon as the consumer does
+        batches.close()
+
+def iterateNetworkDataBatchesParallel(pathname, siteId, maxCount=None, numWorkers=8, chunkSize=65536,
+                                      queueSize=4, start=None, end=None):
+    """ Batch counterpart of iterateNetworkDataParallel.
+    """
+    batches = iterParallelBatches(pathname, siteId, numWorkers, chunkSize, queueSize, start, end)
+    return networkBatches(batches, maxCount)
     
 
 def iterateNetworkDataWithPortScanning(pathname, siteId, insertionFreq=0.01, maxCount=None):
@@ -101,3 +365,61 @@ def iterateNetworkDataWithPortScanning(pathname, siteId, insertionFreq=0.01, max
             flowCount = randint(1, 100)
             scanFlow = Netflow(ts, portScanner, srcport, dstip, dstport, flowCount)
             yield scanFlow
+
+
+def test():
+    import io
+    import tempfile
+    import contextlib
+    import queue
+    from Benchmark import generateSite
+    dirname = tempfile.mkdtemp()
+    generateSite(os.path.join(dirname, 'site0'), numHosts=100, numFiles=3, rowsPerFile=3000)
+    pathname = os.path.join(dirname, 'site%s')
+    rows = [repr(nf) for nf in iterateNetworkDataImpl(pathname, 0)]
+    batches = list(iterateNetworkDataBatches(pathname, 0, chunkSize=1000))
+    assert [repr(nf) for batch in batches for nf in batch.iterNetflows()] == rows
+    parallel = list(iterateNetworkDataBatchesParallel(pathname, 0, numWorkers=2, chunkSize=1000))
+    assert [repr(nf) for batch in parallel for nf in batch.iterNetflows()] == rows
+    assert [repr(nf) for nf in iterateNetworkDataParallel(pathname, 0, numWorkers=2)] == rows
+    assert len(list(iterateNetworkDataParallel(pathname, 0, maxCount=100, numWorkers=2))) == 100
+    # every reader stops at maxCount, and only says it was cut off when it was
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        for maxCount in (len(rows) - 1, len(rows)):
+            assert len(list(iterateNetworkDataImpl(pathname, 0, maxCount))) == maxCount
+            assert sum(map(len, iterateNetworkDataBatches(pathname, 0, maxCount, chunkSize=1000))) == maxCount
+            assert len(list(iterateNetworkDataMerged(pathname, [0], maxCount))) == maxCount
+            assert len(list(iterateNetworkDataParallel(pathname, 0, maxCount, numWorkers=2))) == maxCount
+    assert out.getvalue().splitlines() == ["iterated %i netflows - terminated" % (len(rows) - 1)] * 4 + \
+        ["iterated %i netflows - completed" % len(rows)] * 4
+    # a worker's errors, and its death, reach the reader
+    q = queue.Queue()
+    decodeFiles([(os.path.join(dirname, 'missing.txt.gz'), None)], 1000, None, None, q)
+    msg = q.get_nowait()
+    assert msg[0] == 'error' and 'missing.txt.gz' in msg[1]
+    process = multiprocessing.Process(target=os._exit, args=(3,))
+    process.start()
+    try:
+        getFromWorker(multiprocessing.Queue(), process, pollInterval=0.05)
+        assert False
+    except Exception as e:
+        assert 'exit code 3' in str(e)
+    process.join()
+    # merging out-of-order, skewed sources gives every row once, in order
+    rand = np.random.default_rng(1)
+    table = IpTable()
+    ips = table.internMany(['10.0.0.%i' % i for i in range(8)])
+    def source(offset, count, size):
+        ts = np.sort(rand.uniform(0, 1000, count)) + offset
+        # no row arrives more than 5 seconds after a later one
+        ts = ts[np.argsort(ts + rand.uniform(0, 5, count), kind='stable')]
+        for i in range(0, count, size):
+            n = len(ts[i:i + size])
+            yield NetflowBatch(ts[i:i + size], rand.choice(ips, n), np.full(n, 1024), rand.choice(ips, n),
+                               rand.integers(1, 65536, n), np.ones(n, dtype=np.int64), table)
+    sources = [list(source(0, 5000, 100)), list(source(50, 3000, 1000)), list(source(-20, 200, 7)), []]
+    merged = list(mergeNetflowBatches(sources, reorderWindow=5))
+    ts = np.concatenate([batch.timestamp for batch in merged])
+    assert np.all(ts[1:] >= ts[:-1])
+    assert np.array_equal(np.sort(ts), np.sort(np.concatenate([b.timestamp for s in sources for b in s])))
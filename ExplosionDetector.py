@@ -11,6 +11,9 @@ from math import sqrt
 from OnlineDeviation import Stdev
 from Netflows import Netflow
 from HLL import HyperLogLog
+from SketchStore import SketchStore
+from TopK import TopK
+from Checkpoint import packScalars, unpackScalar
 from NetflowDetector import NetflowDetector, timestampToDatetime
 from heapq import heappush, heappop, heappushpop
 
@@ -27,21 +30,37 @@ class ExplosionDetector(NetflowDetector):
         combinations we see.) We regularly check the cardinality for each
         IP address, and issue a warning when it's > 5 sigmas above 
         the expected number for all the HLLs.
+        
+        Hosts with no netflows for maxIdlePeriods periods in a row are dropped
+        from shortCardDict, and stop counting towards the mean and stdev.
+        
+        With windowPeriods, the short-term count of a host covers its last
+        windowPeriods periods, sliding by one period at each check, so a burst
+        that straddles a check is not split in two.
     """
-    __slots__ = ('shortCardDict', 'totalCount', 'topN')
+    __slots__ = ('shortCardDict', 'totalCount', 'topN', 'topCards')
+    alertDescription = "an outlier for explosion scanning"
 
-    def __init__(self, sigmaCount=5, period=86400, topN=10):
+    def __init__(self, sigmaCount=5, period=86400, topN=10, maxIdlePeriods=None, windowPeriods=None):
         super().__init__(sigmaCount, period=period)
         self.topN = topN
-        self.shortCardDict = defaultdict(lambda: HyperLogLog(16))
+        # largest cardinalities, kept up to date as netflows arrive. Window
+        # counts also go down, which TopK does not follow, and cost a merge
+        # of the whole window to read, so windows find theirs at each check.
+        self.topCards = TopK(topN) if windowPeriods is None else None
+        self.shortCardDict = SketchStore(16, maxIdlePeriods, windowPeriods=windowPeriods)
         self.totalCount = 0
     
-    def addNetflow(self, netflow):
-        srcip = netflow.getSourceIpString()
-        dst = netflow.getDestinationString()
-        self.shortCardDict[ srcip ].add( dst )
+    def addFlowFeatures(self, srcip, dst):
+        if self.shortCardDict.add_hash( srcip, dst ) and self.topCards is not None:
+            self.topCards.update( srcip, self.shortCardDict[ srcip ].cardinality() )
         self.totalCount += 1
     
+    def addFlowFeatureGroup(self, srcip, dstHashes):
+        if self.shortCardDict.add_hashes( srcip, dstHashes ) and self.topCards is not None:
+            self.topCards.update( srcip, self.shortCardDict[ srcip ].cardinality() )
+        self.totalCount += len(dstHashes)
+    
     def getOutliersAll(self):
         """ must return a dict of (key, sigmas > sigmaCount)
         """
@@ -52,16 +71,20 @@ class ExplosionDetector(NetflowDetector):
             s.add(cnt)
         mean = s.getMean()
         stdv = s.getStdev()
-        for key, hll in self.cardinalityDict.items():
+        for key, hll in self.shortCardDict.items():
             cnt = hll.cardinality()
             if cnt > mean + self.sigmaCount * stdv:
                 sigs = (cnt - mean) / stdv
                 outliers[key] = sigs
-        # empty short-term HLLs
-        for key in self.shortCardDict.keys():
-            self.shortCardDict[key] = HyperLogLog(16)
+        # empty (or slide) the short-term HLLs
+        self.shortCardDict.reset()
+        if self.topCards is not None:
+            self.topCards.clear()
         return outliers
     
+    def getSketchDicts(self):
+        return [self.shortCardDict]
+    
     def logOutput(self, key, result):
         """ key: an item being tracked
             result: bool -- True if starting above sigmaCount, False if ending above it.
@@ -75,29 +98,67 @@ class ExplosionDetector(NetflowDetector):
     def getOutliers(self):
         """ must return a dict of (key, sigmas > sigmaCount)
         """
+        partial = self.getPartialOutliers(self.timePeriodMap.getActives())
+        return self.combinePartialOutliers([partial])
+    
+    def getPartialOutliers(self, activeKeys):
+        """ returns (Stdev of all short-term cardinalities, top N
+            (cardinality, key) pairs, dict of (active key, cardinality)), and empties
+            the short-term HLLs.
+        """
+        # only hosts with netflows this period (or window) have non-zero counts
+        counts = [(self.shortCardDict[key].cardinality(), key) for key in self.shortCardDict.getRecent()]
+        s = Stdev()
+        s.add_many([cnt for cnt, key in counts])
+        idle = Stdev()
+        idle.n = len(self.shortCardDict) - len(counts)
+        s.merge(idle)
+        if self.topCards is not None and not self.topCards.stale:
+            h = self.topCards.largest()
+        else:
+            h = heapq.nlargest(self.topN, counts)
+        actives = {}
+        for key in activeKeys:
+            if key in self.shortCardDict:
+                actives[key] = self.shortCardDict[key].cardinality()
+        # empty (or slide) the short-term HLLs
+        self.shortCardDict.reset()
+        if self.topCards is not None:
+            self.topCards.clear()
+        return s, h, actives
+    
+    def combinePartialOutliers(self, partials):
         outliers = {}
         s = Stdev()
-        h = []
-        topN = self.topN
-        for key, hll in self.shortCardDict.items():
-            shortCount = hll.cardinality()  
-            s.add(shortCount)
-            if len(h) < topN:
-                heapq.heappush( h, (shortCount, key) )
-            else:
-                heapq.heappushpop( h, (shortCount, key) )
+        candidates = []
+        actives = {}
+        for partialStdev, h, partialActives in partials:
+            s.merge(partialStdev)
+            candidates.extend(h)
+            actives.update(partialActives)
         mean = s.getMean()
         stdv = s.getStdev()
-        for cnt, key in h:
+        for cnt, key in heapq.nlargest(self.topN, candidates):
             if cnt > mean + self.sigmaCount * stdv:
                 sigs = (cnt - mean) / stdv
                 outliers[key] = sigs
-        for key in self.timePeriodMap.getActives():
-            cnt = hll.cardinality()
+        for key, cnt in actives.items():
             if cnt > mean + self.sigmaCount * stdv:
                 sigs = (cnt - mean) / stdv
                 outliers[key] = sigs
-        # empty short-term HLLs
-        for key in self.shortCardDict.keys():
-            self.shortCardDict[key] = HyperLogLog(16)
         return outliers
+    
+    def getState(self):
+        state = super().getState()
+        self.shortCardDict.getState(state, 'shortCardDict')
+        packScalars(state, 'detector', totalCount=self.totalCount)
+        return state
+    
+    def setState(self, state):
+        super().setState(state)
+        self.shortCardDict.setState(state, 'shortCardDict')
+        self.totalCount = unpackScalar(state, 'detector', 'totalCount', int)
+        if self.topCards is not None:
+            self.topCards.clear()
+            for key in self.shortCardDict.dirty:
+                self.topCards.update(key, self.shortCardDict[key].cardinality())
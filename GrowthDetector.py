@@ -7,9 +7,15 @@ from collections import defaultdict
 import heapq
 from datetime import datetime
 from math import sqrt
-from OnlineDeviation import Stdev
+import numpy as np
+from functools import partial
+from OnlineDeviation import Stdev, StdevArray, EWStdev, EWStdevArray
+from Interning import InternTable
 from Netflows import Netflow
 from HLL import HyperLogLog
+from SketchStore import SketchStore
+from Checkpoint import packKeys, unpackKeys, packFields, unpackFields, packColumns, unpackColumns, \
+                       packScalars, unpackScalar
 from NetflowDetector import NetflowDetector, timestampToDatetime
 from heapq import heappush, heappop, heappushpop
 
@@ -26,22 +32,65 @@ class GrowthDetector(NetflowDetector):
         combinations we see.) We regularly check the cardinality for each
         IP address, and issue a warning when it's > 5 sigmas above 
         the expected number for all the HLLs.
+        
+        With vectorized=True, each host's history lives in a row of a
+        StdevArray instead of a Stdev in stdevDict, and the sigma test and
+        the history update run as whole-array operations.
+        
+        Hosts with no netflows for maxIdlePeriods periods in a row are dropped
+        from shortCardDict, and their history stops receiving zeros until
+        they come back.
+        
+        With windowPeriods, the short-term count of a host covers its last
+        windowPeriods periods, sliding by one period at each check, instead
+        of only the period since the last check.
+        
+        With halfLife, each host's history is an exponentially weighted
+        EWStdev (or EWStdevArray), in which a period's weight halves every
+        halfLife periods, so baselines follow a host's recent behaviour
+        instead of all of its history.
     """
-    __slots__ = ('shortCardDict', 'stdevDict', 'totalCount', 'topN')
+    __slots__ = ('shortCardDict', 'stdevDict', 'totalCount', 'topN', 'hostRows', 'stdevArray', 'halfLife')
+    alertDescription = "an outlier for growth scanning"
 
-    def __init__(self, sigmaCount=5, period=3600, topN=10):
+    def __init__(self, sigmaCount=5, period=3600, topN=10, vectorized=False, maxIdlePeriods=None,
+                 windowPeriods=None, halfLife=None):
         super().__init__(sigmaCount, period=period)
         self.topN = topN
-        self.shortCardDict = defaultdict(lambda: HyperLogLog(16))
-        self.stdevDict = defaultdict(Stdev)
+        self.shortCardDict = SketchStore(16, maxIdlePeriods, windowPeriods=windowPeriods)
         self.totalCount = 0
+        self.halfLife = halfLife
+        if vectorized:
+            self.stdevDict = None
+            self.hostRows = InternTable()
+            self.stdevArray = self.newStdevArray()
+        else:
+            self.stdevDict = defaultdict(self.getStdevFactory())
+            self.hostRows = None
+            self.stdevArray = None
     
-    def addNetflow(self, netflow):
-        srcip = netflow.getSourceIpString()
-        dst = netflow.getDestinationString()
-        self.shortCardDict[ srcip ].add( dst )
+    def getStdevFactory(self):
+        return Stdev if self.halfLife is None else partial(EWStdev, self.halfLife)
+    
+    def getStdevFields(self):
+        """ The fields of a history to checkpoint.
+        """
+        return (Stdev if self.halfLife is None else EWStdev).__slots__[:3]
+    
+    def newStdevArray(self):
+        return StdevArray() if self.halfLife is None else EWStdevArray(halfLife=self.halfLife)
+    
+    def addFlowFeatures(self, srcip, dst):
+        self.shortCardDict.add_hash( srcip, dst )
         self.totalCount += 1
     
+    def addFlowFeatureGroup(self, srcip, dstHashes):
+        self.shortCardDict.add_hashes( srcip, dstHashes )
+        self.totalCount += len(dstHashes)
+    
+    def getSketchDicts(self):
+        return [self.shortCardDict]
+    
     def logOutput(self, key, result):
         """ key: an item being tracked
             result: bool -- True if starting above sigmaCount, False if ending above it.
@@ -55,6 +104,8 @@ class GrowthDetector(NetflowDetector):
     def getOutliers(self):
         """ must return a dict of (key, sigmas > sigmaCount)
         """
+        if self.stdevArray is not None:
+            return self.getOutliersVectorized()
         outliers = {}
         topN = self.topN
         for key, hll in self.shortCardDict.items():
@@ -66,10 +117,93 @@ class GrowthDetector(NetflowDetector):
                 outliers[key] = sigs
             # update stdevDict, while we've got the information to do so.
             self.stdevDict[key].add(shortCount)
-        # empty short-term HLLs
-        for key in self.shortCardDict.keys():
-            self.shortCardDict[key] = HyperLogLog(16)
+        # empty (or slide) the short-term HLLs
+        self.shortCardDict.reset()
+        return outliers
+
+    def getOutliersVectorized(self):
+        keys = list(self.shortCardDict.keys())
+        rows = self.hostRows.internMany(keys)
+        self.stdevArray.resize(len(self.hostRows))
+        # only hosts with netflows this period (or window) have non-zero counts
+        active = list(self.shortCardDict.getRecent())
+        counts = np.zeros(len(self.hostRows))
+        counts[self.hostRows.internMany(active)] = [self.shortCardDict[key].cardinality() for key in active]
+        shortCounts = counts[rows]
+        prevMeans = self.stdevArray.getMean(rows)
+        prevStdevs = self.stdevArray.getStdev(rows)
+        extreme = np.flatnonzero(shortCounts >= prevMeans + prevStdevs * self.sigmaCount)
+        sigs = (shortCounts[extreme] - prevMeans[extreme]) / prevStdevs[extreme]
+        outliers = dict(zip([keys[i] for i in extreme], sigs.tolist()))
+        self.stdevArray.add(rows, shortCounts)
+        # empty (or slide) the short-term HLLs
+        self.shortCardDict.reset()
         return outliers
 
     def getMeansAndStdDevs(self):
+        if self.stdevArray is not None:
+            return list(zip(self.stdevArray.getMean().tolist(), self.stdevArray.getStdev().tolist()))
         return [(stdev.getMean(), stdev.getStdev()) for stdev in self.stdevDict.values()]
+
+    def getState(self):
+        state = super().getState()
+        self.shortCardDict.getState(state, 'shortCardDict')
+        packScalars(state, 'detector', totalCount=self.totalCount)
+        if self.stdevArray is not None:
+            packKeys(state, 'hostRows', self.hostRows.keys)
+            packColumns(state, 'stdevArray', self.stdevArray, type(self.stdevArray).__slots__[:3])
+        else:
+            packFields(state, 'stdevDict', self.stdevDict, self.getStdevFields())
+        return state
+
+    def setState(self, state):
+        super().setState(state)
+        self.shortCardDict.setState(state, 'shortCardDict')
+        self.totalCount = unpackScalar(state, 'detector', 'totalCount', int)
+        if self.stdevArray is not None:
+            self.hostRows = InternTable()
+            self.hostRows.internMany(unpackKeys(state, 'hostRows'))
+            stdevArray = self.newStdevArray()
+            self.stdevArray = unpackColumns(state, 'stdevArray', stdevArray, type(stdevArray).__slots__[:3])
+        else:
+            factory = self.getStdevFactory()
+            self.stdevDict = unpackFields(state, 'stdevDict', defaultdict(factory), factory,
+                                          self.getStdevFields())
+
+
+def test():
+    import io
+    import tempfile
+    import contextlib
+    from Benchmark import generateSite
+    from DataIterator import iterateNetworkDataBatches
+    from Checkpoint import getSnapshot
+    dirname = tempfile.mkdtemp()
+    generateSite(dirname + '/site0', numHosts=200, numFiles=2, rowsPerFile=5000, scanRate=0.01)
+    with contextlib.redirect_stdout(io.StringIO()):
+        batches = list(iterateNetworkDataBatches(dirname + '/site%s', 0, chunkSize=500))
+    def run(detector, batches):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            detector.addNetflowBatchIterator(iter(batches))
+        return out.getvalue().splitlines()
+    plain = run(GrowthDetector(period=10, sigmaCount=2), batches)
+    # a half-life far longer than the run weighs every period the same
+    assert run(GrowthDetector(period=10, sigmaCount=2, halfLife=1e12), batches) == plain
+    expected = run(GrowthDetector(period=10, sigmaCount=2, halfLife=3), batches)
+    assert expected and expected != plain
+    for vectorized in (False, True):
+        # both modes agree, and resume from getState()
+        full = GrowthDetector(period=10, sigmaCount=2, halfLife=3, vectorized=vectorized)
+        assert run(full, batches) == expected
+        first = GrowthDetector(period=10, sigmaCount=2, halfLife=3, vectorized=vectorized)
+        lines = run(first, batches[:9])
+        resumed = GrowthDetector(period=10, sigmaCount=2, halfLife=3, vectorized=vectorized)
+        resumed.setState(getSnapshot(first))
+        assert run(resumed, batches[9:]) == expected[len(lines):]
+        assert np.allclose(sorted(resumed.getMeansAndStdDevs()), sorted(full.getMeansAndStdDevs()), equal_nan=True)
+    # the baseline follows a host whose level changes
+    detector = GrowthDetector(halfLife=2)
+    for count in [10] * 20 + [100] * 10:
+        detector.stdevDict['10.0.0.1'].add(count)
+    assert detector.stdevDict['10.0.0.1'].getMean() > 95
@@ -0,0 +1,423 @@
+#
+# Copyright (c) 2018, Edgewise Networks Inc. All rights reserved.
+#
+
+import sys
+from array import array
+from bisect import bisect_left
+from hashlib import blake2b
+from math import log
+import numpy as np
+
+def hash64(item):
+    """ Stable 64-bit hash of a str or bytes item. Unlike hash(), this is the
+        same in every process, so sketches can be merged and persisted.
+    """
+    if isinstance(item, str):
+        item = item.encode('utf8')
+    return int.from_bytes(blake2b(item, digest_size=8).digest(), 'little')
+
+def hashMany(items):
+    """ hash64 over a sequence of items, as a uint64 array.
+    """
+    return np.fromiter((hash64(x) for x in items), dtype=np.uint64, count=len(items))
+
+def bitLengths(values):
+    """ Vectorized int.bit_length() for a uint64 array.
+    """
+    v = values.copy()
+    n = np.zeros(v.shape, dtype=np.uint8)
+    for shift in (32, 16, 8, 4, 2, 1):
+        big = v >= np.uint64(1 << shift)
+        n[big] += shift
+        v[big] >>= np.uint64(shift)
+    n += (v > 0)
+    return n
+
+twoTo64 = float(1 << 64)
+
+def scaledSum(rankCounts):
+    """ 2**64 * sum(2**-rank), exactly, from a count of registers per rank value.
+    """
+    return sum(int(c) << (64 - rank) for rank, c in enumerate(rankCounts.tolist()) if c)
+
+def maxRankEntries(entries):
+    """ Sorted (index << 6 | rank) entries, keeping only the highest rank per index.
+    """
+    entries = np.sort(entries)
+    indices = entries >> 6
+    # entries sort by index, then rank, so the last one per index is the max
+    last = np.ones(len(entries), dtype=bool)
+    last[:-1] = indices[1:] != indices[:-1]
+    return entries[last]
+
+def alpha(m):
+    if m == 16:
+        return 0.673
+    elif m == 32:
+        return 0.697
+    elif m == 64:
+        return 0.709
+    return 0.7213 / (1 + 1.079 / m)
+
+
+class HyperLogLog(object):
+    """ HyperLogLog cardinality sketch with 2**p one-byte registers.
+
+        A new sketch starts sparse: the non-zero registers are kept as a sorted
+        array of (index << 6 | rank) uint32 entries, which costs a few bytes
+        per distinct register instead of 2**p bytes. Once more than
+        sparseMax registers are set, it switches to dense registers.
+
+        Dense registers live in a bytearray, so single adds are cheap and the
+        vectorized paths (add_many, merge) can work on a zero-copy NumPy view
+        of the same memory.
+
+        The harmonic sum of the registers and the number of zero registers
+        are kept up to date as registers change, so cardinality() is O(1).
+        The sum is an exact integer, scaled by 2**64, so it does not drift
+        and does not depend on the order of adds.
+    """
+    __slots__ = ('p', 'm', 'registers', 'sparse', 'sparseMax', 'scaledSum', 'zeros')
+
+    def __init__(self, p=16, sparse=True):
+        if not 4 <= p <= 18:
+            raise Exception("p must be between 4 and 18, got %s" % p)
+        self.p = p
+        self.m = 1 << p
+        # past m/16 entries the sparse list is a quarter the size of the
+        # dense registers, and inserts start to cost more than they save.
+        self.sparseMax = self.m // 16
+        if sparse:
+            self.registers = None
+            self.sparse = array('I')
+        else:
+            self.registers = bytearray(self.m)
+            self.sparse = None
+        self.scaledSum = self.m << 64
+        self.zeros = self.m
+
+    def __sizeof__(self):
+        if self.sparse is not None:
+            return object.__sizeof__(self) + sys.getsizeof(self.sparse)
+        return object.__sizeof__(self) + sys.getsizeof(self.registers)
+
+    def size(self):
+        return self.m
+
+    def isSparse(self):
+        return self.sparse is not None
+
+    def isEmpty(self):
+        return self.zeros == self.m
+
+    def getRegisters(self):
+        """ Dense register values. A view on the sketch when dense, a copy when sparse.
+        """
+        if self.sparse is not None:
+            regs = np.zeros(self.m, dtype=np.uint8)
+            entries = np.frombuffer(self.sparse, dtype=np.uint32)
+            regs[entries >> 6] = entries & 63
+            return regs
+        return np.frombuffer(self.registers, dtype=np.uint8)
+
+    def getRaw(self):
+        """ The sketch's own storage, for checkpoints: the sorted uint32
+            entries when sparse, the uint8 registers when dense. Not a copy.
+        """
+        if self.sparse is not None:
+            return np.frombuffer(self.sparse, dtype=np.uint32)
+        return np.frombuffer(self.registers, dtype=np.uint8)
+
+    def setRaw(self, raw):
+        """ Restore a sketch saved with getRaw().
+        """
+        if raw.dtype == np.uint32:
+            self.sparse = array('I', raw.tobytes())
+            self.registers = None
+            self.recount(raw & 63)
+        else:
+            if len(raw) != self.m:
+                raise Exception("expected %i registers, got %i" % (self.m, len(raw)))
+            self.registers = bytearray(raw.tobytes())
+            self.sparse = None
+            self.recount(raw)
+
+    def toDense(self):
+        if self.sparse is not None:
+            self.registers = bytearray(self.getRegisters().tobytes())
+            self.sparse = None
+
+    def recount(self, ranks):
+        """ Recompute scaledSum and zeros from the non-zero register values.
+        """
+        counts = np.bincount(ranks, minlength=65)
+        counts[0] = self.m - counts[1:].sum()
+        self.zeros = int(counts[0])
+        self.scaledSum = scaledSum(counts)
+
+    def add(self, item):
+        """ Returns True if a register changed.
+        """
+        return self.add_hash(hash64(item))
+
+    def add_hash(self, h):
+        q = 64 - self.p
+        idx = h >> q
+        rank = q - (h & ((1 << q) - 1)).bit_length() + 1
+        sparse = self.sparse
+        if sparse is None:
+            old = self.registers[idx]
+            if rank > old:
+                self.registers[idx] = rank
+                self.scaledSum += (1 << (64 - rank)) - (1 << (64 - old))
+                if old == 0:
+                    self.zeros -= 1
+                return True
+            return False
+        key = idx << 6
+        i = bisect_left(sparse, key)
+        if i < len(sparse) and sparse[i] >> 6 == idx:
+            old = sparse[i] & 63
+            if rank > old:
+                sparse[i] = key | rank
+                self.scaledSum += (1 << (64 - rank)) - (1 << (64 - old))
+                return True
+            return False
+        sparse.insert(i, key | rank)
+        self.scaledSum += (1 << (64 - rank)) - (1 << 64)
+        self.zeros -= 1
+        if len(sparse) > self.sparseMax:
+            self.toDense()
+        return True
+
+    def add_many(self, items):
+        """ Hash and add a batch of items in one pass. Returns True if a register changed.
+        """
+        return self.add_hashes(hashMany(items))
+
+    def add_hashes(self, hashes):
+        """ Add a uint64 array of precomputed hash64 values. Returns True if a register changed.
+        """
+        if len(hashes) == 0:
+            return False
+        q = 64 - self.p
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        idx = (hashes >> np.uint64(q)).astype(np.uint32)
+        rank = (q + 1) - bitLengths(hashes & np.uint64((1 << q) - 1))
+        entries = maxRankEntries((idx << 6) | rank)
+        if self.sparse is not None:
+            return self.mergeSparse(entries)
+        regs = np.frombuffer(self.registers, dtype=np.uint8)
+        idx = entries >> 6
+        rank = (entries & 63).astype(np.uint8)
+        old = regs[idx]
+        raised = rank > old
+        if not raised.any():
+            return False
+        regs[idx[raised]] = rank[raised]
+        newCounts = np.bincount(rank[raised], minlength=65)
+        oldCounts = np.bincount(old[raised], minlength=65)
+        self.scaledSum += scaledSum(newCounts) - scaledSum(oldCounts)
+        self.zeros -= int(oldCounts[0])
+        return True
+
+    def mergeSparse(self, entries):
+        """ Fold (index << 6 | rank) entries into the sparse list, going dense if
+            it gets too long. Returns True if a register changed.
+        """
+        before = self.sparse
+        combined = maxRankEntries(np.concatenate((np.frombuffer(before, dtype=np.uint32),
+                                                  entries.astype(np.uint32))))
+        if len(combined) == len(before) and (combined == np.frombuffer(before, dtype=np.uint32)).all():
+            return False
+        self.recount(combined & 63)
+        if len(combined) > self.sparseMax:
+            self.sparse = None
+            self.registers = bytearray(self.m)
+            regs = np.frombuffer(self.registers, dtype=np.uint8)
+            regs[combined >> 6] = combined & 63
+        else:
+            self.sparse = array('I', combined.tobytes())
+        return True
+
+    def cardinality(self):
+        return self.estimate(self.scaledSum / twoTo64, self.zeros)
+
+    def estimate(self, total, zeros):
+        """ Cardinality from the harmonic register sum and the number of zero registers.
+        """
+        m = self.m
+        e = alpha(m) * m * m / total
+        if e <= 2.5 * m and zeros > 0:
+            return m * log(m / zeros)
+        return e
+
+    def merge(self, other):
+        """ Register-wise max of other into this sketch.
+        """
+        if self.p != other.p:
+            raise Exception("cannot merge HyperLogLogs with p=%i and p=%i" % (self.p, other.p))
+        if self.sparse is not None and other.sparse is not None:
+            self.mergeSparse(np.frombuffer(other.sparse, dtype=np.uint32))
+            return
+        self.toDense()
+        regs = np.frombuffer(self.registers, dtype=np.uint8)
+        np.maximum(regs, other.getRegisters(), out=regs)
+        self.recount(regs)
+
+    def union(self, other):
+        result = self.copy()
+        result.merge(other)
+        return result
+
+    __or__ = union
+
+    def copy(self):
+        result = HyperLogLog(self.p)
+        if self.sparse is not None:
+            result.sparse = array('I', self.sparse)
+        else:
+            result.sparse = None
+            result.registers = bytearray(self.registers)
+        result.scaledSum = self.scaledSum
+        result.zeros = self.zeros
+        return result
+
+    def clear(self):
+        if self.sparse is not None:
+            del self.sparse[:]
+        else:
+            np.frombuffer(self.registers, dtype=np.uint8).fill(0)
+        self.scaledSum = self.m << 64
+        self.zeros = self.m
+
+
+class SlidingHyperLogLog(object):
+    """ Distinct count over a sliding window made of the last `slots`
+        sub-windows, kept as a ring of HyperLogLogs. Adds go to the current
+        sub-window; advance() starts a new one and forgets the oldest. The
+        window's cardinality is that of the union of the ring, merged when
+        asked for, so it costs O(slots * registers) at most, and nothing
+        when only one sub-window has data.
+    """
+    __slots__ = ('p', 'ring', 'current')
+
+    def __init__(self, p=16, slots=4):
+        if slots < 1:
+            raise Exception("slots must be at least 1, got %s" % slots)
+        self.p = p
+        self.ring = [HyperLogLog(p) for _ in range(slots)]
+        self.current = 0
+
+    def __sizeof__(self):
+        return object.__sizeof__(self) + sum(sys.getsizeof(sketch) for sketch in self.ring)
+
+    def add(self, item):
+        return self.ring[self.current].add(item)
+
+    def add_hash(self, h):
+        return self.ring[self.current].add_hash(h)
+
+    def add_hashes(self, hashes):
+        return self.ring[self.current].add_hashes(hashes)
+
+    def advance(self):
+        self.current = (self.current + 1) % len(self.ring)
+        self.ring[self.current].clear()
+
+    def isEmpty(self):
+        return all(sketch.isEmpty() for sketch in self.ring)
+
+    def getSlots(self):
+        """ The sub-window sketches, newest first.
+        """
+        n = len(self.ring)
+        return [self.ring[(self.current - i) % n] for i in range(n)]
+
+    def setSlots(self, sketches):
+        self.ring = list(sketches)
+        self.current = 0
+        self.ring[1:] = self.ring[:0:-1]
+
+    def getSketch(self):
+        """ A HyperLogLog of the whole window.
+        """
+        result = HyperLogLog(self.p)
+        for sketch in self.ring:
+            if not sketch.isEmpty():
+                result.merge(sketch)
+        return result
+
+    def cardinality(self):
+        used = [sketch for sketch in self.ring if not sketch.isEmpty()]
+        if not used:
+            return 0.0
+        if len(used) == 1:
+            return used[0].cardinality()
+        return self.getSketch().cardinality()
+
+    def clear(self):
+        for sketch in self.ring:
+            sketch.clear()
+
+
+def test():
+    h = HyperLogLog(14)
+    for i in range(10000):
+        h.add("10.0.%i.%i:80" % (i // 256, i % 256))
+    assert abs(h.cardinality() - 10000) < 300
+    h2 = HyperLogLog(14)
+    h2.add_many(["10.0.%i.%i:80" % (i // 256, i % 256) for i in range(10000)])
+    assert (h2.getRegisters() == h.getRegisters()).all()
+    assert not h.isSparse()
+    h3 = HyperLogLog(14)
+    h3.add_many(["10.1.%i.%i:443" % (i // 256, i % 256) for i in range(5000)])
+    u = h.union(h3)
+    assert abs(u.cardinality() - 15000) < 450
+    h.merge(h3)
+    assert (h.getRegisters() == u.getRegisters()).all()
+    assert HyperLogLog(10).cardinality() == 0
+    # sparse sketches estimate exactly as their dense equivalent
+    s = HyperLogLog(16)
+    d = HyperLogLog(16, sparse=False)
+    items = ["10.2.0.%i:22" % i for i in range(50)]
+    for x in items[:25]:
+        s.add(x)
+    s.add_many(items[25:])
+    d.add_many(items)
+    assert s.isSparse()
+    assert s.cardinality() == d.cardinality()
+    assert (s.getRegisters() == d.getRegisters()).all()
+    assert sys.getsizeof(s) * 50 < sys.getsizeof(d)
+
+
+def benchmark(precisions=range(10, 17), count=200000):
+    """ adds/sec for add() and add_many(), and bytes per sketch, at each precision.
+    """
+    from time import perf_counter
+    items = ["10.%i.%i.%i:%i" % (i >> 16 & 255, i >> 8 & 255, i & 255, i % 1024) for i in range(count)]
+    results = []
+    for p in precisions:
+        h = HyperLogLog(p)
+        start = perf_counter()
+        for x in items:
+            h.add(x)
+        single = count / (perf_counter() - start)
+        h = HyperLogLog(p)
+        start = perf_counter()
+        h.add_many(items)
+        bulk = count / (perf_counter() - start)
+        start = perf_counter()
+        h.cardinality()
+        cardTime = perf_counter() - start
+        small = HyperLogLog(p)
+        small.add_many(items[:50])
+        result = {"p": p, "adds/sec": single, "add_many adds/sec": bulk,
+                  "cardinality sec": cardTime, "bytes": sys.getsizeof(h),
+                  "bytes at 50 items": sys.getsizeof(small)}
+        print("p=%(p)2i  add %(adds/sec)10.0f/s  add_many %(add_many adds/sec)10.0f/s  "
+              "cardinality %(cardinality sec).6fs  %(bytes)8i bytes  "
+              "%(bytes at 50 items)6i bytes at 50 items" % result)
+        results.append(result)
+    return results
@@ -5,16 +5,22 @@
 
 from sys import float_info
 from collections import defaultdict
+from functools import partial
 import heapq
 from datetime import datetime
 from math import sqrt
-from OnlineDeviation import Stdev
+import numpy as np
+from OnlineDeviation import Stdev, StdevArray
 from Netflows import Netflow
 from HLL import HyperLogLog
 from NetflowDetector import NetflowDetector, timestampToDatetime
 from heapq import heappush, heappop, heappushpop
-from IncrementalLeastSquares import ILS
-from Windowing import AverageWindow, SlopeWindow
+from IncrementalLeastSquares import ILS, ILSArray
+from Interning import InternTable, grow
+from Windowing import AverageWindow, SlopeWindow, WindowArray
+from Checkpoint import packKeys, unpackKeys, packSketches, unpackSketches, packStdevs, unpackStdevs, \
+                       packILSs, unpackILSs, packWindows, unpackWindows, packColumns, unpackColumns, \
+                       packValues, unpackValues, packScalars, unpackScalar
 
 maxfloat = float_info.max
 inf = float('inf')
@@ -38,38 +44,83 @@ class HostStabilizationDetector(NetflowDetector):
         also -- if we want -- to determine when the host is NEVER likely to
         stabilize, or "freeze", or when the exponential model is simply
         not appropriate.
+        
+        With vectorized=True, prevLongCard, the averages, the slope
+        regressions and the frozen flags are NumPy columns indexed by host
+        row, and each check updates them all with whole-array operations.
+        
+        With slopeWindow, the average and slope come from each host's last
+        slopeWindow checks instead of its whole history: a SlopeWindow per
+        host, or one WindowArray when vectorized, with no intercept fitted.
+        A host needs two checks in its window before it can freeze.
     """
     __slots__ = ('longCardDict', 'slopeDict', 'avgDict', 'totalCount', 
-                 'updatePeriod', 'tolerance', 'frozenHosts', 'everFrozen', 'prevLongCard')
+                 'updatePeriod', 'tolerance', 'frozenHosts', 'everFrozen', 'prevLongCard',
+                 'hostRows', 'avgArray', 'slopeArray', 'frozenFlags', 'everFrozenFlags', 'slopeWindow')
+    alertDescription = "frozen"
 
-    def __init__(self, sigmaCount=5, period=86400, tolerance=0.001):
+    def __init__(self, sigmaCount=5, period=86400, tolerance=0.001, vectorized=False, slopeWindow=None):
         super().__init__(sigmaCount, period=period)
         self.longCardDict = defaultdict(lambda: HyperLogLog(16))
-        self.prevLongCard = {}
-        self.slopeDict = defaultdict(lambda: ILS())
-        #self.slopeDict = defaultdict(lambda: SlopeWindow())
-        self.avgDict = defaultdict(lambda: Stdev())
-        #self.avgDict = defaultdict(lambda: AverageWindow())
         self.totalCount = 0
         self.updatePeriod = 0
         self.tolerance = tolerance
+        self.slopeWindow = slopeWindow
+        if vectorized:
+            self.hostRows = InternTable()
+            self.prevLongCard = np.zeros(1024)
+            if slopeWindow is None:
+                self.avgArray = StdevArray()
+                self.slopeArray = ILSArray()
+            else:
+                # the window gives the averages too
+                self.avgArray = None
+                self.slopeArray = WindowArray(slopeWindow)
+            self.frozenFlags = np.zeros(1024, dtype=np.bool_)
+            self.everFrozenFlags = np.zeros(1024, dtype=np.bool_)
+            self.slopeDict = self.avgDict = self.frozenHosts = self.everFrozen = None
+            return
+        self.hostRows = self.avgArray = self.slopeArray = None
+        self.frozenFlags = self.everFrozenFlags = None
+        self.prevLongCard = {}
+        if slopeWindow is None:
+            self.slopeDict = defaultdict(lambda: ILS())
+            self.avgDict = defaultdict(lambda: Stdev())
+        else:
+            # the window gives the averages too
+            self.slopeDict = defaultdict(partial(SlopeWindow, slopeWindow))
+            self.avgDict = None
         self.frozenHosts = set()
         self.everFrozen = set() #HyperLogLog(16)
     
-    def addNetflow(self, netflow):
-        srcip = netflow.getSourceIpString()
-        dst = netflow.getDestinationString()
-        self.longCardDict[ srcip ].add( dst )
+    def addFlowFeatures(self, srcip, dst):
+        self.longCardDict[ srcip ].add_hash( dst )
         self.totalCount += 1
     
-    def check(self):
-        self.checkCount += 1
-        if self.checkCount % 1000 == 0:
-            print("%s checkCount = %i" % (type(self).__name__, self.checkCount))
-        extremeDict = self.getOutliers()
+    def addFlowFeatureGroup(self, srcip, dstHashes):
+        self.longCardDict[ srcip ].add_hashes( dstHashes )
+        self.totalCount += len(dstHashes)
+    
+    def getSketchDicts(self):
+        return [self.longCardDict]
+    
+    def reportOutliers(self, extremeDict):
+        if self.alertSink is not None:
+            for key, result in extremeDict.items():
+                self.alert(key, 'start' if result else 'end', None)
+            return
         for key, result in extremeDict.items():
             self.logOutput(key, result)
     
+    def warnNegative(self, key, N_rem, slope):
+        """ A host whose slope is positive, so N_rem comes out negative.
+        """
+        if self.alertSink is not None:
+            self.alert(key, 'negative N_rem', {'N_rem': N_rem, 'slope': slope})
+            return
+        print(key, "has a positive slope, and N_rem estimate is negative. ", \
+              "N_rem=%f slope=%f" % (N_rem, slope))
+    
     def logOutput(self, key, result):
         """ key: an item being tracked
             result: bool -- True if starting above sigmaCount, False if ending above it.
@@ -83,29 +134,33 @@ class HostStabilizationDetector(NetflowDetector):
     def getOutliers(self):
         """ must return a dict of (key, N_rem if > tolerance)
         """
+        if self.hostRows is not None:
+            return self.getOutliersVectorized()
         outliers = {}
         self.updatePeriod += 1
         for key, hll in self.longCardDict.items():
             N_obs = hll.cardinality()
             newObs = N_obs - self.prevLongCard.get(key, 0)
             self.prevLongCard[key] = N_obs
-            # add to slope and average
-            self.avgDict[key].add(newObs)
-            self.slopeDict[key].update(newObs, self.updatePeriod)
-            #self.slopeDict[key].add(N_obs)
-            # get new slope and average
-            avg = self.avgDict[key].getMean()
-            #avg = self.avgDict[key].estimate()
-            slope, intercept = self.slopeDict[key].estimate()
-            #slope = self.slopeDict[key].estimate()
-            #intercept = 0
+            if self.avgDict is None:
+                window = self.slopeDict[key]
+                window.add(newObs)
+                avg = window.getMean()
+                slope = window.estimate()
+                intercept = 0
+            else:
+                # add to slope and average
+                self.avgDict[key].add(newObs)
+                self.slopeDict[key].updateLegacy(newObs, self.updatePeriod)
+                # get new slope and average
+                avg = self.avgDict[key].getMean()
+                slope, intercept = self.slopeDict[key].estimate()
             N_rem = - slope * avg
             if intercept == inf or slope == inf:
                 continue
             elif N_rem < -self.tolerance:
                 # slope is positive; N_rem is negative
-                print(key, "has a positive slope, and N_rem estimate is negative. ", \
-                      "N_rem=%f slope=%f" % (N_rem, slope))
+                self.warnNegative(key, N_rem, slope)
             elif abs(N_rem) <= self.tolerance and key not in self.frozenHosts:
                 self.frozenHosts.add(key)
                 outliers[key] = True
@@ -115,13 +170,61 @@ class HostStabilizationDetector(NetflowDetector):
                 outliers[key] = False
         return outliers
 
+    def getOutliersVectorized(self):
+        self.updatePeriod += 1
+        keys = list(self.longCardDict.keys())
+        N_obs = np.fromiter((hll.cardinality() for hll in self.longCardDict.values()),
+                            dtype=np.float64, count=len(keys))
+        rows = self.hostRows.internMany(keys)
+        size = len(self.hostRows)
+        self.prevLongCard = grow(self.prevLongCard, size)
+        self.frozenFlags = grow(self.frozenFlags, size)
+        self.everFrozenFlags = grow(self.everFrozenFlags, size)
+        self.slopeArray.resize(size)
+        newObs = N_obs - self.prevLongCard[rows]
+        self.prevLongCard[rows] = N_obs
+        if self.avgArray is None:
+            self.slopeArray.add(rows, newObs)
+            avg = self.slopeArray.getMean(rows)
+        else:
+            # add to slope and average
+            self.avgArray.resize(size)
+            self.avgArray.add(rows, newObs)
+            self.slopeArray.updateLegacy(rows, newObs, self.updatePeriod)
+            # get new slope and average
+            avg = self.avgArray.getMean(rows)
+        slope, intercept = self.slopeArray.estimate(rows)
+        N_rem = - slope * avg
+        fitted = (intercept != inf) & (slope != inf)
+        frozen = self.frozenFlags[rows]
+        for i in np.flatnonzero(fitted & (N_rem < -self.tolerance)):
+            # slope is positive; N_rem is negative
+            self.warnNegative(keys[i], float(N_rem[i]), float(slope[i]))
+        freezing = fitted & (np.abs(N_rem) <= self.tolerance) & ~frozen
+        thawing = fitted & (N_rem > self.tolerance) & frozen
+        self.frozenFlags[rows[freezing]] = True
+        self.everFrozenFlags[rows[freezing]] = True
+        self.frozenFlags[rows[thawing]] = False
+        changed = np.flatnonzero(freezing | thawing)
+        return dict(zip([keys[i] for i in changed], freezing[changed].tolist()))
+
     def getCardinalities(self):
+        if self.hostRows is not None:
+            return np.sort(np.fromiter((hll.cardinality() for hll in self.longCardDict.values()),
+                                       dtype=np.float64, count=len(self.longCardDict)))
         return sorted(hll.cardinality() for hll in self.longCardDict.values())
     
     def getMeans(self):
-        return sorted(stdev.getMean() for stdev in self.avgDict.values())
+        if self.hostRows is not None:
+            return np.sort((self.slopeArray if self.avgArray is None else self.avgArray).getMean())
+        return sorted(stdev.getMean() for stdev in (self.slopeDict if self.avgDict is None
+                                                    else self.avgDict).values())
 
     def getSlopes(self):
+        if self.hostRows is not None:
+            return np.sort(self.slopeArray.estimate()[0])
+        if self.avgDict is None:
+            return sorted(window.estimate() for window in self.slopeDict.values())
         return sorted(reg.estimate()[0] for reg in self.slopeDict.values())
     
     def getExtremes(self):
@@ -136,11 +239,81 @@ class HostStabilizationDetector(NetflowDetector):
                 "frozen": len(self.getFrozens()) }
     
     def getFrozens(self):
+        if self.hostRows is not None:
+            return self.keysWhere(self.frozenFlags)
         return self.frozenHosts
     
     def getUnfrozens(self):
+        if self.hostRows is not None:
+            return self.keysWhere(self.everFrozenFlags & ~self.frozenFlags)
         return self.everFrozen - self.frozenHosts
     
     def getNeverFrozens(self):
+        if self.hostRows is not None:
+            return frozenset(self.longCardDict.keys()) - self.keysWhere(self.everFrozenFlags)
         return frozenset(self.longCardDict.keys()) - self.everFrozen
-        
+
+    def keysWhere(self, flags):
+        """ The set of host keys whose row is set in flags.
+        """
+        keys = self.hostRows.keys
+        return set(keys[i] for i in np.flatnonzero(flags[:len(keys)]))
+
+    def getState(self):
+        state = super().getState()
+        packSketches(state, 'longCardDict', self.longCardDict)
+        packScalars(state, 'detector', totalCount=self.totalCount, updatePeriod=self.updatePeriod)
+        if self.hostRows is not None:
+            size = len(self.hostRows)
+            packKeys(state, 'hostRows', self.hostRows.keys)
+            state['prevLongCard'] = self.prevLongCard[:size].copy()
+            if self.avgArray is None:
+                packColumns(state, 'slopeArray', self.slopeArray, WindowArray.columns)
+            else:
+                packColumns(state, 'avgArray', self.avgArray, StdevArray.__slots__[:3])
+                packColumns(state, 'slopeArray', self.slopeArray, ILSArray.columns)
+            state['frozenFlags'] = self.frozenFlags[:size].copy()
+            state['everFrozenFlags'] = self.everFrozenFlags[:size].copy()
+        else:
+            packValues(state, 'prevLongCard', self.prevLongCard)
+            if self.avgDict is None:
+                packWindows(state, 'slopeDict', self.slopeDict)
+            else:
+                packStdevs(state, 'avgDict', self.avgDict)
+                packILSs(state, 'slopeDict', self.slopeDict)
+            # sorted, so the same sets always give the same checkpoint
+            packKeys(state, 'frozenHosts', sorted(self.frozenHosts))
+            packKeys(state, 'everFrozen', sorted(self.everFrozen))
+        return state
+
+    def setState(self, state):
+        super().setState(state)
+        self.longCardDict = unpackSketches(state, 'longCardDict', defaultdict(lambda: HyperLogLog(16)))
+        self.totalCount = unpackScalar(state, 'detector', 'totalCount', int)
+        self.updatePeriod = unpackScalar(state, 'detector', 'updatePeriod', int)
+        if self.hostRows is not None:
+            self.hostRows = InternTable()
+            self.hostRows.internMany(unpackKeys(state, 'hostRows'))
+            size = len(self.hostRows)
+            self.prevLongCard = grow(np.zeros(1024), size)
+            self.prevLongCard[:size] = state['prevLongCard']
+            if self.avgArray is None:
+                self.slopeArray = unpackColumns(state, 'slopeArray', WindowArray(self.slopeWindow),
+                                                WindowArray.columns)
+            else:
+                self.avgArray = unpackColumns(state, 'avgArray', StdevArray(), StdevArray.__slots__[:3])
+                self.slopeArray = unpackColumns(state, 'slopeArray', ILSArray(), ILSArray.columns)
+            self.frozenFlags = grow(np.zeros(1024, dtype=np.bool_), size)
+            self.frozenFlags[:size] = state['frozenFlags']
+            self.everFrozenFlags = grow(np.zeros(1024, dtype=np.bool_), size)
+            self.everFrozenFlags[:size] = state['everFrozenFlags']
+        else:
+            self.prevLongCard = unpackValues(state, 'prevLongCard', {})
+            if self.avgDict is None:
+                factory = partial(SlopeWindow, self.slopeWindow)
+                self.slopeDict = unpackWindows(state, 'slopeDict', defaultdict(factory), factory)
+            else:
+                self.avgDict = unpackStdevs(state, 'avgDict', defaultdict(lambda: Stdev()))
+                self.slopeDict = unpackILSs(state, 'slopeDict', defaultdict(lambda: ILS()))
+            self.frozenHosts = set(unpackKeys(state, 'frozenHosts'))
+            self.everFrozen = set(unpackKeys(state, 'everFrozen'))
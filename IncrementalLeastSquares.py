@@ -2,6 +2,8 @@
 # Copyright (c) 2018, Edgewise Networks Inc. All rights reserved.
 #
 
+import numpy as np
+
 inf = float('inf')
 
 class ILS(object):
@@ -17,6 +19,23 @@ class ILS(object):
         self.cnt = 0
 
     def update(self, x, y):
+        """ Fold in one (x, y) pair, keeping exact co-moments, so the result
+            can be merged with other ILSs.
+        """
+        self.cnt += 1
+        dx = x - self.xbar
+        dy = y - self.ybar
+        self.xbar += dx/self.cnt
+        self.ybar += dy/self.cnt
+        self.betaNumer += dx * (y - self.ybar)
+        self.betaDenom += dy * (y - self.ybar)
+
+    def updateLegacy(self, x, y):
+        """ The original recurrence, which takes both deviations from the new
+            means and so slightly underweights early pairs.
+            HostStabilizationDetector's freeze decisions are tuned to it. An
+            ILS built this way must not be merged.
+        """
         self.cnt += 1
         self.xbar += (x - self.xbar)/self.cnt
         self.ybar += (y - self.ybar)/self.cnt
@@ -25,6 +44,42 @@ class ILS(object):
         self.betaNumer += (x - self.xbar) * (y - self.ybar)
         self.betaDenom += (y - self.ybar) * (y - self.ybar)
 
+    def update_many(self, xs, ys):
+        """ Fold every (x, y) pair from two arrays in at once, as a run of
+            update() calls would.
+        """
+        xs = np.asarray(xs, dtype=np.float64)
+        ys = np.asarray(ys, dtype=np.float64)
+        if len(xs) == 0:
+            return
+        other = ILS()
+        other.cnt = len(xs)
+        other.xbar = float(xs.mean())
+        other.ybar = float(ys.mean())
+        other.betaNumer = float(((xs - other.xbar) * (ys - other.ybar)).sum())
+        other.betaDenom = float(((ys - other.ybar) ** 2).sum())
+        self.merge(other)
+
+    def merge(self, other):
+        """ Fold another ILS's means and co-moments into this one (pairwise
+            combination). Both must be built with update, update_many or merge.
+        """
+        if other.cnt == 0:
+            return
+        if self.cnt == 0:
+            self.cnt, self.xbar, self.ybar = other.cnt, other.xbar, other.ybar
+            self.betaNumer, self.betaDenom = other.betaNumer, other.betaDenom
+            return
+        cnt = self.cnt + other.cnt
+        dx = other.xbar - self.xbar
+        dy = other.ybar - self.ybar
+        weight = self.cnt * other.cnt / cnt
+        self.xbar += dx * other.cnt / cnt
+        self.ybar += dy * other.cnt / cnt
+        self.betaNumer += other.betaNumer + dx * dy * weight
+        self.betaDenom += other.betaDenom + dy * dy * weight
+        self.cnt = cnt
+
     def getCount(self):
         return self.cnt
 
@@ -39,3 +94,133 @@ class ILS(object):
         #intercept = self.ybar - slope * self.xbar
         intercept = self.xbar - slope * self.ybar
         return (slope, intercept)
+
+
+class ILSArray(object):
+    """ ILS for many keys at once, with the running means and co-moments kept
+        as NumPy columns indexed by row.
+    """
+    __slots__ = ('cnt', 'xbar', 'ybar', 'betaNumer', 'betaDenom', 'size')
+
+    columns = ('cnt', 'xbar', 'ybar', 'betaNumer', 'betaDenom')
+
+    def __init__(self, size=0):
+        capacity = max(size, 1024)
+        self.cnt = np.zeros(capacity, dtype=np.int64)
+        self.xbar = np.zeros(capacity, dtype=np.float64)
+        self.ybar = np.zeros(capacity, dtype=np.float64)
+        self.betaNumer = np.zeros(capacity, dtype=np.float64)
+        self.betaDenom = np.zeros(capacity, dtype=np.float64)
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def resize(self, size):
+        """ Make sure rows below size exist; new rows start empty.
+        """
+        if size > len(self.cnt):
+            capacity = max(size, 2 * len(self.cnt))
+            for name in self.columns:
+                column = getattr(self, name)
+                grown = np.zeros(capacity, dtype=column.dtype)
+                grown[:len(column)] = column
+                setattr(self, name, grown)
+        self.size = max(self.size, size)
+
+    def update(self, rows, xs, ys):
+        """ ILS.update(xs[i], ys[i]) on each row in rows, which must be distinct.
+            ys may be a scalar.
+        """
+        cnt = self.cnt[rows] + 1
+        self.cnt[rows] = cnt
+        xbar = self.xbar[rows]
+        dx = xs - xbar
+        xbar += dx/cnt
+        self.xbar[rows] = xbar
+        ybar = self.ybar[rows]
+        dy = ys - ybar
+        ybar += dy/cnt
+        self.ybar[rows] = ybar
+        self.betaNumer[rows] += dx * (ys - ybar)
+        self.betaDenom[rows] += dy * (ys - ybar)
+
+    def updateLegacy(self, rows, xs, ys):
+        """ ILS.updateLegacy(xs[i], ys[i]) on each row in rows, which must be
+            distinct. ys may be a scalar.
+        """
+        cnt = self.cnt[rows] + 1
+        self.cnt[rows] = cnt
+        xbar = self.xbar[rows]
+        xbar += (xs - xbar)/cnt
+        self.xbar[rows] = xbar
+        ybar = self.ybar[rows]
+        ybar += (ys - ybar)/cnt
+        self.ybar[rows] = ybar
+        self.betaNumer[rows] += (xs - xbar) * (ys - ybar)
+        self.betaDenom[rows] += (ys - ybar) * (ys - ybar)
+
+    def getCount(self, rows=slice(None)):
+        return self.cnt[:self.size][rows]
+
+    def estimate(self, rows=slice(None)):
+        """ (slopes, intercepts) arrays, with the same special cases as ILS.estimate.
+        """
+        cnt = self.cnt[:self.size][rows]
+        numer = self.betaNumer[:self.size][rows]
+        denom = self.betaDenom[:self.size][rows]
+        noFit = (cnt < 2) | (denom == 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            slope = np.where(noFit, 0.0, numer / denom)
+        intercept = self.xbar[:self.size][rows] - slope * self.ybar[:self.size][rows]
+        intercept[cnt < 2] = 0.0
+        intercept[(cnt >= 2) & (denom == 0)] = inf
+        return slope, intercept
+
+
+def test():
+    xs = [3 * y + 1 + (-1) ** y for y in range(20)]
+    ys = list(range(20))
+    fitSlope, fitIntercept = np.polyfit(ys, xs, 1)
+    a = ILS()
+    for x, y in zip(xs, ys):
+        a.update(x, y)
+    slope, intercept = a.estimate()
+    assert np.isclose(slope, fitSlope, rtol=1e-12) and np.isclose(intercept, fitIntercept, rtol=1e-12)
+    legacy = ILS()
+    for x, y in zip(xs, ys):
+        legacy.updateLegacy(x, y)
+    assert abs(legacy.estimate()[0] - 3.0) < 0.02
+    # merged batches give the exact least squares fit of x on y
+    b = ILS()
+    b.update_many(xs[:7], ys[:7])
+    c = ILS()
+    c.update_many(xs[7:12], ys[7:12])
+    c.merge(ILS())
+    d = ILS()
+    d.update_many(xs[12:], ys[12:])
+    b.merge(c)
+    b.merge(d)
+    assert b.getCount() == 20
+    assert abs(b.estimate()[0] - fitSlope) < 1e-9
+    assert abs(b.estimate()[1] - fitIntercept) < 1e-9
+    # merging update()-built ILSs matches one pass over the same data, to rounding
+    e, f = ILS(), ILS()
+    for x, y in zip(xs[:9], ys[:9]):
+        e.update(x, y)
+    for x, y in zip(xs[9:], ys[9:]):
+        f.update(x, y)
+    e.merge(f)
+    assert e.getCount() == a.getCount()
+    for name in ('xbar', 'ybar', 'betaNumer', 'betaDenom'):
+        assert np.isclose(getattr(e, name), getattr(a, name), rtol=1e-12), name
+    arr = ILSArray(2)
+    legacyArr = ILSArray(2)
+    for x, y in zip(xs, ys):
+        arr.update(np.array([0, 1]), np.array([x, 5.0]), y)
+        legacyArr.updateLegacy(np.array([0, 1]), np.array([x, 5.0]), y)
+    slopes, intercepts = arr.estimate()
+    assert slopes[0] == slope and intercepts[0] == intercept
+    assert slopes[1] == 0 and intercepts[1] == 5.0
+    slopes, intercepts = legacyArr.estimate()
+    assert tuple(slopes[:1]) + tuple(intercepts[:1]) == legacy.estimate()
@@ -0,0 +1,200 @@
+#
+# Copyright (c) 2018, Edgewise Networks Inc. All rights reserved.
+#
+
+import numpy as np
+from HLL import hash64
+
+def isInside(ipaddr):
+    return ipaddr.startswith('169.254.') or \
+           ipaddr.startswith('127.0.0.') or \
+           ipaddr.startswith('fe80:') or \
+           ipaddr == "0:0:0:0:0:0:0:1" or \
+           ipaddr == "::1"
+
+def grow(arr, size):
+    """ arr, or a copy doubled in length if it has fewer than size elements.
+    """
+    if size <= len(arr):
+        return arr
+    result = np.zeros(max(size, 2 * len(arr)), dtype=arr.dtype)
+    result[:len(arr)] = arr
+    return result
+
+
+class InternTable(object):
+    """ Maps keys to compact integer ids, assigned in order of first sight.
+    """
+    __slots__ = ('ids', 'keys')
+
+    def __init__(self):
+        self.ids = {}
+        self.keys = []
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self.ids
+
+    def intern(self, key):
+        i = self.ids.get(key)
+        if i is None:
+            i = self.ids[key] = len(self.keys)
+            self.keys.append(key)
+        return i
+
+    def internMany(self, keys):
+        try:
+            # all keys already known is the common case, and stays in C
+            return np.fromiter(map(self.ids.__getitem__, keys), dtype=np.int64, count=len(keys))
+        except KeyError:
+            return np.fromiter(map(self.intern, keys), dtype=np.int64, count=len(keys))
+
+    def getKey(self, i):
+        return self.keys[i]
+
+
+def checkPort(port):
+    """ port, a string or int, as an int in 0..65535.
+    """
+    p = int(port)
+    if not 0 <= p <= 0xffff:
+        raise ValueError("port %r is not in 0..65535" % (port,))
+    return p
+
+
+class EndpointTable(InternTable):
+    """ InternTable of (ip, port) destinations, with the port as a decimal
+        string, as found on a Netflow. The hash64 of each "ip:port"
+        destination string is computed once, when the endpoint is first seen,
+        so HLLs never need to format or hash it again.
+
+        Ports given as ints or spelled differently ("080") intern to the same
+        endpoint as the decimal string. Ids are only used to look up hashes,
+        so once the table holds maxSize keys, hashOf and internBatch clear it
+        rather than let a long-running ingest grow it without bound; ids from
+        before are no longer valid.
+    """
+    __slots__ = ('ipTable', 'hashList', 'hashes', 'codes', 'maxSize')
+
+    def __init__(self, ipTable, maxSize=1 << 22):
+        super().__init__()
+        self.ipTable = ipTable
+        self.hashList = []
+        self.hashes = np.zeros(1024, dtype=np.uint64)
+        # ipTable id << 16 | port -> endpoint id, for NetflowBatch columns
+        self.codes = {}
+        self.maxSize = maxSize
+
+    def clear(self):
+        self.ids = {}
+        self.keys = []
+        self.hashList = []
+        self.codes = {}
+
+    def intern(self, key):
+        i = self.ids.get(key)
+        if i is None:
+            ip, port = key
+            endpoint = (ip, "%i" % checkPort(port))
+            i = self.ids.get(endpoint)
+            if i is None:
+                i = self.ids[endpoint] = len(self.keys)
+                self.keys.append(endpoint)
+                h = hash64("%s:%s" % endpoint)
+                self.hashList.append(h)
+                self.hashes = grow(self.hashes, i + 1)
+                self.hashes[i] = h
+            # so the key as given is found without normalising it again
+            self.ids[key] = i
+        return i
+
+    def hashOf(self, ip, port):
+        if len(self.ids) >= self.maxSize:
+            self.clear()
+        return self.hashList[self.intern((ip, port))]
+
+    def getHashes(self):
+        return self.hashes[:len(self.keys)]
+
+    def internCode(self, code):
+        i = self.codes.get(code)
+        if i is None:
+            ip = self.ipTable.keys[code >> 16]
+            i = self.codes[code] = self.intern((ip, str(code & 0xffff)))
+        return i
+
+    def internBatch(self, ips, ports):
+        """ Endpoint ids for arrays of ipTable ids and ports. Only the distinct
+            endpoints in the batch go through the dict.
+        """
+        if len(ports) and (ports.min() < 0 or ports.max() > 0xffff):
+            # they would run into the next ip's codes
+            raise ValueError("ports must be in 0..65535")
+        if len(self.ids) + len(self.codes) >= self.maxSize:
+            self.clear()
+        codes = (ips.astype(np.int64) << 16) | ports
+        distinct, inverse = np.unique(codes, return_inverse=True)
+        ids = np.fromiter(map(self.internCode, distinct.tolist()), dtype=np.int64, count=len(distinct))
+        return ids[inverse]
+
+
+class IpTable(InternTable):
+    """ InternTable of IP address strings that also records, per id, whether
+        the address is link-local or loopback, so inNetwork can be evaluated
+        as an array lookup. Destinations seen with these IPs are interned in
+        endpoints.
+    """
+    __slots__ = ('inside', 'endpoints')
+
+    def __init__(self):
+        super().__init__()
+        self.inside = np.zeros(1024, dtype=np.bool_)
+        self.endpoints = EndpointTable(self)
+
+    def intern(self, key):
+        i = self.ids.get(key)
+        if i is None:
+            i = self.ids[key] = len(self.keys)
+            self.keys.append(key)
+            self.inside = grow(self.inside, i + 1)
+            self.inside[i] = isInside(key)
+        return i
+
+    def getInside(self):
+        return self.inside[:len(self.keys)]
+
+# shared by default, so netflows and batches from different files and readers agree on ids
+ipTable = IpTable()
+
+
+def test():
+    table = IpTable()
+    endpoints = table.endpoints
+    h = endpoints.hashOf('10.0.0.1', '80')
+    assert endpoints.hashOf('10.0.0.1', 80) == h and endpoints.hashOf('10.0.0.1', '080') == h
+    assert len(endpoints) == 1 and h == hash64('10.0.0.1:80')
+    ips = table.internMany(['10.0.0.1', '10.0.0.2', '10.0.0.1'])
+    ids = endpoints.internBatch(ips, np.array([80, 80, 443]))
+    assert ids[0] == endpoints.ids[('10.0.0.1', '80')] and len(endpoints) == 3
+    assert endpoints.getHashes()[ids[2]] == hash64('10.0.0.1:443')
+    for port in (-1, 65536, '70000'):
+        try:
+            endpoints.hashOf('10.0.0.1', port)
+        except ValueError:
+            continue
+        assert False, port
+    try:
+        endpoints.internBatch(ips[:1], np.array([65536]))
+        assert False
+    except ValueError:
+        pass
+    endpoints.maxSize = 8
+    for port in range(20):
+        assert endpoints.hashOf('10.0.0.2', port) == hash64('10.0.0.2:%i' % port)
+    assert len(endpoints.ids) <= 8
+    ids = endpoints.internBatch(np.repeat(ips, 3), np.arange(9) + 1000)
+    assert len(endpoints) < 8 + 9
+    assert endpoints.getHashes()[ids].tolist() == [hash64('%s:%i' % (table.keys[ip], port)) for ip, port
+                                                    in zip(np.repeat(ips, 3).tolist(), range(1000, 1009))]
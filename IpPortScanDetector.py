@@ -7,9 +7,13 @@ from collections import defaultdict
 import heapq
 from datetime import datetime
 from math import sqrt
+import numpy as np
 from OnlineDeviation import Stdev
 from Netflows import Netflow
 from HLL import HyperLogLog
+from SketchStore import SketchStore
+from TopK import TopK
+from Checkpoint import packSketch, unpackSketch, packScalars, unpackScalar
 from NetflowDetector import NetflowDetector, timestampToDatetime
 from heapq import heappush, heappop, heappushpop
 
@@ -27,22 +31,33 @@ class IpPortScanDetector(NetflowDetector):
         IP address, and issue a warning when it's > 5 sigmas above 
         the expected number for all the HLLs.
     """
-    __slots__ = ('cardinalityDict', 'totalCard', 'totalCount', 'topN')
+    __slots__ = ('cardinalityDict', 'totalCard', 'totalCount', 'topN', 'topCards', 'cardinalities')
+    alertDescription = "an outlier for IP port scanning"
 
     def __init__(self, sigmaCount=5, period=600, topN=10):
         super().__init__(sigmaCount, period=period)
         self.topN = topN
-        self.cardinalityDict = defaultdict(lambda: HyperLogLog(16))
+        # largest cardinalities, kept up to date as netflows arrive
+        self.topCards = TopK(topN)
+        self.cardinalityDict = SketchStore(16)
+        # cardinality of each key as of the last check; only keys whose
+        # sketches changed since then are re-estimated.
+        self.cardinalities = {}
         self.totalCard = HyperLogLog(16)
         self.totalCount = 0
     
-    def addNetflow(self, netflow):
-        srcip = netflow.getSourceIpString()
-        dst = netflow.getDestinationString()
-        self.cardinalityDict[ srcip ].add( dst )
-        self.totalCard.add( dst )
+    def addFlowFeatures(self, srcip, dst):
+        if self.cardinalityDict.add_hash( srcip, dst ):
+            self.topCards.update( srcip, self.cardinalityDict[ srcip ].cardinality() )
+        self.totalCard.add_hash( dst )
         self.totalCount += 1
     
+    def addFlowFeatureGroup(self, srcip, dstHashes):
+        if self.cardinalityDict.add_hashes( srcip, dstHashes ):
+            self.topCards.update( srcip, self.cardinalityDict[ srcip ].cardinality() )
+        self.totalCard.add_hashes( dstHashes )
+        self.totalCount += len(dstHashes)
+    
     def getOutliersAll(self):
         """ must return a dict of (key, sigmas if > sigmaCount)
         """
@@ -60,6 +75,9 @@ class IpPortScanDetector(NetflowDetector):
                 outliers[key] = sigs
         return outliers
     
+    def getSketchDicts(self):
+        return [self.cardinalityDict]
+    
     def logOutput(self, key, result):
         """ key: an item being tracked
             result: bool -- True if starting above sigmaCount, False if ending above it.
@@ -73,29 +91,66 @@ class IpPortScanDetector(NetflowDetector):
     def getOutliers(self):
         """ must return a dict of (key, sigmas > sigmaCount)
         """
+        partial = self.getPartialOutliers(self.timePeriodMap.getActives())
+        return self.combinePartialOutliers([partial])
+    
+    def getPartialOutliers(self, activeKeys):
+        """ returns (Stdev of all cardinalities, top N (cardinality, key) pairs,
+            dict of (active key, cardinality))
+        """
+        cardinalities = self.cardinalities
+        for key in self.cardinalityDict.popDirty():
+            cardinalities[key] = self.cardinalityDict[key].cardinality()
+        s = Stdev()
+        s.add_many(np.fromiter(cardinalities.values(), dtype=np.float64, count=len(cardinalities)))
+        if self.topCards.stale:
+            self.topCards.rebuild(heapq.nlargest(self.topN, ((cnt, key) for key, cnt in cardinalities.items())))
+        h = self.topCards.largest()
+        actives = {}
+        for key in activeKeys:
+            if key in cardinalities:
+                actives[key] = cardinalities[key]
+        return s, h, actives
+    
+    def combinePartialOutliers(self, partials):
         outliers = {}
         s = Stdev()
-        h = []
-        topN = self.topN
-        for key, hll in self.cardinalityDict.items():
-            cnt = hll.cardinality()
-            s.add(cnt)
-            if len(h) < topN:
-                heapq.heappush( h, (cnt, key) )
-            else:
-                heapq.heappushpop( h, (cnt, key) )
+        candidates = []
+        actives = {}
+        for partialStdev, h, partialActives in partials:
+            s.merge(partialStdev)
+            candidates.extend(h)
+            actives.update(partialActives)
         mean = s.getMean()
         stdv = s.getStdev()
-        for cnt, key in h:
+        for cnt, key in heapq.nlargest(self.topN, candidates):
             if cnt > mean + self.sigmaCount * stdv:
                 sigs = (cnt - mean) / stdv
                 outliers[key] = sigs
-        for key in self.timePeriodMap.getActives():
-            cnt = hll.cardinality()
+        for key, cnt in actives.items():
             if cnt > mean + self.sigmaCount * stdv:
                 sigs = (cnt - mean) / stdv
                 outliers[key] = sigs
         return outliers
     
+    def getState(self):
+        state = super().getState()
+        self.cardinalityDict.getState(state, 'cardinalityDict')
+        packSketch(state, 'totalCard', self.totalCard)
+        packScalars(state, 'detector', totalCount=self.totalCount)
+        return state
+    
+    def setState(self, state):
+        super().setState(state)
+        self.cardinalityDict.setState(state, 'cardinalityDict')
+        self.totalCard = unpackSketch(state, 'totalCard')
+        self.totalCount = unpackScalar(state, 'detector', 'totalCount', int)
+        # the next check re-estimates every host
+        self.cardinalities = {}
+        self.cardinalityDict.dirty = set(self.cardinalityDict)
+        self.topCards.clear()
+        for key, hll in self.cardinalityDict.items():
+            self.topCards.update(key, hll.cardinality())
+    
     def getCardinalities(self):
         return sorted(hll.cardinality() for hll in self.cardinalityDict.values())
\ No newline at end of file
@@ -0,0 +1,283 @@
+#
+# Copyright (c) 2018, Edgewise Networks Inc. All rights reserved.
+#
+
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from DataIterator import parseNetflowBatch
+from Interning import ipTable as sharedIpTable
+
+class IngestServer(object):
+    """ Accepts live netflow exports over TCP and/or UDP, as newline-delimited
+        TSV rows in the format iterNetflows reads, from any number of
+        exporters at once, and feeds them to a detector (typically a
+        CompositeNetflowDetector).
+
+        The event loop only splits lines. Every chunkSize rows, or every
+        flushInterval seconds, the rows are handed to a single worker thread
+        that parses them into a NetflowBatch, sorts it by timestamp and
+        drops out-of-network rows, and runs detector.addNetflowBatchIterator
+        on it, including any checks that fall due. One thread keeps detector
+        calls in arrival order. When more than maxPending chunks are waiting,
+        TCP exporters stop being read until the worker catches up. UDP
+        datagrams have no flow control and are always queued.
+    """
+    __slots__ = ('detector', 'host', 'tcpPort', 'udpPort', 'chunkSize', 'flushInterval', 'maxPending',
+                 'ipTable', 'lines', 'pending', 'executor', 'servers', 'transports', 'connections',
+                 'flusher', 'received', 'malformed')
+
+    def __init__(self, detector, host='127.0.0.1', tcpPort=None, udpPort=None, chunkSize=4096,
+                 flushInterval=1.0, maxPending=8, ipTable=None):
+        if tcpPort is None and udpPort is None:
+            raise Exception("IngestServer needs a tcpPort or a udpPort")
+        self.detector = detector
+        self.host = host
+        self.tcpPort = tcpPort
+        self.udpPort = udpPort
+        self.chunkSize = chunkSize
+        self.flushInterval = flushInterval
+        self.maxPending = maxPending
+        self.ipTable = sharedIpTable if ipTable is None else ipTable
+        self.lines = []
+        self.pending = deque()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.servers = []
+        self.transports = []
+        self.connections = set()
+        self.flusher = None
+        self.received = 0
+        self.malformed = 0
+
+    async def start(self):
+        """ Start listening. Port 0 picks a free port; the bound ports are
+            stored back in tcpPort and udpPort.
+        """
+        loop = asyncio.get_running_loop()
+        if self.tcpPort is not None:
+            server = await asyncio.start_server(self.handleConnection, self.host, self.tcpPort)
+            self.tcpPort = server.sockets[0].getsockname()[1]
+            self.servers.append(server)
+        if self.udpPort is not None:
+            transport, protocol = await loop.create_datagram_endpoint(
+                lambda: DatagramReceiver(self), local_addr=(self.host, self.udpPort))
+            self.udpPort = transport.get_extra_info('sockname')[1]
+            self.transports.append(transport)
+        self.flusher = asyncio.ensure_future(self.flushPeriodically())
+
+    async def stop(self):
+        """ Stop listening, drop open connections, and wait until every row
+            received has been processed. Raises, once the worker thread is
+            shut down, if any chunk failed while waiting.
+        """
+        for server in self.servers:
+            server.close()
+        for task in list(self.connections):
+            task.cancel()
+        if self.connections:
+            await asyncio.wait(list(self.connections))
+        for server in self.servers:
+            await server.wait_closed()
+        for transport in self.transports:
+            transport.close()
+        if self.flusher is not None:
+            self.flusher.cancel()
+        self.flush()
+        errors = []
+        try:
+            while self.pending:
+                error = await self.waitPending()
+                if error is not None:
+                    errors.append(error)
+        finally:
+            self.executor.shutdown()
+        if errors:
+            raise Exception("netflow ingest failed for %i chunks, first: %r" % (len(errors), errors[0]))
+
+    async def handleConnection(self, reader, writer):
+        task = asyncio.current_task()
+        self.connections.add(task)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                self.addLine(line)
+                while len(self.pending) > self.maxPending:
+                    await self.waitPending()
+        finally:
+            self.connections.discard(task)
+            writer.close()
+
+    def addLine(self, line):
+        self.lines.append(line)
+        self.received += 1
+        if len(self.lines) >= self.chunkSize:
+            self.flush()
+
+    async def waitPending(self):
+        """ Wait for the oldest pending chunk to be processed, and return
+            its exception, if any. A failure is logged rather than raised: the
+            chunk may hold any exporter's rows.
+        """
+        future = self.pending[0]
+        await asyncio.wait([future])
+        if self.pending and self.pending[0] is future:
+            self.pending.popleft()
+            return self.logFailure(future)
+        # someone else waiting on it has logged it
+        return None
+
+    def logFailure(self, future):
+        error = future.exception()
+        if error is not None:
+            print("netflow ingest failed: %r" % error)
+        return error
+
+    async def flushPeriodically(self):
+        while True:
+            await asyncio.sleep(self.flushInterval)
+            self.flush()
+            while self.pending and self.pending[0].done():
+                self.logFailure(self.pending.popleft())
+
+    def flush(self):
+        if not self.lines:
+            return
+        lines = self.lines
+        self.lines = []
+        future = asyncio.get_running_loop().run_in_executor(self.executor, self.process, lines)
+        self.pending.append(future)
+
+    def process(self, lines):
+        """ Runs in the worker thread.
+        """
+        rows = []
+        for line in lines:
+            line = line.decode('utf8').strip()
+            if line.count('\t') == 5:
+                rows.append(line)
+            elif line:
+                self.malformed += 1
+        if not rows:
+            return
+        try:
+            batch = parseNetflowBatch(rows, self.ipTable)
+        except ValueError:
+            # a bad number or port somewhere; fall back to parsing row by row
+            good = []
+            for row in rows:
+                try:
+                    parseNetflowBatch([row], self.ipTable)
+                    good.append(row)
+                except ValueError:
+                    self.malformed += 1
+            if not good:
+                return
+            batch = parseNetflowBatch(good, self.ipTable)
+        batch = batch.select(np.argsort(batch.timestamp, kind='stable'))
+        self.detector.addNetflowBatchIterator(iter([batch.select(batch.inNetwork())]))
+
+
+class DatagramReceiver(asyncio.DatagramProtocol):
+    """ Hands each line of every UDP datagram to an IngestServer.
+    """
+    def __init__(self, server):
+        self.server = server
+
+    def datagram_received(self, data, addr):
+        for line in data.splitlines():
+            self.server.addLine(line)
+
+
+def serve(detector, host='127.0.0.1', tcpPort=None, udpPort=None, **kwargs):
+    """ Run an IngestServer until interrupted.
+    """
+    async def run():
+        server = IngestServer(detector, host, tcpPort, udpPort, **kwargs)
+        await server.start()
+        print("ingesting netflows on %s tcp=%s udp=%s" % (host, server.tcpPort, server.udpPort))
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await server.stop()
+    asyncio.run(run())
+
+async def sendNetflows(lines, host, port, udp=False, linesPerDatagram=32):
+    """ Test exporter: send TSV netflow lines to an IngestServer.
+    """
+    if udp:
+        loop = asyncio.get_running_loop()
+        transport, protocol = await loop.create_datagram_endpoint(asyncio.DatagramProtocol,
+                                                                  remote_addr=(host, port))
+        for i in range(0, len(lines), linesPerDatagram):
+            transport.sendto(''.join(line + '\n' for line in lines[i:i + linesPerDatagram]).encode('utf8'))
+            # let the receiver drain its socket buffer
+            await asyncio.sleep(0)
+        transport.close()
+        return
+    reader, writer = await asyncio.open_connection(host, port)
+    for line in lines:
+        writer.write((line + '\n').encode('utf8'))
+        await writer.drain()
+    writer.close()
+    await writer.wait_closed()
+
+
+def test():
+    from random import Random
+    from IpPortScanDetector import IpPortScanDetector
+    rand = Random(1)
+    exporters = [[] for _ in range(4)]
+    ts = 1500000000000
+    for i in range(20000):
+        ts += rand.randint(0, 50)
+        exporters[i % 4].append("%i\t10.0.0.%i\t%i\t10.1.0.%i\t%i\t1" % (ts, rand.randint(1, 50), rand.randint(1024, 65535),
+                                                                         rand.randint(1, 200), rand.choice([22, 80, 443])))
+    exporters[0].append("not a netflow")
+    # one bad port only costs its own row, not the rest of its chunk
+    exporters[1].insert(500, "%i\t10.0.0.1\t5000\t10.1.0.1\t70000\t1" % ts)
+    exporters[2].insert(500, "%i\t10.0.0.1\t99999999999\t10.1.0.1\t80\t1" % ts)
+    detector = IpPortScanDetector(period=60)
+    async def run():
+        server = IngestServer(detector, tcpPort=0, udpPort=0, chunkSize=1000, flushInterval=0.05)
+        await server.start()
+        await asyncio.gather(*[sendNetflows(lines, server.host, server.tcpPort) for lines in exporters[:3]],
+                             sendNetflows(exporters[3], server.host, server.udpPort, udp=True))
+        sent = sum(len(lines) for lines in exporters)
+        for _ in range(100):
+            if server.received == sent and not server.connections:
+                break
+            await asyncio.sleep(0.01)
+        await server.stop()
+        return server
+    server = asyncio.run(run())
+    # TCP delivers every line, but UDP may drop datagrams
+    tcpSent, udpSent = sum(len(lines) for lines in exporters[:3]), len(exporters[3])
+    assert tcpSent + udpSent // 2 <= server.received <= tcpSent + udpSent and server.malformed == 3
+    assert detector.totalCount == server.received - 3 and detector.checkCount > 0
+    # a detector failure is logged, and raised by stop(), not by a connection
+    class FailingDetector(object):
+        def addNetflowBatchIterator(self, batches):
+            raise Exception("detector failed")
+    async def runFailing():
+        server = IngestServer(FailingDetector(), tcpPort=0, chunkSize=1000, flushInterval=60, maxPending=0)
+        await server.start()
+        # the connection waits on five failing chunks, and stop() on the last ten rows
+        await sendNetflows(exporters[1] + exporters[2][:10], server.host, server.tcpPort)
+        for _ in range(100):
+            if not server.connections:
+                break
+            await asyncio.sleep(0.01)
+        try:
+            await server.stop()
+        except Exception as e:
+            return str(e)
+    import io
+    import contextlib
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        error = asyncio.run(runFailing())
+    assert error is not None and 'detector failed' in error
+    assert out.getvalue().count("netflow ingest failed: ") == 6
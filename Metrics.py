@@ -0,0 +1,179 @@
+#
+# Copyright (c) 2018, Edgewise Networks Inc. All rights reserved.
+#
+
+import os
+from bisect import bisect_left
+from time import monotonic
+
+# histogram bucket upper bounds, in seconds: 1us to about 2 minutes
+latencyBounds = [1e-6 * 2 ** i for i in range(28)]
+
+class Histogram(object):
+    """ Counts of observed values by bucket, Prometheus style: counts[i] is
+        the number of values <= bounds[i] and > bounds[i - 1], and the last
+        count is for values above every bound.
+    """
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds=latencyBounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def getMean(self):
+        return self.sum / self.count if self.count else 0.0
+
+    def getQuantile(self, q):
+        """ Upper bound of the bucket holding the q quantile.
+        """
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class Metrics(object):
+    """ Counters, gauges and latency histograms for one or more detectors.
+
+        Every metric has a name and a label, the detector it is about.
+        Gauges are functions, only called when a snapshot is taken.
+        Detectors time one netflow in every sampleEvery, so the hot path
+        pays a counter increment per netflow rather than two clock reads.
+
+        Sinks are callables given each getSnapshot(), for example a
+        PrometheusTextSink or any callback. export() calls them, and
+        detectors call maybeExport() after every check, which exports at most
+        once every exportInterval seconds.
+    """
+    __slots__ = ('counters', 'gauges', 'histograms', 'sinks', 'sampleEvery',
+                 'exportInterval', 'lastExport')
+
+    def __init__(self, sinks=(), sampleEvery=1024, exportInterval=60.0):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.sinks = list(sinks)
+        self.sampleEvery = sampleEvery
+        self.exportInterval = exportInterval
+        self.lastExport = monotonic()
+
+    def addSink(self, sink):
+        self.sinks.append(sink)
+
+    def increment(self, name, label, value=1):
+        key = (name, label)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def addGauge(self, name, label, fn):
+        self.gauges[(name, label)] = fn
+
+    def getHistogram(self, name, label):
+        key = (name, label)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        return histogram
+
+    def observe(self, name, label, seconds):
+        self.getHistogram(name, label).observe(seconds)
+
+    def getSnapshot(self):
+        """ {'counters': {name: {label: value}}, 'gauges': ..., 'histograms':
+            {name: {label: {'bounds', 'counts', 'sum', 'count'}}}}.
+        """
+        counters = {}
+        for (name, label), value in self.counters.items():
+            counters.setdefault(name, {})[label] = value
+        gauges = {}
+        for (name, label), fn in self.gauges.items():
+            gauges.setdefault(name, {})[label] = fn()
+        histograms = {}
+        for (name, label), h in self.histograms.items():
+            histograms.setdefault(name, {})[label] = {'bounds': h.bounds, 'counts': list(h.counts),
+                                                      'sum': h.sum, 'count': h.count}
+        return {'counters': counters, 'gauges': gauges, 'histograms': histograms}
+
+    def export(self):
+        self.lastExport = monotonic()
+        if not self.sinks:
+            return
+        snapshot = self.getSnapshot()
+        for sink in self.sinks:
+            sink(snapshot)
+
+    def maybeExport(self):
+        if monotonic() - self.lastExport >= self.exportInterval:
+            self.export()
+
+
+def formatPrometheus(snapshot, prefix='fivesigma_'):
+    """ A getSnapshot() in the Prometheus text exposition format, with the
+        label as a "detector" label.
+    """
+    lines = []
+    for kind, section in (('counter', 'counters'), ('gauge', 'gauges')):
+        for name, values in sorted(snapshot[section].items()):
+            lines.append("# TYPE %s%s %s" % (prefix, name, kind))
+            for label, value in sorted(values.items()):
+                lines.append('%s%s{detector="%s"} %r' % (prefix, name, label, value))
+    for name, values in sorted(snapshot['histograms'].items()):
+        lines.append("# TYPE %s%s histogram" % (prefix, name))
+        for label, h in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(h['bounds'] + ['+Inf'], h['counts']):
+                cumulative += count
+                lines.append('%s%s_bucket{detector="%s",le="%s"} %i' % (prefix, name, label, bound, cumulative))
+            lines.append('%s%s_sum{detector="%s"} %r' % (prefix, name, label, h['sum']))
+            lines.append('%s%s_count{detector="%s"} %i' % (prefix, name, label, h['count']))
+    return '\n'.join(lines) + '\n'
+
+
+class PrometheusTextSink(object):
+    """ Writes each snapshot to fname for node_exporter's textfile collector,
+        replacing the file atomically so it is never read half written.
+    """
+    __slots__ = ('fname', 'prefix')
+
+    def __init__(self, fname, prefix='fivesigma_'):
+        self.fname = fname
+        self.prefix = prefix
+
+    def __call__(self, snapshot):
+        tmpname = self.fname + '.tmp'
+        with open(tmpname, 'w') as f:
+            f.write(formatPrometheus(snapshot, self.prefix))
+        os.replace(tmpname, self.fname)
+
+
+def test():
+    h = Histogram()
+    for value in (0.5e-6, 3e-6, 3e-6, 1.0):
+        h.observe(value)
+    assert h.count == 4 and h.counts[0] == 1 and h.counts[2] == 2
+    assert h.getQuantile(0.5) == 4e-6
+    metrics = Metrics()
+    snapshots = []
+    metrics.addSink(snapshots.append)
+    metrics.increment('calls_total', 'test', 10)
+    metrics.increment('calls_total', 'test', 5)
+    metrics.observe('call_seconds', 'test', 1e-3)
+    metrics.observe('call_seconds', 'test', 2e-3)
+    metrics.addGauge('answer', 'test', lambda: 42)
+    metrics.export()
+    snapshot = snapshots[-1]
+    assert snapshot['counters']['calls_total']['test'] == 15
+    assert snapshot['gauges']['answer']['test'] == 42
+    assert snapshot['histograms']['call_seconds']['test']['count'] == 2
+    text = formatPrometheus(snapshot)
+    assert 'fivesigma_calls_total{detector="test"} 15' in text
+    assert 'fivesigma_call_seconds_count{detector="test"} 2' in text
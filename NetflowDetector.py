@@ -2,71 +2,148 @@
 # Copyright (c) 2018, Edgewise Networks Inc. All rights reserved.
 #
 
+import sys
 from sys import float_info
+from time import perf_counter
 from collections import defaultdict
 from datetime import datetime
 from math import sqrt
+from array import array
+import numpy as np
 from Netflows import Netflow
+from Interning import InternTable
+from Alerts import Alert
+from Checkpoint import packKeys, unpackKeys, packScalars, unpackScalar
 
 maxfloat = float_info.max
 
-class TimePeriods(object):
-
-    __slots__ = ('timestampPairs', 'currentStart')
-        
-    def __init__(self, currStart=None):
-        self.timestampPairs = {}
-        self.currentStart = currStart
-        
-    def end(self, e):
-        if self.currentStart is None:
-            raise Exception("currentStart not defined")
-        self.timestampPairs[self.currentStart] = e
-        self.currentStart = None
-        
-    def start(self, s):
-        if self.currentStart is not None:
-            raise Exception("currentStart already defined")
-        self.currentStart = s
-    
-    def active(self):
-        return self.currentStart is not None
-    
-
 class TimePeriodMap(object):
+    """ When each key started and stopped being an outlier.
+
+        Keys that are outliers now are kept in a dict of key -> start time,
+        so update() costs O(new outliers + current outliers) rather than
+        O(every key ever seen). Finished periods go to an append-only log of
+        (key id, start, end) columns, with key ids from an InternTable.
 
-    __slots__ = ('map')
+        With historyLimit, the log holds at most that many periods: older
+        ones are appended to the historySpill file as "key<TAB>start<TAB>end"
+        lines if one is given, and dropped otherwise. Trimming also drops the
+        ids of keys that are neither in the log nor active, so memory stays
+        bounded by the history kept, not by every key ever seen.
+    """
+    __slots__ = ('active', 'keyIds', 'logKeys', 'logStarts', 'logEnds', 'historyLimit', 'historySpill')
     
-    def __init__(self):
-        self.map = defaultdict(TimePeriods)
+    def __init__(self, historyLimit=None, historySpill=None):
+        self.active = {}
+        self.keyIds = InternTable()
+        self.logKeys = array('q')
+        self.logStarts = array('d')
+        self.logEnds = array('d')
+        self.historyLimit = historyLimit
+        self.historySpill = historySpill
     
     def __len__(self):
-        return len(self.map)
+        return len(self.keyIds)
     
     def update(self, itemSet, timestamp):
         result = {}
+        active = self.active
         for item in itemSet:
-            if item not in self.map:
-                self.map[item].start(timestamp)
-                result[item] = True
-            elif not self.map[item].active():
-                self.map[item].start(timestamp)
+            if item not in active:
+                self.keyIds.intern(item)
+                active[item] = timestamp
                 result[item] = True
-        for key, tp in self.map.items():
-            if key not in itemSet and tp.active():
-                tp.end(timestamp)
-                result[key] = False
+        ended = [key for key in active if key not in itemSet]
+        # in order of first appearance, as a scan of every key would give
+        ended.sort(key=self.keyIds.ids.__getitem__)
+        for key in ended:
+            self.logKeys.append(self.keyIds.ids[key])
+            self.logStarts.append(active.pop(key))
+            self.logEnds.append(timestamp)
+            result[key] = False
+        if self.historyLimit is not None and len(self.logKeys) >= 2 * max(self.historyLimit, 1):
+            self.trimHistory()
         return result
     
+    def trimHistory(self):
+        """ Keep the newest historyLimit periods, spilling the others if asked to.
+        """
+        drop = len(self.logKeys) - self.historyLimit
+        if self.historySpill is not None:
+            keys = self.keyIds.keys
+            with open(self.historySpill, 'a') as f:
+                f.writelines("%s\t%r\t%r\n" % (keys[i], s, e)
+                             for i, s, e in zip(self.logKeys[:drop], self.logStarts[:drop], self.logEnds[:drop]))
+        del self.logKeys[:drop]
+        del self.logStarts[:drop]
+        del self.logEnds[:drop]
+        self.compactKeys()
+    
+    def compactKeys(self):
+        """ Renumber the keys still in the log or active, keeping their order.
+        """
+        keys = self.keyIds.keys
+        used = set(self.logKeys)
+        used.update(self.keyIds.ids[key] for key in self.active)
+        if len(used) == len(keys):
+            return
+        keyIds = InternTable()
+        for i in sorted(used):
+            keyIds.intern(keys[i])
+        ids = keyIds.ids
+        self.logKeys = array('q', [ids[keys[i]] for i in self.logKeys])
+        self.keyIds = keyIds
+    
     def getActives(self):
-        return list( k for k, v in self.map.items() if v.active() )
+        return list(self.active)
+    
+    def isActive(self, key):
+        return key in self.active
+    
+    def getPeriods(self, key):
+        """ [(start, end)] of key's logged periods, then (start, None) if it is active.
+        """
+        i = self.keyIds.ids.get(key)
+        periods = [(s, e) for k, s, e in zip(self.logKeys, self.logStarts, self.logEnds) if k == i]
+        if key in self.active:
+            periods.append((self.active[key], None))
+        return periods
     
     def keys(self):
-        return self.map.keys()
+        return self.keyIds.keys
+    
+    def getState(self, state, prefix):
+        """ Add this map to a checkpoint state dict, under prefix.
+        """
+        packKeys(state, prefix, self.keyIds.keys)
+        keys = self.keyIds.ids
+        state[prefix + '.active'] = np.array([keys[key] for key in self.active], dtype=np.int64)
+        state[prefix + '.activeStarts'] = np.array(list(self.active.values()), dtype=np.float64)
+        state[prefix + '.logKeys'] = np.array(self.logKeys, dtype=np.int64)
+        state[prefix + '.logStarts'] = np.array(self.logStarts, dtype=np.float64)
+        state[prefix + '.logEnds'] = np.array(self.logEnds, dtype=np.float64)
+    
+    def setState(self, state, prefix):
+        self.keyIds = InternTable()
+        keys = unpackKeys(state, prefix)
+        self.keyIds.internMany(keys)
+        self.active = dict((keys[i], s) for i, s in zip(state[prefix + '.active'].tolist(),
+                                                        state[prefix + '.activeStarts'].tolist()))
+        self.logKeys = array('q', state[prefix + '.logKeys'].tolist())
+        self.logStarts = array('d', state[prefix + '.logStarts'].tolist())
+        self.logEnds = array('d', state[prefix + '.logEnds'].tolist())
 
 def timestampToDatetime(timestamp):
     return datetime.fromtimestamp(timestamp)
 
+def firstDue(timestamps, lastTimestamp, period):
+    """ Index of the first timestamp at which a detector checked every
+        period seconds since lastTimestamp would check, or None.
+    """
+    due = timestamps - lastTimestamp >= period
+    i = int(due.argmax())
+    return i if due[i] else None
+
 
 class NetflowDetector(object):
     """ We want to find an IP address pair that's scanning a large number of
@@ -80,7 +157,10 @@ class NetflowDetector(object):
         IP address, and issue a warning when it's > 5 sigmas above 
         the expected number for all the HLLs.
     """
-    __slots__ = ('sigmaCount', 'period', 'lastTimestamp', 'checkCount', 'timePeriodMap')
+    __slots__ = ('sigmaCount', 'period', 'lastTimestamp', 'checkCount', 'timePeriodMap',
+                 'metrics', 'metricsName', 'alertSink')
+    # what a key becomes when it starts an outlier period, for alerts
+    alertDescription = "an outlier"
 
     def __init__(self, sigmaCount=5, period=600):
         self.sigmaCount = sigmaCount
@@ -88,8 +168,48 @@ class NetflowDetector(object):
         self.lastTimestamp = None
         self.checkCount = 0
         self.timePeriodMap = TimePeriodMap()
+        self.metrics = None
+        self.metricsName = None
+        self.alertSink = None
+    
+    def setAlertSink(self, alertSink):
+        """ Send outlier starts and ends to alertSink (see Alerts) instead of
+            printing them with logOutput.
+        """
+        self.alertSink = alertSink
+    
+    def alert(self, key, event, value):
+        self.alertSink.add(Alert(self.metricsName or type(self).__name__, key, event, value,
+                                 self.lastTimestamp, self.alertDescription))
+    
+    def setMetrics(self, metrics, name=None):
+        """ Record this detector's netflow counts, sampled addNetflow and
+            per-batch latencies, check latencies and sizes in metrics (see
+            Metrics), labelled name, which defaults to the class name.
+        """
+        self.metrics = metrics
+        self.metricsName = name = name or type(self).__name__
+        metrics.addGauge('tracked_keys', name, self.getTrackedKeys)
+        metrics.addGauge('sketch_bytes', name, self.getSketchBytes)
+        metrics.addGauge('active_outliers', name, lambda: len(self.timePeriodMap.active))
+    
+    def getSketchDicts(self):
+        """ The dicts of key -> sketch this detector keeps, for metrics.
+        """
+        return []
+    
+    def getTrackedKeys(self):
+        return max([len(sketches) for sketches in self.getSketchDicts()] or [0])
+    
+    def getSketchBytes(self):
+        """ Estimated memory held by the sketches.
+        """
+        return sum(sys.getsizeof(sketch) for sketches in self.getSketchDicts() for sketch in sketches.values())
         
     def addNetflowIterator(self, it):
+        if self.metrics is not None:
+            self.addNetflowIteratorMeasured(it)
+            return
         # first time
         netflow = next(it)
         self.addNetflow(netflow)
@@ -102,7 +222,77 @@ class NetflowDetector(object):
             self.addNetflow(netflow)
             self.checkNetflow(netflow.timestamp)
     
+    def addNetflowIteratorMeasured(self, it):
+        """ addNetflowIterator, counting the netflows and timing one
+            addNetflow in every metrics.sampleEvery.
+        """
+        metrics = self.metrics
+        name = self.metricsName
+        histogram = metrics.getHistogram('add_netflow_seconds', name)
+        sampleEvery = metrics.sampleEvery
+        addNetflow = self.addNetflow
+        netflow = next(it)
+        addNetflow(netflow)
+        self.lastTimestamp = netflow.timestamp
+        count = 1
+        for netflow in it:
+            count += 1
+            if count < sampleEvery:
+                addNetflow(netflow)
+            else:
+                start = perf_counter()
+                addNetflow(netflow)
+                histogram.observe(perf_counter() - start)
+                metrics.increment('netflows_total', name, count)
+                count = 0
+            self.checkNetflow(netflow.timestamp)
+        metrics.increment('netflows_total', name, count)
+    
+    def addNetflowBatchIterator(self, it):
+        """ Like addNetflowIterator, for an iterator of NetflowBatch. Batches
+            are split at check boundaries, so checks see the same state as
+            they would one netflow at a time.
+        """
+        addNetflowBatch = self.addNetflowBatch if self.metrics is None else self.addNetflowBatchMeasured
+        for batch in it:
+            if len(batch) == 0:
+                continue
+            timestamps = batch.timestamp
+            if self.lastTimestamp is None:
+                self.lastTimestamp = float(timestamps[0])
+            start = 0
+            while start < len(batch):
+                i = firstDue(timestamps[start:], self.lastTimestamp, self.period)
+                if i is None:
+                    addNetflowBatch(batch.select(slice(start, None)))
+                    break
+                stop = start + i + 1
+                addNetflowBatch(batch.select(slice(start, stop)))
+                self.checkNetflow(float(timestamps[stop - 1]))
+                start = stop
+    
     def addNetflow(self, netflow):
+        self.addFlowFeatures(netflow.getSourceIpString(), netflow.getDestinationHash())
+    
+    def addFlowFeatures(self, srcip, dstHash):
+        """ srcip: source IP string
+            dstHash: hash64 of the destination "ip:port" string
+        """
+        raise Exception("Implement in subclass")
+    
+    def addNetflowBatch(self, batch):
+        for srcip, dstHashes in batch.getSourceGroups():
+            self.addFlowFeatureGroup(srcip, dstHashes)
+    
+    def addNetflowBatchMeasured(self, batch):
+        start = perf_counter()
+        self.addNetflowBatch(batch)
+        self.metrics.observe('add_batch_seconds', self.metricsName, perf_counter() - start)
+        self.metrics.increment('netflows_total', self.metricsName, len(batch))
+    
+    def addFlowFeatureGroup(self, srcip, dstHashes):
+        """ addFlowFeatures for a uint64 array of destination hashes from one source IP.
+        """
         raise Exception("Implement in subclass")
         
     def checkNetflow(self, netflowTimestamp):
@@ -115,21 +305,84 @@ class NetflowDetector(object):
         """
         raise Exception("Implement in subclass")
     
+    def getPartialOutliers(self, activeKeys):
+        """ The part of getOutliers this detector can work out on its own when
+            it holds only one shard of the source IPs. activeKeys are the
+            currently extreme keys that belong to this shard.
+            
+            Detectors that only compare a host with its own history can
+            decide outliers per shard; ones that compare hosts with each other
+            override this and combinePartialOutliers.
+        """
+        return self.getOutliers()
+    
+    def combinePartialOutliers(self, partials):
+        """ getOutliers for the whole population, from every shard's getPartialOutliers.
+        """
+        outliers = {}
+        for partial in partials:
+            outliers.update(partial)
+        return outliers
+    
     def logOutput(self, key, result):
         """ key: an item being tracked
             result: bool -- True if starting above sigmaCount, False if ending above it.
         """ 
         raise Exception("Implement in subclass")
     
+    def getState(self):
+        """ Everything needed to resume this detector, as a dict of NumPy
+            arrays (see Checkpoint). Subclasses add their own state.
+        """
+        state = {}
+        packScalars(state, 'detector', lastTimestamp=self.lastTimestamp, checkCount=self.checkCount)
+        self.timePeriodMap.getState(state, 'timePeriodMap')
+        return state
+    
+    def setState(self, state):
+        self.lastTimestamp = unpackScalar(state, 'detector', 'lastTimestamp')
+        self.checkCount = unpackScalar(state, 'detector', 'checkCount', int)
+        self.timePeriodMap.setState(state, 'timePeriodMap')
+    
     def check(self):
         self.checkCount += 1
         if self.checkCount % 1000 == 0:
             print("%s checkCount = %i" % (type(self).__name__, self.checkCount))
-        extremeDict = self.getOutliers()
+        if self.metrics is None:
+            self.reportOutliers(self.getOutliers())
+            return
+        start = perf_counter()
+        outliers = self.getOutliers()
+        self.measureCheck(start, perf_counter(), outliers)
+    
+    def measureCheck(self, start, found, outliers):
+        """ reportOutliers, recording how long the check took to find the
+            outliers (from start to found) and to report them.
+        """
+        metrics = self.metrics
+        name = self.metricsName
+        self.reportOutliers(outliers)
+        end = perf_counter()
+        metrics.increment('checks_total', name)
+        metrics.observe('get_outliers_seconds', name, found - start)
+        metrics.observe('report_outliers_seconds', name, end - found)
+        metrics.observe('check_seconds', name, end - start)
+        metrics.maybeExport()
+    
+    def reportOutliers(self, extremeDict):
         extremeSet = set(extremeDict.keys())
-        key2result = self.timePeriodMap.update(extremeSet, self.lastTimestamp)
-        for key, result in key2result.items():
-            self.logOutput(key, result)
+        if self.metrics is None:
+            key2result = self.timePeriodMap.update(extremeSet, self.lastTimestamp)
+        else:
+            start = perf_counter()
+            key2result = self.timePeriodMap.update(extremeSet, self.lastTimestamp)
+            self.metrics.observe('period_map_update_seconds', self.metricsName, perf_counter() - start)
+        if self.alertSink is None:
+            for key, result in key2result.items():
+                self.logOutput(key, result)
+        else:
+            for key, result in key2result.items():
+                self.alert(key, 'start' if result else 'end', extremeDict.get(key))
     
     def getExtremes(self):
         return self.timePeriodMap.getActives()
@@ -137,3 +390,22 @@ class NetflowDetector(object):
     def getExtremeCounts(self):
         return {"extreme": len(self.getExtremes()), 
                 "previously extreme": len(self.timePeriodMap) }
+
+
+def test():
+    periods = TimePeriodMap(historyLimit=4)
+    t = 0
+    for outliers in [{'a', 'b'}, {'b'}, {'c'}, set(), {'a'}] + [{'d%i' % i} for i in range(10)] + [{'a', 'e'}, {'e'}]:
+        t += 1
+        periods.update(outliers, t)
+    assert periods.getActives() == ['e'] and periods.getPeriods('e') == [(16, None)]
+    assert periods.getPeriods('a') == [(16, 17)] and periods.getPeriods('d9') == [(15, 16)]
+    assert periods.getPeriods('b') == [] and periods.getPeriods('d0') == []
+    # only keys still in the log or active keep ids
+    assert len(periods) <= 2 * 4 + 1 and 'e' in periods.keyIds and 'b' not in periods.keyIds
+    state = {}
+    periods.getState(state, 'periods')
+    copy = TimePeriodMap(historyLimit=4)
+    copy.setState(state, 'periods')
+    assert copy.getActives() == ['e'] and copy.getPeriods('d9') == [(15, 16)]
+    assert [copy.update({'f'}, t + 1)] == [periods.update({'f'}, t + 1)] == [{'f': True, 'e': False}]
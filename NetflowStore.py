@@ -0,0 +1,257 @@
+#
+# Copyright (c) 2018, Edgewise Networks Inc. All rights reserved.
+#
+
+import os
+import shutil
+import numpy as np
+from Netflows import NetflowBatch
+from Interning import IpTable, ipTable as sharedIpTable
+from DataIterator import iterdir, iterNetflowBatches, networkBatches
+from TimeIndex import TimeIndex, blockStats, timeRangeMask
+
+# column name -> on-disk dtype. IPs are ids into the store's ips.txt.
+columns = (('timestamp', '<f8'), ('srcip', '<u4'), ('srcport', '<i4'),
+           ('dstip', '<u4'), ('dstport', '<i4'), ('flows', '<i8'))
+
+ipsName = 'ips.txt'
+segmentsName = 'segments.txt'
+indexName = 'index.json'
+
+def defaultStoreName(pathname, siteId):
+    return (pathname % siteId).rstrip(os.sep) + '.store'
+
+def readLines(fname):
+    if not os.path.exists(fname):
+        return []
+    with open(fname, 'r', encoding='utf8') as f:
+        return f.read().splitlines()
+
+def writeLines(fname, lines):
+    """ Replace fname with lines, atomically.
+    """
+    tmp = fname + '.tmp'
+    with open(tmp, 'w', encoding='utf8') as f:
+        f.writelines(line + '\n' for line in lines)
+    os.replace(tmp, fname)
+
+
+def convertData(pathname, siteId, storename=None, chunkSize=65536):
+    """ Convert every .txt.gz file under pathname % siteId into a binary
+        columnar store, one segment directory per file holding a .npy file per
+        column. IP addresses are written once to the store's ips.txt, and the
+        segments hold their ids.
+
+        Conversion is incremental: files whose segment is listed in the store's
+        segments.txt and newer than the file are skipped, and ips.txt is only
+        ever appended to, so ids stay valid. A segment is written to a
+        temporary directory, the IPs it uses are appended to ips.txt, and only
+        then is it renamed into place and listed, so a crash part way leaves
+        nothing that a later run would skip. Returns the store name.
+    """
+    if storename is None:
+        storename = defaultStoreName(pathname, siteId)
+    dirname = pathname % siteId
+    os.makedirs(storename, exist_ok=True)
+    ipsFile = os.path.join(storename, ipsName)
+    segmentsFile = os.path.join(storename, segmentsName)
+    storeTable = IpTable()
+    known = readLines(ipsFile)
+    storeTable.internMany(known)
+    listed = readLines(segmentsFile)
+    current = set(listed)
+    segments = []
+    for fname in iterdir(dirname):
+        if not fname.endswith(".txt.gz"):
+            continue
+        segment = os.path.relpath(fname, dirname)[:-len(".txt.gz")]
+        segments.append(segment)
+        segdir = os.path.join(storename, segment)
+        if segment in current and os.path.isdir(segdir) and os.path.getmtime(segdir) >= os.path.getmtime(fname):
+            continue
+        tmp = segdir + '.tmp'
+        writeSegment(tmp, iterNetflowBatches(fname, chunkSize, storeTable))
+        # ids used by the segment must be on disk before it is
+        with open(ipsFile, 'a', encoding='utf8') as f:
+            f.writelines(ip + '\n' for ip in storeTable.keys[len(known):])
+            f.flush()
+            os.fsync(f.fileno())
+        known = list(storeTable.keys)
+        if os.path.isdir(segdir):
+            shutil.rmtree(segdir)
+        os.rename(tmp, segdir)
+        if segment not in current:
+            current.add(segment)
+            listed.append(segment)
+            writeLines(segmentsFile, listed)
+    writeLines(segmentsFile, segments)
+    return storename
+
+def writeSegment(dirname, batches):
+    """ Write the columns of batches to a new directory, dirname.
+    """
+    chunks = dict((name, []) for name, dtype in columns)
+    for batch in batches:
+        for name, dtype in columns:
+            chunks[name].append(getattr(batch, name))
+    if os.path.isdir(dirname):
+        shutil.rmtree(dirname)
+    os.makedirs(dirname)
+    for name, dtype in columns:
+        col = np.concatenate(chunks[name]) if chunks[name] else np.zeros(0)
+        np.save(os.path.join(dirname, name + '.npy'), col.astype(dtype, copy=False))
+
+
+class NetflowStore(object):
+    """ Reader for a store written by convertData. Segment columns are
+        memory-mapped, and batches are views of them, so replaying the store
+        does no decompression or parsing.
+
+        Store IP ids are translated into ipTable ids. When they already agree,
+        as when the store is the first thing a process reads, the srcip and
+        dstip views are used as they are.
+    """
+    __slots__ = ('storename', 'segments', 'ipTable', 'translation')
+
+    def __init__(self, storename, ipTable=None):
+        if ipTable is None:
+            ipTable = sharedIpTable
+        self.storename = storename
+        self.ipTable = ipTable
+        if not os.path.exists(os.path.join(storename, segmentsName)):
+            raise Exception("%s is not a netflow store" % storename)
+        self.segments = readLines(os.path.join(storename, segmentsName))
+        self.translation = None
+        self.loadIps()
+
+    def loadIps(self):
+        ids = self.ipTable.internMany(readLines(os.path.join(self.storename, ipsName)))
+        if np.array_equal(ids, np.arange(len(ids))):
+            self.translation = None
+        else:
+            self.translation = ids
+
+    def openSegment(self, segment):
+        """ dict of column name -> read-only memory-mapped array.
+        """
+        segdir = os.path.join(self.storename, segment)
+        return dict((name, np.load(os.path.join(segdir, name + '.npy'), mmap_mode='r'))
+                    for name, dtype in columns)
+
+    def segmentBatch(self, cols, start, end):
+        srcip = cols['srcip'][start:end]
+        dstip = cols['dstip'][start:end]
+        if self.translation is not None:
+            srcip = self.translation[srcip]
+            dstip = self.translation[dstip]
+        return NetflowBatch(cols['timestamp'][start:end], srcip, cols['srcport'][start:end],
+                            dstip, cols['dstport'][start:end], cols['flows'][start:end], self.ipTable)
+
+    def getIndex(self):
+        """ The store's TimeIndex, brought up to date with its segments.
+        """
+        index = TimeIndex(os.path.join(self.storename, indexName))
+        for segment in self.segments:
+            index.update(segment, os.path.join(self.storename, segment, 'timestamp.npy'), scanSegment)
+        index.save()
+        return index
+
+    def iterBatches(self, chunkSize=65536, start=None, end=None):
+        """ Yields NetflowBatch views of up to chunkSize rows, in file order,
+            optionally only those with timestamps in [start, end). Bounded
+            reads only touch the blocks the index says overlap the range.
+        """
+        index = None
+        if start is not None or end is not None:
+            index = self.getIndex()
+        for segment in self.segments:
+            if index is None:
+                rowRanges = None
+            else:
+                rowRanges = index.getRowRanges(segment, start, end)
+                if not rowRanges:
+                    continue
+            cols = self.openSegment(segment)
+            if rowRanges is None:
+                rowRanges = [(0, len(cols['timestamp']))]
+            for first, last in rowRanges:
+                for row in range(first, last, chunkSize):
+                    batch = self.segmentBatch(cols, row, min(row + chunkSize, last))
+                    if index is not None:
+                        batch = batch.select(timeRangeMask(batch.timestamp, start, end))
+                    yield batch
+
+
+def scanSegment(fname, blockSize):
+    """ TimeIndex scan of a segment's timestamp column.
+    """
+    timestamps = np.load(fname, mmap_mode='r')
+    return len(timestamps), blockStats(timestamps, blockSize)
+
+def iterateStoreBatches(storename, chunkSize=65536, start=None, end=None):
+    return NetflowStore(storename).iterBatches(chunkSize, start, end)
+
+def iterateNetworkStoreBatches(storename, maxCount=None, chunkSize=65536, start=None, end=None):
+    """ Store counterpart of DataIterator.iterateNetworkDataBatches.
+    """
+    return networkBatches(iterateStoreBatches(storename, chunkSize, start, end), maxCount)
+
+
+def test():
+    import gzip
+    import random
+    import tempfile
+    from DataIterator import iterateData
+    dirname = tempfile.mkdtemp()
+    rng = random.Random(0)
+    timestamp = 1500000000000
+    os.mkdir(os.path.join(dirname, 'site0'))
+    for f in range(3):
+        with gzip.open(os.path.join(dirname, 'site0', 'flows-%i.txt.gz' % f), 'wt') as out:
+            for i in range(3000):
+                timestamp += rng.randint(1, 40)
+                # a few loopback rows, for the in-network filters to drop
+                src = '127.0.0.1' if rng.random() < 0.01 else '10.0.%i.%i' % (rng.randint(0, 3), rng.randint(1, 254))
+                out.write('%i\t%s\t%i\t10.1.%i.%i\t%i\t%i\n' % (timestamp, src, rng.randint(1024, 65535), rng.randint(0, 3),
+                                                            rng.randint(1, 254), rng.choice((22, 80, 443)), rng.randint(1, 99)))
+    def rows(netflows):
+        return [(nf.timestamp, nf.srcip, int(nf.srcport), nf.getDestinationString(), nf.flows) for nf in netflows]
+    def batchRows(batches):
+        return [row for batch in batches
+                for row in zip(batch.timestamp.tolist(), batch.getSourceIpStrings(), batch.srcport.tolist(),
+                               batch.getDestinationStrings(), batch.flows.tolist())]
+    pathname = os.path.join(dirname, 'site%s')
+    storename = convertData(pathname, 0, chunkSize=1000)
+    expected = rows(iterateData(pathname, 0))
+    store = NetflowStore(storename)
+    assert batchRows(store.iterBatches(1000)) == expected
+    # a table that already holds other IPs gets translated ids
+    table = IpTable()
+    table.internMany(['192.168.0.%i' % i for i in range(10)])
+    translated = NetflowStore(storename, table)
+    assert translated.translation is not None
+    assert batchRows(translated.iterBatches(700)) == expected
+    # bounded reads give the rows iterateData gives
+    timestamps = sorted(nf.timestamp for nf in iterateData(pathname, 0))
+    start, end = timestamps[2000], timestamps[6500]
+    bounded = rows(iterateData(pathname, 0, start, end))
+    assert len(bounded) == 4500
+    assert batchRows(store.iterBatches(1000, start, end)) == bounded
+    assert sum(len(batch) for batch in iterateNetworkStoreBatches(storename, start=start, end=end)) == \
+        sum(1 for nf in iterateData(pathname, 0, start, end) if nf.inNetwork())
+    # converting again leaves current segments alone
+    segments = [os.path.getmtime(os.path.join(storename, segment)) for segment in store.segments]
+    convertData(pathname, 0)
+    assert [os.path.getmtime(os.path.join(storename, segment)) for segment in store.segments] == segments
+    # a crash after the last segment was written, but before its IPs were, leaves it unlisted,
+    # so it is converted again instead of keeping ids that ips.txt does not have
+    ipsFile, segmentsFile = os.path.join(storename, ipsName), os.path.join(storename, segmentsName)
+    cols = [store.openSegment(segment) for segment in store.segments[:-1]]
+    numIps = 1 + max(int(max(col['srcip'].max(), col['dstip'].max())) for col in cols)
+    writeLines(ipsFile, readLines(ipsFile)[:numIps])
+    writeLines(segmentsFile, store.segments[:-1])
+    last = os.path.join(storename, store.segments[-1])
+    os.utime(last, (2e9, 2e9))
+    convertData(pathname, 0)
+    assert os.path.getmtime(last) < 2e9 and readLines(segmentsFile) == store.segments
+    assert batchRows(NetflowStore(storename, IpTable()).iterBatches(1000)) == expected
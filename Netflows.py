@@ -3,6 +3,8 @@
 #
 
 import ipaddress
+import numpy as np
+from Interning import isInside, ipTable
 
 class NetflowOrig(object):
 
@@ -41,16 +43,9 @@ class NetflowOrig(object):
     def getDestinationString(self):
         return "%s:%i" % (self.dstip, self.dstport)
 
-def isInside(ipaddr):
-    return ipaddr.startswith('169.254.') or \
-           ipaddr.startswith('127.0.0.') or \
-           ipaddr.startswith('fe80:') or \
-           ipaddr == "0:0:0:0:0:0:0:1" or \
-           ipaddr == "::1"
-
 class Netflow(object):
 
-    __slots__ = ('timestamp', 'srcip', 'srcport', 'dstip', 'dstport', 'flows', 'isOverNetwork')
+    __slots__ = ('timestamp', 'srcip', 'srcport', 'dstip', 'dstport', 'flows', 'isOverNetwork', 'dstHash')
     
     def __init__(self, timestamp, srcip, srcport, dstip, dstport, flows, javaTimestamp=True):
         if javaTimestamp:
@@ -63,6 +58,7 @@ class Netflow(object):
         self.dstport = dstport
         self.flows = int(flows)
         self.isOverNetwork = (not isInside(self.srcip)) and (not isInside(self.dstip))
+        self.dstHash = None
 
     def inNetwork(self):
         return self.isOverNetwork
@@ -83,4 +79,119 @@ class Netflow(object):
     
     def getDestinationString(self):
         return "%s:%s" % (self.dstip, self.dstport)
-        #return (self.dstip, self.dstport)
\ No newline at end of file
+        #return (self.dstip, self.dstport)
+
+    def getDestinationHash(self):
+        """ hash64 of getDestinationString(), looked up in the shared endpoint
+            table and cached, so every detector after the first gets it for free.
+        """
+        if self.dstHash is None:
+            self.dstHash = ipTable.endpoints.hashOf(self.dstip, self.dstport)
+        return self.dstHash
+
+class NetflowBatch(object):
+    """ A chunk of netflows stored column-wise: timestamps in seconds as float64,
+        source and destination IPs as ids into ipTable, and ports and flow
+        counts as int arrays.
+    """
+    __slots__ = ('timestamp', 'srcip', 'srcport', 'dstip', 'dstport', 'flows', 'ipTable', 'dstHashes',
+                 'sourceGroups')
+
+    def __init__(self, timestamp, srcip, srcport, dstip, dstport, flows, ipTable):
+        self.timestamp = timestamp
+        self.srcip = srcip
+        self.srcport = srcport
+        self.dstip = dstip
+        self.dstport = dstport
+        self.flows = flows
+        self.ipTable = ipTable
+        self.dstHashes = None
+        self.sourceGroups = None
+
+    def __len__(self):
+        return len(self.timestamp)
+
+    def __repr__(self):
+        return 'NetflowBatch(%i netflows)' % len(self)
+
+    def select(self, index):
+        """ The rows picked out by a slice, boolean mask or index array.
+        """
+        return NetflowBatch(self.timestamp[index], self.srcip[index], self.srcport[index],
+                            self.dstip[index], self.dstport[index], self.flows[index], self.ipTable)
+
+    def iterNetflows(self):
+        """ The rows as Netflow objects, with string IPs and ports as iterNetflows gives them.
+        """
+        keys = self.ipTable.keys
+        for ts, srcip, srcport, dstip, dstport, flows in zip(self.timestamp.tolist(), self.srcip.tolist(),
+                                                             self.srcport.tolist(), self.dstip.tolist(),
+                                                             self.dstport.tolist(), self.flows.tolist()):
+            nf = Netflow(0, keys[srcip], str(srcport), keys[dstip], str(dstport), flows)
+            nf.timestamp = ts
+            yield nf
+
+    def inNetwork(self):
+        """ Boolean mask of the rows where neither endpoint is link-local or loopback.
+        """
+        inside = self.ipTable.getInside()
+        return ~(inside[self.srcip] | inside[self.dstip])
+
+    def getSourceIpStrings(self):
+        keys = self.ipTable.keys
+        return [keys[i] for i in self.srcip.tolist()]
+
+    def getDestinationStrings(self):
+        keys = self.ipTable.keys
+        return ["%s:%s" % (keys[i], port) for i, port in zip(self.dstip.tolist(), self.dstport.tolist())]
+
+    def getDestinationIds(self):
+        """ Ids of each row's (dstip, dstport) in ipTable.endpoints.
+        """
+        return self.ipTable.endpoints.internBatch(self.dstip, self.dstport)
+
+    def getDestinationHashes(self):
+        """ hash64 of each row's destination string, as a uint64 array. Cached,
+            like Netflow.getDestinationHash.
+        """
+        if self.dstHashes is None:
+            # intern first: it may grow the hash column
+            ids = self.getDestinationIds()
+            self.dstHashes = self.ipTable.endpoints.getHashes()[ids]
+        return self.dstHashes
+
+    def groupBySource(self):
+        """ Yields (source IP string, row indices) for each distinct source IP.
+        """
+        if len(self) == 0:
+            return
+        order = np.argsort(self.srcip, kind='stable')
+        srcs = self.srcip[order]
+        bounds = np.flatnonzero(srcs[1:] != srcs[:-1]) + 1
+        starts = [0] + bounds.tolist()
+        ends = bounds.tolist() + [len(order)]
+        keys = self.ipTable.keys
+        for start, end in zip(starts, ends):
+            yield keys[srcs[start]], order[start:end]
+
+    def getSourceGroups(self):
+        """ [(source IP string, uint64 array of its destination hashes)], computed
+            once per batch and shared by every detector it is handed to.
+        """
+        if self.sourceGroups is None:
+            hashes = self.getDestinationHashes()
+            self.sourceGroups = [(srcip, hashes[rows]) for srcip, rows in self.groupBySource()]
+        return self.sourceGroups
+
+def concatenateBatches(batches):
+    """ One NetflowBatch of all the rows of batches, in order. The batches must share an ipTable.
+    """
+    ipTable = batches[0].ipTable
+    for batch in batches:
+        if batch.ipTable is not ipTable:
+            raise Exception("can't concatenate NetflowBatches with different ipTables")
+    if len(batches) == 1:
+        return batches[0]
+    return NetflowBatch(*[np.concatenate([getattr(b, name) for b in batches])
+                          for name in ('timestamp', 'srcip', 'srcport', 'dstip', 'dstport', 'flows')],
+                        ipTable=ipTable)
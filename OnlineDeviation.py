@@ -3,6 +3,7 @@
 #
 
 from math import sqrt
+import numpy as np
 
 class Stdev(object):
 
@@ -20,6 +21,32 @@ class Stdev(object):
         delta2 = x - self.mean
         self.m2 += delta * delta2
 
+    def add_many(self, xs):
+        """ add() every value in an array, in one vectorized step.
+        """
+        xs = np.asarray(xs, dtype=np.float64)
+        if len(xs) == 0:
+            return
+        other = Stdev()
+        other.n = len(xs)
+        other.mean = float(xs.mean())
+        other.m2 = float(((xs - other.mean) ** 2).sum())
+        self.merge(other)
+
+    def merge(self, other):
+        """ Fold another Stdev's moments into this one (Chan et al.'s parallel algorithm).
+        """
+        if other.n == 0:
+            return
+        if self.n == 0:
+            self.n, self.mean, self.m2 = other.n, other.mean, other.m2
+            return
+        n = self.n + other.n
+        delta = other.mean - self.mean
+        self.mean += delta * other.n / n
+        self.m2 += other.m2 + delta * delta * self.n * other.n / n
+        self.n = n
+
     def getMean(self):
         return self.mean
 
@@ -33,8 +60,158 @@ class Stdev(object):
         return sqrt(self.getVariance())
 
 
+class StdevArray(object):
+    """ Stdev for many keys at once: n, mean and m2 are NumPy columns indexed
+        by row, so whole populations can be updated and tested in one step.
+    """
+    __slots__ = ('n', 'mean', 'm2', 'size')
+
+    def __init__(self, size=0):
+        self.n = np.zeros(max(size, 1024), dtype=np.int64)
+        self.mean = np.zeros(len(self.n), dtype=np.float64)
+        self.m2 = np.zeros(len(self.n), dtype=np.float64)
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def resize(self, size):
+        """ Make sure rows below size exist; new rows start empty.
+        """
+        if size > len(self.n):
+            capacity = max(size, 2 * len(self.n))
+            for name in ('n', 'mean', 'm2'):
+                column = getattr(self, name)
+                grown = np.zeros(capacity, dtype=column.dtype)
+                grown[:len(column)] = column
+                setattr(self, name, grown)
+        self.size = max(self.size, size)
+
+    def add(self, rows, xs):
+        """ Stdev.add(xs[i]) on each row in rows, which must be distinct.
+        """
+        n = self.n[rows] + 1
+        mean = self.mean[rows]
+        delta = xs - mean
+        mean += delta / n
+        self.m2[rows] += delta * (xs - mean)
+        self.mean[rows] = mean
+        self.n[rows] = n
+
+    def getMean(self, rows=slice(None)):
+        return self.mean[:self.size][rows]
+
+    def getVariance(self, rows=slice(None)):
+        n = self.n[:self.size][rows]
+        m2 = self.m2[:self.size][rows]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(m2 < 2, np.nan, m2 / (n - 1))
+
+    def getStdev(self, rows=slice(None)):
+        return np.sqrt(self.getVariance(rows))
+
+
+def halfLifeAlpha(halfLife):
+    """ The weight of each new value when the weight of a value halves every halfLife values.
+    """
+    if not halfLife > 0:
+        raise Exception("halfLife must be positive, got %s" % halfLife)
+    return 1 - 0.5 ** (1 / halfLife)
+
+
+class EWStdev(object):
+    """ Exponentially weighted mean and variance: a Stdev whose history
+        fades, a value's weight halving every halfLife values, in O(1) memory.
+
+        The weight of a new value is max(alpha, 1/n), so for the first
+        1/alpha values this is exactly Stdev; after that it behaves like a
+        Stdev over about the last 1/alpha values, which getVariance uses as
+        the sample size.
+    """
+    __slots__ = ('n', 'mean', 'var', 'alpha')
+
+    def __init__(self, halfLife=24):
+        self.n = 0
+        self.mean = 0
+        self.var = 0
+        self.alpha = halfLifeAlpha(halfLife)
+
+    def add(self, x):
+        self.n += 1
+        weight = max(self.alpha, 1 / self.n)
+        delta = x - self.mean
+        self.mean += weight * delta
+        self.var = (1 - weight) * (self.var + weight * delta * delta)
+
+    def getMean(self):
+        return self.mean
+
+    def getVariance(self):
+        n = min(self.n, 1 / self.alpha)
+        m2 = self.var * n
+        if m2 < 2:
+            return float('nan')
+        else:
+            return m2 / (n - 1)
+
+    def getStdev(self):
+        return sqrt(self.getVariance())
+
+
+class EWStdevArray(object):
+    """ EWStdev for many keys at once, with the same interface as StdevArray.
+    """
+    __slots__ = ('n', 'mean', 'var', 'size', 'alpha')
+
+    def __init__(self, size=0, halfLife=24):
+        self.n = np.zeros(max(size, 1024), dtype=np.int64)
+        self.mean = np.zeros(len(self.n), dtype=np.float64)
+        self.var = np.zeros(len(self.n), dtype=np.float64)
+        self.size = size
+        self.alpha = halfLifeAlpha(halfLife)
+
+    def __len__(self):
+        return self.size
+
+    def resize(self, size):
+        """ Make sure rows below size exist; new rows start empty.
+        """
+        if size > len(self.n):
+            capacity = max(size, 2 * len(self.n))
+            for name in ('n', 'mean', 'var'):
+                column = getattr(self, name)
+                grown = np.zeros(capacity, dtype=column.dtype)
+                grown[:len(column)] = column
+                setattr(self, name, grown)
+        self.size = max(self.size, size)
+
+    def add(self, rows, xs):
+        """ EWStdev.add(xs[i]) on each row in rows, which must be distinct.
+        """
+        n = self.n[rows] + 1
+        weight = np.maximum(self.alpha, 1 / n)
+        delta = xs - self.mean[rows]
+        self.mean[rows] += weight * delta
+        self.var[rows] = (1 - weight) * (self.var[rows] + weight * delta * delta)
+        self.n[rows] = n
+
+    def getMean(self, rows=slice(None)):
+        return self.mean[:self.size][rows]
+
+    def getVariance(self, rows=slice(None)):
+        n = np.minimum(self.n[:self.size][rows], 1 / self.alpha)
+        m2 = self.var[:self.size][rows] * n
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(m2 < 2, np.nan, m2 / (n - 1))
+
+    def getStdev(self, rows=slice(None)):
+        return np.sqrt(self.getVariance(rows))
+
+
 def test():
-    from random import shuffle
+    from math import isclose
+    from random import shuffle, Random
+    rand = Random(0)
     l = [1, 2, 3, 4, 5, 6, 7]
     s = Stdev()
     for x in l:
@@ -47,3 +224,49 @@ def test():
         s2.add(x)
     assert abs(s2.getMean() - 4.0) < 0.00001
     assert abs(s2.getStdev() - 2.16025) < 0.00001
+    s3 = Stdev()
+    s3.add_many(l[:3])
+    s4 = Stdev()
+    s4.add_many(l[3:])
+    s3.merge(s4)
+    assert s3.n == 7
+    assert abs(s3.getMean() - 4.0) < 0.00001
+    assert abs(s3.getStdev() - 2.16025) < 0.00001
+    # merging is not bit-exact for arbitrary floats, but agrees with one pass to rounding
+    values = [rand.gauss(1e6, 10.0) for _ in range(1001)]
+    one, left, right = Stdev(), Stdev(), Stdev()
+    one.add_many(values)
+    left.add_many(values[:300])
+    right.add_many(values[300:])
+    left.merge(right)
+    assert left.n == one.n
+    assert isclose(left.getMean(), one.getMean(), rel_tol=1e-12)
+    assert isclose(left.getVariance(), one.getVariance(), rel_tol=1e-9)
+    # and exact on small integers, where every intermediate is representable
+    one, left, right = Stdev(), Stdev(), Stdev()
+    one.add_many([1, 2, 3, 6, 2, 4, 6, 10])
+    left.add_many([1, 2, 3, 6])
+    right.add_many([2, 4, 6, 10])
+    left.merge(right)
+    assert (left.n, left.mean, left.m2) == (one.n, one.mean, one.m2)
+    a = StdevArray(3)
+    rows = np.array([0, 2])
+    for x in l:
+        a.add(rows, np.array([x, 2.0 * x]))
+    assert abs(a.getMean(rows)[0] - s2.getMean()) < 0.00001
+    assert abs(a.getStdev()[2] - 2 * s2.getStdev()) < 0.00001
+    assert a.n[1] == 0 and np.isnan(a.getStdev()[1])
+    e = EWStdev(halfLife=1e9)
+    for x in l:
+        e.add(x)
+    assert abs(e.getMean() - 4.0) < 0.00001
+    assert abs(e.getStdev() - 2.16025) < 0.00001
+    e = EWStdev(halfLife=2)
+    ea = EWStdevArray(2, halfLife=2)
+    for x in l + [100] * 60:
+        e.add(x)
+        ea.add(np.array([1]), np.array([float(x)]))
+    # the old values have faded out
+    assert abs(e.getMean() - 100) < 0.01 and e.var < 0.01
+    assert abs(ea.getMean()[1] - e.getMean()) < 0.00001 and abs(ea.var[1] - e.var) < 0.00001
+    assert ea.n[0] == 0 and np.isnan(ea.getStdev()[0])
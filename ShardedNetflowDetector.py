@@ -0,0 +1,322 @@
+#
+# Copyright (c) 2018, Edgewise Networks Inc. All rights reserved.
+#
+
+import multiprocessing
+from time import perf_counter
+from HLL import hash64
+from NetflowDetector import NetflowDetector
+
+class AlertBuffer(object):
+    """ Stands in for an AlertSink in a shard: keeps the alerts its replica
+        raises while checking, to go back to the coordinator with the partials.
+    """
+    __slots__ = ('alerts',)
+
+    def __init__(self):
+        self.alerts = []
+
+    def add(self, alert):
+        self.alerts.append(alert)
+        return True
+
+    def pop(self):
+        alerts = self.alerts
+        self.alerts = []
+        return alerts
+
+def runShard(detectorClass, kwargs, conn):
+    """ Worker process loop: owns one detector replica and applies the
+        messages sent by ShardedNetflowDetector, in order.
+    """
+    detector = detectorClass(**kwargs)
+    alertBuffer = AlertBuffer()
+    while True:
+        msg = conn.recv()
+        op = msg[0]
+        if op == 'flows':
+            addFlowFeatures = detector.addFlowFeatures
+            for srcip, dstHash in msg[1]:
+                addFlowFeatures(srcip, dstHash)
+        elif op == 'groups':
+            for srcip, dstHashes in msg[1]:
+                detector.addFlowFeatureGroup(srcip, dstHashes)
+        elif op == 'check':
+            detector.lastTimestamp = msg[1]
+            partial = detector.getPartialOutliers(msg[2])
+            conn.send((partial, alertBuffer.pop()))
+        elif op == 'alerts':
+            detector.setAlertSink(alertBuffer if msg[1] else None)
+        elif op == 'call':
+            conn.send(getattr(detector, msg[1])(*msg[2]))
+        elif op == 'close':
+            conn.close()
+            return
+
+
+class ShardedNetflowDetector(object):
+    """ Runs a detector across numShards worker processes. Netflows are
+        partitioned by source IP, which is how all detector state is keyed,
+        so each worker's replica sees every netflow of the hosts it owns.
+
+        This process keeps a coordinating instance of the detector that owns
+        the check schedule, the TimePeriodMap and logging. At each check it
+        gathers every shard's getPartialOutliers (Stdev moments, top-N heaps,
+        active keys' cardinalities) and lets the coordinator's
+        combinePartialOutliers make the same outlier decisions a single
+        process would.
+
+        Exposes the same addNetflow*/checkNetflow surface as a detector, so it
+        can also be added to a CompositeNetflowDetector.
+    """
+    __slots__ = ('detector', 'numShards', 'bufferSize', 'connections', 'processes',
+                 'flowBuffers', 'groupBuffers', 'shardOfSource')
+
+    addNetflowIterator = NetflowDetector.addNetflowIterator
+    addNetflowIteratorMeasured = NetflowDetector.addNetflowIteratorMeasured
+    addNetflowBatchMeasured = NetflowDetector.addNetflowBatchMeasured
+    addNetflowBatchIterator = NetflowDetector.addNetflowBatchIterator
+    addNetflow = NetflowDetector.addNetflow
+    checkNetflow = NetflowDetector.checkNetflow
+
+    def __init__(self, detectorClass, numShards=4, bufferSize=8192, **kwargs):
+        self.detector = detectorClass(**kwargs)
+        self.numShards = numShards
+        self.bufferSize = bufferSize
+        self.connections = []
+        self.processes = []
+        for _ in range(numShards):
+            conn, workerConn = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=runShard, args=(detectorClass, kwargs, workerConn),
+                                              daemon=True)
+            process.start()
+            workerConn.close()
+            self.connections.append(conn)
+            self.processes.append(process)
+        self.flowBuffers = [[] for _ in range(numShards)]
+        self.groupBuffers = [[] for _ in range(numShards)]
+        self.shardOfSource = {}
+
+    @property
+    def lastTimestamp(self):
+        return self.detector.lastTimestamp
+
+    @lastTimestamp.setter
+    def lastTimestamp(self, timestamp):
+        self.detector.lastTimestamp = timestamp
+
+    @property
+    def period(self):
+        return self.detector.period
+
+    @property
+    def metrics(self):
+        return self.detector.metrics
+
+    @property
+    def metricsName(self):
+        return self.detector.metricsName
+
+    def setMetrics(self, metrics, name=None):
+        """ Metrics as for NetflowDetector.setMetrics, with the sizes summed
+            over the shards, and a check's getOutliers time covering the
+            round trip to every shard.
+        """
+        detector = self.detector
+        detector.setMetrics(metrics, name)
+        metrics.addGauge('tracked_keys', detector.metricsName, lambda: sum(self.callShards('getTrackedKeys')))
+        metrics.addGauge('sketch_bytes', detector.metricsName, lambda: sum(self.callShards('getSketchBytes')))
+
+    def getShard(self, srcip):
+        shard = self.shardOfSource.get(srcip)
+        if shard is None:
+            shard = self.shardOfSource[srcip] = hash64(srcip) % self.numShards
+        return shard
+
+    def addFlowFeatures(self, srcip, dstHash):
+        shard = self.getShard(srcip)
+        if self.groupBuffers[shard]:
+            self.flush(shard)
+        buf = self.flowBuffers[shard]
+        buf.append((srcip, dstHash))
+        if len(buf) >= self.bufferSize:
+            self.connections[shard].send(('flows', buf))
+            self.flowBuffers[shard] = []
+
+    def addNetflowBatch(self, batch):
+        for srcip, dstHashes in batch.getSourceGroups():
+            self.addFlowFeatureGroup(srcip, dstHashes)
+        for shard in range(self.numShards):
+            self.flush(shard)
+
+    def addFlowFeatureGroup(self, srcip, dstHashes):
+        shard = self.getShard(srcip)
+        if self.flowBuffers[shard]:
+            self.flush(shard)
+        self.groupBuffers[shard].append((srcip, dstHashes))
+
+    def flush(self, shard):
+        """ Send shard's buffered netflows. Only one of its buffers is ever
+            non-empty, so they arrive in order.
+        """
+        if self.groupBuffers[shard]:
+            self.connections[shard].send(('groups', self.groupBuffers[shard]))
+            self.groupBuffers[shard] = []
+        if self.flowBuffers[shard]:
+            self.connections[shard].send(('flows', self.flowBuffers[shard]))
+            self.flowBuffers[shard] = []
+
+    def setAlertSink(self, alertSink):
+        """ Outlier alerts come from the coordinator. Warnings raised while
+            the shards check, like HostStabilizationDetector's negative N_rem,
+            are sent back with their partials and added to alertSink here;
+            without a sink, the shards print them.
+        """
+        self.detector.setAlertSink(alertSink)
+        for shard, conn in enumerate(self.connections):
+            self.flush(shard)
+            conn.send(('alerts', alertSink is not None))
+
+    def check(self):
+        detector = self.detector
+        detector.checkCount += 1
+        if detector.checkCount % 1000 == 0:
+            print("%s checkCount = %i" % (type(detector).__name__, detector.checkCount))
+        start = perf_counter()
+        activeKeys = [[] for _ in range(self.numShards)]
+        for key in detector.timePeriodMap.getActives():
+            activeKeys[self.getShard(key)].append(key)
+        for shard, conn in enumerate(self.connections):
+            self.flush(shard)
+            conn.send(('check', detector.lastTimestamp, activeKeys[shard]))
+        partials = []
+        for conn in self.connections:
+            partial, alerts = conn.recv()
+            partials.append(partial)
+            if alerts:
+                name = detector.metricsName or type(detector).__name__
+                for alert in alerts:
+                    alert.detector = name
+                    detector.alertSink.add(alert)
+        outliers = detector.combinePartialOutliers(partials)
+        if detector.metrics is None:
+            detector.reportOutliers(outliers)
+        else:
+            detector.measureCheck(start, perf_counter(), outliers)
+
+    def callShards(self, name, *args):
+        """ The result of calling detector method name on every shard's replica.
+        """
+        for shard, conn in enumerate(self.connections):
+            self.flush(shard)
+            conn.send(('call', name, args))
+        return [conn.recv() for conn in self.connections]
+
+    def getState(self):
+        """ The coordinator's state, and each shard's under 'shard<i>.'.
+        """
+        state = self.detector.getState()
+        for shard, shardState in enumerate(self.callShards('getState')):
+            for name, value in shardState.items():
+                state['shard%i.%s' % (shard, name)] = value
+        return state
+
+    def setState(self, state):
+        shards = set(name.split('.', 1)[0] for name in state if name.startswith('shard'))
+        if len(shards) != self.numShards:
+            raise Exception("state has %i shards, not %i" % (len(shards), self.numShards))
+        self.detector.setState(dict((name, value) for name, value in state.items()
+                                    if not name.startswith('shard')))
+        for shard, conn in enumerate(self.connections):
+            self.flush(shard)
+            prefix = 'shard%i.' % shard
+            conn.send(('call', 'setState', (dict((name[len(prefix):], value) for name, value in state.items()
+                                                 if name.startswith(prefix)),)))
+        for conn in self.connections:
+            conn.recv()
+
+    def getExtremes(self):
+        """ The union of the coordinator's and every shard's extremes: the
+            TimePeriodMap is the coordinator's, but state that getOutliers
+            keeps, like HostStabilizationDetector's frozen hosts, is in the
+            shards.
+        """
+        extremes = set(self.detector.getExtremes())
+        for shardExtremes in self.callShards('getExtremes'):
+            extremes.update(shardExtremes)
+        return extremes
+
+    def getExtremeCounts(self):
+        """ getExtremeCounts summed over the coordinator and the shards.
+        """
+        counts = dict(self.detector.getExtremeCounts())
+        for shardCounts in self.callShards('getExtremeCounts'):
+            for name, count in shardCounts.items():
+                counts[name] += count
+        return counts
+
+    def close(self):
+        for shard, conn in enumerate(self.connections):
+            self.flush(shard)
+            conn.send(('close',))
+            conn.close()
+        for process in self.processes:
+            process.join()
+
+
+def test():
+    import io
+    import math
+    import tempfile
+    import contextlib
+    from Benchmark import generateSite
+    import DataIterator
+    from IpPortScanDetector import IpPortScanDetector
+    from ExplosionDetector import ExplosionDetector
+    from GrowthDetector import GrowthDetector
+    from HostStabilizationDetector import HostStabilizationDetector
+    from CompositeNetflowDetector import CompositeNetflowDetector
+    dirname = tempfile.mkdtemp()
+    generateSite(dirname + '/site0', numHosts=200, numFiles=2, rowsPerFile=5000, scanRate=0.01)
+    pathname = dirname + '/site%s'
+    specs = [(IpPortScanDetector, dict(period=10, sigmaCount=2)), (ExplosionDetector, dict(period=20, sigmaCount=2)),
+             (GrowthDetector, dict(period=10, sigmaCount=2)), (HostStabilizationDetector, dict(period=5, tolerance=1))]
+    def run(sharded, batches, alerts=None):
+        composite = CompositeNetflowDetector()
+        detectors = []
+        for cls, kwargs in specs:
+            detector = ShardedNetflowDetector(cls, numShards=3, **kwargs) if sharded else cls(**kwargs)
+            composite.addDetector(detector)
+            detectors.append(detector)
+        if alerts is not None:
+            composite.setAlertSink(alerts)
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            if batches:
+                composite.addNetflowBatchIterator(DataIterator.iterateNetworkDataBatches(pathname, 0, chunkSize=1000))
+            else:
+                composite.addNetflowIterator(DataIterator.iterateNetworkDataImpl(pathname, 0))
+        extremes = [(set(d.getExtremes()), d.getExtremeCounts()) for d in detectors]
+        if sharded:
+            for detector in detectors:
+                detector.close()
+        # shards print their own warnings; the outlier lines come from here
+        return sorted(line for line in out.getvalue().splitlines() if ' ::: ' in line), extremes
+    lines, extremes = run(False, False)
+    assert len(lines) > 10 and any(counts.get('frozen') for _, counts in extremes)
+    assert run(True, False) == (lines, extremes)
+    assert run(True, True) == (lines, extremes)
+    class Alerts(list):
+        add = list.append
+    single, sharded = Alerts(), Alerts()
+    run(False, True, single)
+    run(True, True, sharded)
+    # sigmas from merged moments are not bit-exact, so they are compared to a relative 1e-9
+    key = lambda alert: (alert.timestamp, alert.detector, alert.key, alert.event,
+                         '' if isinstance(alert.value, float) else str(alert.value),
+                         alert.value if isinstance(alert.value, float) else 0.0)
+    assert any(alert.event == 'negative N_rem' for alert in single)
+    assert len(single) == len(sharded)
+    for a, b in zip(sorted(single, key=key), sorted(sharded, key=key)):
+        assert key(a)[:-1] == key(b)[:-1]
+        assert math.isclose(key(a)[-1], key(b)[-1], rel_tol=1e-9)
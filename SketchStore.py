@@ -0,0 +1,214 @@
+#
+# Copyright (c) 2018, Edgewise Networks Inc. All rights reserved.
+#
+
+import numpy as np
+from HLL import HyperLogLog, SlidingHyperLogLog
+from Checkpoint import packKeys, unpackKeys, packSketches, unpackSketches, packScalars, unpackScalar
+
+class SketchStore(dict):
+    """ A dict of key -> HyperLogLog. Missing keys get a new sketch, as with a
+        defaultdict.
+
+        Adding through add_hash/add_hashes records which keys' sketches
+        changed since the last popDirty() or reset(). Detectors can then
+        revisit only those hosts at a check.
+
+        For short-term sketches that are emptied at the end of every period,
+        reset() empties the changed sketches in place instead of allocating
+        new ones. A key with no netflows for maxIdlePeriods periods in a row
+        is evicted. Evicted sketches go to a pool of up to poolSize sketches,
+        and new keys reuse them. reset() costs O(changed + evicted) keys,
+        allocation is bounded by the number of new hosts, and memory by the
+        number of recently active ones.
+
+        With windowPeriods, the sketches are SlidingHyperLogLogs over the last
+        windowPeriods periods, and reset() advances the sketches of the keys
+        active in the window instead of emptying them. getRecent() gives
+        those keys: the only ones whose window count can be non-zero.
+    """
+    __slots__ = ('p', 'maxIdlePeriods', 'windowPeriods', 'poolSize', 'pool', 'dirty', 'period',
+                 'lastActive', 'activeIn')
+
+    def __init__(self, p=16, maxIdlePeriods=None, poolSize=1024, windowPeriods=None):
+        super().__init__()
+        if windowPeriods is not None and maxIdlePeriods is not None and maxIdlePeriods < windowPeriods:
+            raise Exception("maxIdlePeriods must be at least windowPeriods")
+        self.p = p
+        self.maxIdlePeriods = maxIdlePeriods
+        self.windowPeriods = windowPeriods
+        self.poolSize = poolSize
+        self.pool = []
+        self.dirty = set()
+        self.period = 0
+        # key -> last period it had netflows, and period -> those keys
+        self.lastActive = {}
+        self.activeIn = {}
+
+    def __missing__(self, key):
+        if self.pool:
+            sketch = self.pool.pop()
+        elif self.windowPeriods is not None:
+            sketch = SlidingHyperLogLog(self.p, self.windowPeriods)
+        else:
+            sketch = HyperLogLog(self.p)
+        self[key] = sketch
+        self.dirty.add(key)
+        return sketch
+
+    def add_hash(self, key, h):
+        """ Returns True if key's sketch changed.
+        """
+        if self[key].add_hash(h):
+            self.dirty.add(key)
+            return True
+        return False
+
+    def add_hashes(self, key, hashes):
+        if self[key].add_hashes(hashes):
+            self.dirty.add(key)
+            return True
+        return False
+
+    def popDirty(self):
+        """ The keys whose sketches changed since the last call, or reset().
+        """
+        dirty = self.dirty
+        self.dirty = set()
+        return dirty
+
+    def getRecent(self):
+        """ Keys with netflows in the current period or, with windowPeriods,
+            in the rest of the window.
+        """
+        if self.windowPeriods is None:
+            return set(self.dirty)
+        recent = set(self.dirty)
+        for period in range(self.period - self.windowPeriods + 1, self.period):
+            recent.update(self.activeIn.get(period, ()))
+        return recent
+
+    def reset(self):
+        """ Start the next period: empty the sketches, or slide their windows,
+            and evict idle keys. Returns the evicted keys.
+        """
+        if self.windowPeriods is not None:
+            for key in self.getRecent():
+                self[key].advance()
+        dirty = self.popDirty()
+        if self.windowPeriods is None:
+            for key in dirty:
+                sketch = self.get(key)
+                if sketch is not None:
+                    sketch.clear()
+        evicted = []
+        if self.maxIdlePeriods is not None or self.windowPeriods is not None:
+            period = self.period
+            lastActive = self.lastActive
+            activeIn = self.activeIn
+            current = activeIn.setdefault(period, set())
+            for key in dirty:
+                if key not in self:
+                    continue
+                previous = lastActive.get(key)
+                if previous is not None and previous != period:
+                    activeIn[previous].discard(key)
+                lastActive[key] = period
+                current.add(key)
+            if self.maxIdlePeriods is not None:
+                # keys last active maxIdlePeriods periods ago have been idle since
+                evicted = list(activeIn.pop(period - self.maxIdlePeriods, ()))
+                for key in evicted:
+                    del lastActive[key]
+                    sketch = self.pop(key)
+                    if len(self.pool) < self.poolSize:
+                        self.pool.append(sketch)
+            else:
+                # only the window's periods are needed
+                for key in activeIn.pop(period - self.windowPeriods, ()):
+                    del lastActive[key]
+        self.period += 1
+        return evicted
+
+    def getState(self, state, prefix):
+        """ Add the sketches, dirty flags and idle bookkeeping to a checkpoint state dict.
+        """
+        if self.windowPeriods is None:
+            packSketches(state, prefix, self)
+        else:
+            packKeys(state, prefix, self.keys())
+            slots = [sketch.getSlots() for sketch in self.values()]
+            for i in range(self.windowPeriods):
+                packSketches(state, '%s.slot%i' % (prefix, i),
+                             dict(zip(self.keys(), (sketches[i] for sketches in slots))))
+        state[prefix + '.dirty'] = np.array([key in self.dirty for key in self], dtype=np.bool_)
+        state[prefix + '.lastActive'] = np.array([self.lastActive.get(key, -1) for key in self], dtype=np.int64)
+        packScalars(state, prefix, period=self.period)
+
+    def setState(self, state, prefix):
+        self.clear()
+        if self.windowPeriods is None:
+            unpackSketches(state, prefix, self)
+        else:
+            slots = [unpackSketches(state, '%s.slot%i' % (prefix, i), {}) for i in range(self.windowPeriods)]
+            for key in unpackKeys(state, prefix):
+                sketch = SlidingHyperLogLog(self.p, self.windowPeriods)
+                sketch.setSlots([sketches[key] for sketches in slots])
+                self[key] = sketch
+        self.dirty = set()
+        self.lastActive = {}
+        self.activeIn = {}
+        for key, dirty, lastActive in zip(list(self), state[prefix + '.dirty'].tolist(),
+                                          state[prefix + '.lastActive'].tolist()):
+            if dirty:
+                self.dirty.add(key)
+            if lastActive >= 0:
+                self.lastActive[key] = lastActive
+                self.activeIn.setdefault(lastActive, set()).add(key)
+        self.period = unpackScalar(state, prefix, 'period', int)
+
+
+def test():
+    from HLL import hash64, hashMany
+    store = SketchStore(12, maxIdlePeriods=2, poolSize=1)
+    store.add_hashes('a', hashMany([str(i) for i in range(100)]))
+    for i in range(10):
+        store.add_hash('b', hash64(str(i)))
+    assert store.popDirty() == {'a', 'b'} and not store.popDirty()
+    assert not store.add_hash('b', hash64('0')) and not store.dirty
+    store.add_hash('b', hash64('1000'))
+    sketch = store['a']
+    assert store.reset() == [] and store['a'] is sketch
+    # only b changed since popDirty(), so only b is emptied
+    assert abs(store['a'].cardinality() - 100) < 5 and store['b'].isEmpty()
+    store.add_hash('a', hash64('1'))
+    assert store.reset() == []
+    # b was last active two periods ago, and its sketch goes to the pool
+    b = store['b']
+    assert store.reset() == ['b'] and 'b' not in store and store.pool == [b]
+    assert store['c'] is b and b.isEmpty() and not store.pool
+    # state round trip
+    store.add_hash('c', hash64('5'))
+    state = {}
+    store.getState(state, 'store')
+    copy = SketchStore(12, maxIdlePeriods=2)
+    copy.setState(state, 'store')
+    assert set(copy) == set(store) and copy.dirty == store.dirty and copy.period == store.period
+    assert copy.lastActive == store.lastActive
+    assert all(copy[key].cardinality() == store[key].cardinality() for key in store)
+    assert copy.reset() == store.reset()
+    # windows slide, and keep their counts for windowPeriods periods
+    window = SketchStore(12, windowPeriods=3)
+    window.add_hashes('a', hashMany([str(i) for i in range(50)]))
+    window.reset()
+    window.add_hash('b', hash64('1'))
+    assert window.getRecent() == {'a', 'b'}
+    state = {}
+    window.getState(state, 'window')
+    copy = SketchStore(12, windowPeriods=3)
+    copy.setState(state, 'window')
+    for store in (window, copy):
+        assert abs(store['a'].cardinality() - 50) < 3
+        store.reset()
+        store.reset()
+        assert store.getRecent() == {'b'} and store['a'].cardinality() == 0
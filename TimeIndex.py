@@ -0,0 +1,164 @@
+#
+# Copyright (c) 2018, Edgewise Networks Inc. All rights reserved.
+#
+
+import os
+import gzip
+import json
+from itertools import islice
+import numpy as np
+
+class TimeIndex(object):
+    """ Per-file time index, saved as JSON: each file's mtime, size and row
+        count, and for each block of blockSize rows its first row and its
+        min and max timestamp (in seconds).
+
+        update() rescans a file only when its mtime or size changed, so the
+        index can be refreshed on every replay. getRowRanges() turns a
+        [start, end) time range into the row ranges of a file worth reading.
+    """
+    __slots__ = ('indexName', 'blockSize', 'entries', 'changed')
+
+    def __init__(self, indexName, blockSize=65536):
+        self.indexName = indexName
+        self.blockSize = blockSize
+        self.entries = {}
+        self.changed = False
+        if os.path.exists(indexName):
+            with open(indexName, 'r') as f:
+                saved = json.load(f)
+            if saved['blockSize'] == blockSize:
+                self.entries = saved['entries']
+
+    def isCurrent(self, name, fname):
+        entry = self.entries.get(name)
+        if entry is None:
+            return False
+        st = os.stat(fname)
+        return entry['mtime'] == st.st_mtime and entry['size'] == st.st_size
+
+    def update(self, name, fname, scan):
+        """ Index fname under name, with scan(fname, blockSize) -> (rows,
+            [(first row, min ts, max ts)]), unless the entry is current.
+        """
+        if self.isCurrent(name, fname):
+            return
+        st = os.stat(fname)
+        rows, blocks = scan(fname, self.blockSize)
+        self.entries[name] = {'mtime': st.st_mtime, 'size': st.st_size, 'rows': rows,
+                              'blocks': [list(block) for block in blocks]}
+        self.changed = True
+
+    def save(self):
+        if not self.changed:
+            return
+        tmp = self.indexName + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'blockSize': self.blockSize, 'entries': self.entries}, f)
+        os.replace(tmp, self.indexName)
+        self.changed = False
+
+    def getTimeRange(self, name):
+        """ (min, max) timestamp of the file, or None if it has no rows.
+        """
+        blocks = self.entries[name]['blocks']
+        if not blocks:
+            return None
+        return min(b[1] for b in blocks), max(b[2] for b in blocks)
+
+    def getRowRanges(self, name, start=None, end=None):
+        """ [(first row, end row)] of the blocks that may hold timestamps in
+            [start, end), with adjacent blocks merged.
+        """
+        entry = self.entries[name]
+        blocks = entry['blocks']
+        ranges = []
+        for i, (first, lo, hi) in enumerate(blocks):
+            if (start is not None and hi < start) or (end is not None and lo >= end):
+                continue
+            last = blocks[i + 1][0] if i + 1 < len(blocks) else entry['rows']
+            if ranges and ranges[-1][1] == first:
+                ranges[-1] = (ranges[-1][0], last)
+            else:
+                ranges.append((first, last))
+        return ranges
+
+
+def blockStats(timestamps, blockSize):
+    """ [(first row, min, max)] of each blockSize-row block of an array.
+    """
+    return [(first, float(timestamps[first:first + blockSize].min()),
+             float(timestamps[first:first + blockSize].max()))
+            for first in range(0, len(timestamps), blockSize)]
+
+def scanTextFile(fname, blockSize):
+    """ TimeIndex scan of a .txt.gz netflow file. Only the timestamp column is parsed.
+    """
+    rows = 0
+    blocks = []
+    with gzip.open(fname, 'rb') as f:
+        while True:
+            lines = list(islice(f, blockSize))
+            if not lines:
+                break
+            ts = np.array([x.split(b'\t', 1)[0] for x in lines], dtype=np.float64) / 1000.0
+            blocks.append((rows, float(ts.min()), float(ts.max())))
+            rows += len(lines)
+    return rows, blocks
+
+def inTimeRange(timestamp, start, end):
+    return (start is None or timestamp >= start) and (end is None or timestamp < end)
+
+def timeRangeMask(timestamps, start, end):
+    """ Boolean mask of the timestamps in [start, end), or None if the range is unbounded.
+    """
+    mask = None
+    if start is not None:
+        mask = timestamps >= start
+    if end is not None:
+        mask = timestamps < end if mask is None else mask & (timestamps < end)
+    return mask
+
+
+def test():
+    import gzip
+    import random
+    import tempfile
+    from DataIterator import iterNetflows, iterateData
+    dirname = tempfile.mkdtemp()
+    os.mkdir(os.path.join(dirname, 'site0'))
+    fname = os.path.join(dirname, 'site0', 'flows.txt.gz')
+    rng = random.Random(0)
+    timestamp = 1500000000000
+    with gzip.open(fname, 'wt') as out:
+        for i in range(5000):
+            timestamp += rng.randint(1, 40)
+            out.write('%i\t10.0.0.%i\t%i\t10.1.0.%i\t80\t1\n' % (timestamp, rng.randint(1, 254), rng.randint(1024, 65535),
+                                                           rng.randint(1, 254)))
+    indexName = os.path.join(dirname, 'index.json')
+    index = TimeIndex(indexName, blockSize=400)
+    index.update('f', fname, scanTextFile)
+    index.save()
+    netflows = list(iterNetflows(fname))
+    assert index.entries['f']['rows'] == len(netflows) and len(index.entries['f']['blocks']) == 13
+    assert index.getTimeRange('f') == (netflows[0].timestamp, netflows[-1].timestamp)
+    assert index.getRowRanges('f') == [(0, 5000)]
+    for start, end in ((None, None), (netflows[1000].timestamp, netflows[2100].timestamp),
+                       (None, netflows[10].timestamp), (netflows[4999].timestamp, None),
+                       (netflows[-1].timestamp + 1, None)):
+        rowRanges = index.getRowRanges('f', start, end)
+        # only the blocks overlapping the range are read, and they hold every row in it
+        assert sum(last - first for first, last in rowRanges) < 5000 or start is end is None
+        rows = [repr(nf) for nf in iterNetflows(fname, rowRanges) if inTimeRange(nf.timestamp, start, end)]
+        assert rows == [repr(nf) for nf in netflows if inTimeRange(nf.timestamp, start, end)]
+    # a saved index is current until the file changes
+    index = TimeIndex(indexName, blockSize=400)
+    assert index.isCurrent('f', fname)
+    index.update('f', fname, lambda fname, blockSize: 1 / 0)
+    os.utime(fname, (0, 0))
+    assert not index.isCurrent('f', fname)
+    assert not TimeIndex(indexName, blockSize=1000).entries
+    # the site readers use the index for bounded reads
+    pathname = os.path.join(dirname, 'site%s')
+    assert [repr(nf) for nf in iterateData(pathname, 0, netflows[1000].timestamp, netflows[2100].timestamp)] == \
+        [repr(nf) for nf in netflows[1000:2100]]
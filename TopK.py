@@ -0,0 +1,105 @@
+#
+# Copyright (c) 2018, Edgewise Networks Inc. All rights reserved.
+#
+
+class TopK(object):
+    """ The k keys with the largest values, maintained as values rise.
+
+        Entries are ranked as (value, key) tuples, the same order
+        heapq.nlargest gives (value, key) pairs. update() must be called
+        whenever a key's value changes. The smallest kept entry (the floor) is
+        cached, so an update for a key that is not in the top k and does not
+        beat the floor is a single tuple comparison.
+
+        Keys that were turned away are forgotten, so the top k can only follow
+        values that go up. HLL cardinalities nearly always do, but an estimate
+        can drop a little where it switches from linear counting to the raw
+        estimate. When a kept value goes down once keys may have been turned
+        away, stale is set: largest() may then be missing a key, and the
+        caller should find the top k from all the values and rebuild() it.
+    """
+    __slots__ = ('k', 'values', 'floor', 'stale')
+
+    def __init__(self, k=10):
+        self.k = k
+        self.values = {}
+        self.floor = None
+        self.stale = False
+
+    def __len__(self):
+        return len(self.values)
+
+    def __contains__(self, key):
+        return key in self.values
+
+    def update(self, key, value):
+        values = self.values
+        if key in values:
+            if value < values[key] and len(values) >= self.k:
+                # a key turned away may rank above this one now
+                self.stale = True
+            values[key] = value
+            if self.floor is not None and self.floor[1] == key:
+                self.floor = None
+            return
+        if len(values) < self.k:
+            values[key] = value
+            self.floor = None
+            return
+        if self.k == 0:
+            return
+        floor = self.getFloor()
+        if (value, key) > floor:
+            del values[floor[1]]
+            values[key] = value
+            self.floor = None
+
+    def getFloor(self):
+        """ The smallest kept (value, key) pair.
+        """
+        if self.floor is None:
+            self.floor = min((value, key) for key, value in self.values.items())
+        return self.floor
+
+    def largest(self):
+        """ The kept (value, key) pairs, largest first.
+        """
+        return sorted(((value, key) for key, value in self.values.items()), reverse=True)
+
+    def rebuild(self, pairs):
+        """ Keep the (value, key) pairs, the top k of every value.
+        """
+        self.values = dict((key, value) for value, key in pairs)
+        self.floor = None
+        self.stale = False
+
+    def clear(self):
+        self.values = {}
+        self.floor = None
+        self.stale = False
+
+
+def test():
+    import heapq
+    import random
+    rand = random.Random(7)
+    top = TopK(5)
+    current = {}
+    for _ in range(20000):
+        key = rand.randrange(300)
+        current[key] = current.get(key, 0) + rand.random()
+        top.update(key, current[key])
+    expected = heapq.nlargest(5, ((value, key) for key, value in current.items()))
+    assert top.largest() == expected and not top.stale
+    # the largest value drops below one that was turned away
+    key = expected[0][1]
+    current[key] = 0.0
+    top.update(key, 0.0)
+    assert top.stale
+    expected = heapq.nlargest(5, ((value, key) for key, value in current.items()))
+    top.rebuild(expected)
+    assert top.largest() == expected and not top.stale
+    top.clear()
+    top.update(1, 2.0)
+    top.update(1, 1.0)
+    assert not top.stale and top.largest() == [(1.0, 1)]
@@ -1,22 +1,67 @@
-from collections import deque
+import numpy as np
 
 inf = float('inf')
 
 class AbstractWindowOperation(object):
+    """ The last maxlen values added, in a ring buffer, with running sums of
+        y, x*y and y*y so estimates cost O(1) whatever maxlen is. x counts
+        the values in the window, oldest first; slopes don't depend on where
+        x starts, so this is the same as numbering them by add().
+    """
+    __slots__ = ('ring', 'maxlen', 'cnt', 'sumY', 'sumXY', 'sumYY')
 
-    __slots__ = ('dq', 'maxlen', 'cnt')
-    
     def __init__(self, maxlen):
-        self.dq = deque()
+        self.ring = [0] * maxlen
         self.maxlen = maxlen
         self.cnt = 0
-    
+        self.sumY = 0
+        self.sumXY = 0
+        self.sumYY = 0
+
+    def __len__(self):
+        return min(self.cnt, self.maxlen)
+
     def add(self, item):
-        if len(self.dq) >= self.maxlen:
-            self.dq.popleft()
-        self.dq.append(item)
+        n = len(self)
+        i = self.cnt % self.maxlen
+        if n == self.maxlen:
+            # drop the oldest value and renumber the rest from 1
+            old = self.ring[i]
+            self.sumXY -= self.sumY
+            self.sumY -= old
+            self.sumYY -= old * old
+        else:
+            n += 1
+        self.ring[i] = item
+        self.sumY += item
+        self.sumYY += item * item
+        self.sumXY += n * item
         self.cnt += 1
-    
+        if i == self.maxlen - 1:
+            # the ring is in order now: recount the sums, so float rounding
+            # errors can't build up over a long-lived window
+            ring = self.ring
+            self.sumY = sum(ring)
+            self.sumYY = sum(y * y for y in ring)
+            self.sumXY = sum(x * y for x, y in enumerate(ring, 1))
+
+    def values(self):
+        """ The values in the window, oldest first.
+        """
+        i = self.cnt % self.maxlen
+        if self.cnt < self.maxlen:
+            return self.ring[:i]
+        return self.ring[i:] + self.ring[:i]
+
+    def getMean(self):
+        return self.sumY / len(self)
+
+    def getVariance(self):
+        n = len(self)
+        if n < 2:
+            return float('nan')
+        return max(self.sumYY - self.sumY * self.sumY / n, 0) / (n - 1)
+
     def estimate(self):
         raise Exception("implement in subclass")
 
@@ -24,9 +69,9 @@ class AverageWindow(AbstractWindowOperation):
 
     def __init__(self, maxlen=5):
         super().__init__(maxlen)
-    
+
     def estimate(self):
-        return sum(self.dq)/len(self.dq)
+        return self.getMean()
 
 class SlopeWindow(AbstractWindowOperation):
 
@@ -35,24 +80,99 @@ class SlopeWindow(AbstractWindowOperation):
 
     def __init__(self, maxlen=5):
         super().__init__(maxlen)
-    
+
     def estimate(self):
-        if self.cnt < 2: 
+        if self.cnt < 2:
             return inf
-        xs = list(range(self.cnt - len(self.dq) + 1, self.cnt + 1))
-        xbar = sum(xs)/len(xs)
-        ybar = sum(self.dq)/len(self.dq)
-        numer = 0
-        denom = 0
-        for x, y in zip(xs, self.dq):
-            numer += (x-xbar) * (y-ybar)
-            denom += (x-xbar) * (x-xbar)
+        n = len(self)
+        # sums of squares and products about the means, for x = 1..n
+        denom = n * (n * n - 1) / 12
         if denom == 0:
             return inf
-        #print(xs, self.dq, xbar, ybar, numer, denom)
+        numer = self.sumXY - (n + 1) / 2 * self.sumY
         return numer / denom
 
 
+class WindowArray(object):
+    """ SlopeWindow for many keys at once: row r's window is the ring
+        values[r], and its running sums are NumPy columns, so whole
+        populations of windows are updated and estimated in one step.
+    """
+    __slots__ = ('cnt', 'sumY', 'sumXY', 'sumYY', 'values', 'maxlen', 'size')
+
+    columns = ('cnt', 'sumY', 'sumXY', 'sumYY', 'values')
+
+    def __init__(self, maxlen=5, size=0):
+        capacity = max(size, 1024)
+        self.cnt = np.zeros(capacity, dtype=np.int64)
+        self.sumY = np.zeros(capacity, dtype=np.float64)
+        self.sumXY = np.zeros(capacity, dtype=np.float64)
+        self.sumYY = np.zeros(capacity, dtype=np.float64)
+        self.values = np.zeros((capacity, maxlen), dtype=np.float64)
+        self.maxlen = maxlen
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def resize(self, size):
+        """ Make sure rows below size exist; new rows start empty.
+        """
+        if size > len(self.cnt):
+            capacity = max(size, 2 * len(self.cnt))
+            for name in self.columns:
+                column = getattr(self, name)
+                grown = np.zeros((capacity,) + column.shape[1:], dtype=column.dtype)
+                grown[:len(column)] = column
+                setattr(self, name, grown)
+        self.size = max(self.size, size)
+
+    def add(self, rows, ys):
+        """ SlopeWindow.add(ys[i]) on each row in rows, an array of distinct rows.
+        """
+        maxlen = self.maxlen
+        cnt = self.cnt[rows]
+        i = cnt % maxlen
+        full = cnt >= maxlen
+        old = np.where(full, self.values[rows, i], 0.0)
+        sumY = self.sumY[rows]
+        sumXY = self.sumXY[rows] - np.where(full, sumY, 0.0)
+        sumY -= old
+        sumYY = self.sumYY[rows] - old * old
+        n = np.minimum(cnt + 1, maxlen)
+        self.values[rows, i] = ys
+        self.sumY[rows] = sumY + ys
+        self.sumYY[rows] = sumYY + ys * ys
+        self.sumXY[rows] = sumXY + n * ys
+        self.cnt[rows] = cnt + 1
+        # recount the sums of rings that are in order now, as SlopeWindow does
+        inOrder = rows[i == maxlen - 1]
+        if len(inOrder):
+            values = self.values[inOrder]
+            self.sumY[inOrder] = values.sum(axis=1)
+            self.sumYY[inOrder] = (values * values).sum(axis=1)
+            self.sumXY[inOrder] = values @ np.arange(1, maxlen + 1, dtype=np.float64)
+
+    def getCount(self, rows=slice(None)):
+        return np.minimum(self.cnt[:self.size][rows], self.maxlen)
+
+    def getMean(self, rows=slice(None)):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.sumY[:self.size][rows] / self.getCount(rows)
+
+    def estimate(self, rows=slice(None)):
+        """ (slopes, intercepts) arrays, like ILSArray.estimate. Windows only
+            fit slopes: intercepts are 0, and slopes are inf where
+            SlopeWindow.estimate would be.
+        """
+        n = self.getCount(rows)
+        denom = n * (n * n - 1) / 12
+        numer = self.sumXY[:self.size][rows] - (n + 1) / 2 * self.sumY[:self.size][rows]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            slope = np.where(denom == 0, inf, numer / denom)
+        return slope, np.zeros(len(slope))
+
+
 def testAverage():
     import random
     l = list(range(1, 12))
@@ -61,9 +181,10 @@ def testAverage():
         random.shuffle(l)
         for i in l:
             aw.add(i)
-        avg = aw.calculate()
+        avg = aw.estimate()
         #print(avg)
         assert abs(avg - 6.0) < 0.000001
+        assert abs(aw.getVariance() - 11.0) < 0.000001
 
 def testSlope():
     sw = SlopeWindow(10)
@@ -73,8 +194,26 @@ def testSlope():
         for _ in range(10):
             sw.add(yval)
             yval -= decr
-        slope = sw.calculate()
+        slope = sw.estimate()
         #print(slope)
         assert abs(slope + decr) < 0.000001
         decr /= 2
-        
\ No newline at end of file
+
+def testWindowArray():
+    import random
+    windows = [SlopeWindow(7) for _ in range(3)]
+    wa = WindowArray(7, 3)
+    rows = np.array([0, 2])
+    for _ in range(30):
+        ys = np.array([random.random() * 100, random.randrange(50)])
+        for row, y in zip(rows, ys.tolist()):
+            windows[row].add(y)
+        wa.add(rows, ys)
+        slopes, _ = wa.estimate()
+        means = wa.getMean()
+        for row in rows:
+            slope = windows[row].estimate()
+            assert slopes[row] == slope if slope == inf else abs(slopes[row] - slope) < 1e-6
+            assert abs(means[row] - windows[row].getMean()) < 1e-6
+            assert np.allclose(sorted(wa.values[row][:len(windows[row])]), sorted(windows[row].values()))
+    assert wa.getCount()[1] == 0 and wa.estimate()[0][1] == inf